@@ -0,0 +1,32 @@
+# Throughput of the batch Gaussian fitting (fits/s) for synthetic spectra, serially and on a process pool.
+#
+#   python benchmarks/bench_batch_fit.py 200 4
+import sys
+import time
+import numpy as np
+from ACHist.batch_fit import fit_peaks_batch
+from ACHist.binning import fill_histo1d
+from ACHist.histogram import Histogram1D
+
+def synthetic_jobs(n_spectra: int, seed: int = 42):
+    # one spectrum per "detector strip": a doublet on an exponential background
+    rng = np.random.default_rng(seed)
+    jobs = []
+    for i in np.arange(n_spectra):
+        centers = [1000 + rng.normal(0, 2), 1030 + rng.normal(0, 2)]
+        events = np.concatenate([rng.normal(centers[0], 6, 20000), rng.normal(centers[1], 6, 10000), rng.exponential(800, 200000)])
+        counts, edges = fill_histo1d(events, bins=4096, range=(0, 4096))
+        jobs.append((Histogram1D(counts, edges, name=f"strip_{i}"), (960, 1070), centers, [950, 960, 1070, 1080]))
+    return jobs
+
+if __name__ == "__main__":
+    n_spectra = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else -1
+
+    jobs = synthetic_jobs(n_spectra)
+
+    for n_workers in [None, workers]:
+        start = time.perf_counter()
+        results = fit_peaks_batch(jobs, workers=n_workers, verbose=False)
+        elapsed = time.perf_counter() - start
+        print(f"workers={n_workers}: {len(jobs)} fits in {elapsed:.2f} s ({len(jobs) / elapsed:.1f} fits/s), {results['success'].sum()} peaks fitted")
@@ -0,0 +1,43 @@
+# Time and agreement of the lmfit and fast fit backends on synthetic multiplets of 1 to 8 peaks.
+#
+#   python benchmarks/bench_fit_backends.py 20
+import sys
+import time
+import numpy as np
+from ACHist.binning import fill_histo1d
+from ACHist.histo1d_tools import fit_linear_background, fit_region
+
+def synthetic_multiplet(n_peaks: int, seed: int = 42):
+    # n_peaks peaks 25 channels apart on an exponential background
+    rng = np.random.default_rng(seed)
+    centers = 1000 + 25 * np.arange(n_peaks) + rng.normal(0, 1, n_peaks)
+    events = np.concatenate([rng.normal(center, 5, 5000) for center in centers] + [rng.exponential(800, 300000)])
+    counts, edges = fill_histo1d(events, bins=4096, range=(0, 4096))
+    region = (centers[0] - 30, centers[-1] + 30)
+    return counts, edges, region, list(centers)
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    for n_peaks in [1, 2, 4, 8]:
+        counts, edges, region, centers = synthetic_multiplet(n_peaks)
+        centres = (edges[:-1] + edges[1:]) / 2
+        background_result, _ = fit_linear_background(region, counts, centres)
+
+        line = f"{n_peaks} peaks:"
+        results = {}
+        for backend, objective in [("lmfit", "chi2"), ("fast", "chi2"), ("fast", "poisson")]:
+            start = time.perf_counter()
+            for _ in np.arange(repeats):
+                result, _ = fit_region(counts, centres, region, centers, background_result, backend=backend, objective=objective)
+            elapsed = (time.perf_counter() - start) / repeats
+            results[(backend, objective)] = result
+            line += f"  {backend}/{objective} {elapsed * 1e3:7.2f} ms"
+
+        # largest difference of the fitted centres to lmfit, in units of the centre uncertainty of the fast fit
+        reference = results[("lmfit", "chi2")].params
+        for key in [("fast", "chi2"), ("fast", "poisson")]:
+            params = results[key].params
+            pulls = [abs(params[f"g{i}_center"].value - reference[f"g{i}_center"].value) / params[f"g{i}_center"].stderr for i in np.arange(n_peaks)]
+            line += f"  {key[0]}/{key[1]} max centre pull {max(pulls):.2f}"
+        print(line)
@@ -0,0 +1,54 @@
+# Compares the old histo2d binning/rendering (np.histogram2d for the return value and ax.hist2d for the plot)
+# with the single-pass fill engine rendered through pcolormesh. Runs headless.
+#
+#   python benchmarks/bench_histo2d.py 10000000 100000000
+import sys
+import time
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import matplotlib.colors as colors
+import numpy as np
+from ACHist.binning import fill_histo2d
+
+BINS = [1024, 1024]
+RANGE = [[0, 4096], [0, 4096]]
+
+def old_path(x_data, y_data):
+    fig, ax = plt.subplots()
+    hist, x_edges, y_edges = np.histogram2d(x_data, y_data, bins=BINS, range=RANGE)
+    ax.hist2d(x_data, y_data, bins=BINS, range=RANGE, norm=colors.LogNorm())
+    fig.canvas.draw()
+    plt.close(fig)
+    return hist
+
+def new_path(x_data, y_data):
+    fig, ax = plt.subplots()
+    hist, x_edges, y_edges = fill_histo2d(x_data, y_data, bins=BINS, range=RANGE)
+    ax.pcolormesh(x_edges, y_edges, hist.T, norm=colors.LogNorm())
+    fig.canvas.draw()
+    plt.close(fig)
+    return hist
+
+def best_of(function, *args, repeat=3):
+    times = []
+    for _ in np.arange(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == "__main__":
+    sizes = [int(float(arg)) for arg in sys.argv[1:]] or [10_000_000]
+    rng = np.random.default_rng(42)
+
+    print(f"{'events':>12} {'old [s]':>10} {'new [s]':>10} {'speedup':>8}")
+    for size in sizes:
+        x_data = rng.normal(2048, 600, size)
+        y_data = 0.5 * x_data + rng.normal(1000, 300, size)
+
+        old_time, old_hist = best_of(old_path, x_data, y_data)
+        new_time, new_hist = best_of(new_path, x_data, y_data)
+        assert np.array_equal(old_hist, new_hist)
+
+        print(f"{size:>12} {old_time:>10.3f} {new_time:>10.3f} {old_time / new_time:>7.1f}x")
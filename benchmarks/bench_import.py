@@ -0,0 +1,29 @@
+# Cold-start import time of the package modules, each measured in a fresh interpreter (best of n), and
+# whether the fitting stack (lmfit, scipy, tabulate) was loaded by the import.
+#
+#   python benchmarks/bench_import.py 5
+import subprocess
+import sys
+
+MODULES = ["ACHist.binning", "ACHist.stream", "ACHist.histo1d_tools", "ACHist.histo2d_tools", "ACHist.batch_fit"]
+FITTING_STACK = ["lmfit", "scipy", "tabulate"]
+
+SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed, ','.join(name for name in {fitting_stack} if name in sys.modules))
+"""
+
+def import_time(module: str):
+    output = subprocess.run([sys.executable, "-c", SCRIPT.format(module=module, fitting_stack=FITTING_STACK)],
+                            capture_output=True, text=True, check=True).stdout.split()
+    return float(output[0]), output[1] if len(output) > 1 else ""
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    for module in MODULES:
+        times, loaded = zip(*[import_time(module) for _ in range(repeats)])
+        print(f"{module:24s} {min(times) * 1e3:8.1f} ms  fitting stack loaded: {loaded[0] or 'none'}")
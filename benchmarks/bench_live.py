@@ -0,0 +1,38 @@
+# Sustained fill rate (events/s) of the live histograms with the plot open (Agg canvas), redrawing after
+# every batch and rate-limited to a few redraws per second.
+#
+#   python benchmarks/bench_live.py 5
+import sys
+import time
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+from ACHist.live import LiveHistogram1D, LiveHistogram2D
+
+BATCH_SIZE = 50_000
+
+def sustained_rate(histogram, batches, seconds: float):
+    start = time.perf_counter()
+    n_batches = 0
+    while time.perf_counter() - start < seconds:
+        histogram.fill(*batches[n_batches % len(batches)])
+        n_batches += 1
+    histogram.refresh(force=True)
+    elapsed = time.perf_counter() - start
+    return histogram.entries / elapsed, histogram.redraws
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    rng = np.random.default_rng(42)
+    batches_1d = [(rng.normal(2048, 300, BATCH_SIZE),) for _ in np.arange(8)]
+    batches_2d = [(rng.normal(2048, 300, BATCH_SIZE), rng.normal(2048, 500, BATCH_SIZE)) for _ in np.arange(8)]
+
+    for name, make_histogram, batches in [("1D 65536 bins", lambda rate: LiveHistogram1D(bins=65536, range=(0, 4096), redraw_rate=rate), batches_1d),
+                                          ("2D 1024x1024 bins", lambda rate: LiveHistogram2D(bins=(1024, 1024), range=[[0, 4096], [0, 4096]], redraw_rate=rate), batches_2d)]:
+        for redraw_rate in [None, 5.0]:
+            histogram = make_histogram(redraw_rate)
+            events_per_second, redraws = sustained_rate(histogram, batches, seconds)
+            print(f"{name}, redraw_rate={redraw_rate}: {events_per_second / 1e6:.2f} M events/s, {redraws} redraws")
+            plt.close(histogram.fig)
@@ -0,0 +1,57 @@
+# Synthetic nuclear-physics data for the benchmarks. All generators are seeded so the runs are reproducible.
+import numpy as np
+import polars as pl
+
+# gamma lines (keV) on top of the exponential background of the energy spectra
+PEAKS = [(511.0, 0.20), (661.7, 0.25), (1173.2, 0.15), (1332.5, 0.15), (2614.5, 0.05)]
+RESOLUTION = 0.003 # sigma / energy
+
+def peaks_on_background(n_events: int, seed: int = 42) -> np.ndarray:
+    # energy spectrum: Gaussian peaks (relative intensities above) on an exponential background with 20% of the events
+    rng = np.random.default_rng(seed)
+    n_background = n_events // 5
+    counts = rng.multinomial(n_events - n_background, [fraction / sum(f for _, f in PEAKS) for _, fraction in PEAKS])
+
+    energy = np.empty(n_events)
+    energy[:n_background] = rng.exponential(800, n_background)
+    start = n_background
+    for (center, _), n_peak in zip(PEAKS, counts):
+        energy[start:start + n_peak] = rng.normal(center, center * RESOLUTION * 3, n_peak)
+        start += n_peak
+    return energy
+
+def gamma_lines(n_events: int, n_lines: int = 200, fwhm: float = 3.0, seed: int = 42) -> np.ndarray:
+    # energy spectrum with many gamma lines of the same FWHM (keV) and random intensities on an exponential background with half of the events
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(50, 4050, n_lines)
+    n_background = n_events // 2
+    intensities = rng.uniform(0.05, 1, n_lines)
+    counts = rng.multinomial(n_events - n_background, intensities / intensities.sum())
+
+    energy = np.empty(n_events)
+    energy[:n_background] = rng.exponential(800, n_background)
+    energy[n_background:] = rng.normal(np.repeat(centers, counts), fwhm / (2 * np.sqrt(2 * np.log(2))))
+    return energy
+
+def pid_bands(n_events: int, n_bands: int = 5, seed: int = 42) -> pl.DataFrame:
+    # particle identification (e.g. dE-E): hyperbolic bands dE ~ k / E, one per particle species
+    rng = np.random.default_rng(seed)
+    band = rng.integers(0, n_bands, n_events)
+    energy = rng.uniform(200, 4000, n_events)
+    delta_e = (band + 1) * 4e5 / (energy + 100) + rng.normal(0, 15, n_events)
+    return pl.DataFrame({"E": energy, "dE": delta_e, "band": band})
+
+def multi_detector(n_events: int, n_detectors: int = 16, seed: int = 42) -> list[pl.Series]:
+    # one energy series per detector with slightly different gains
+    rng = np.random.default_rng(seed)
+    energy = peaks_on_background(n_events, seed)
+    detector = rng.integers(0, n_detectors, n_events)
+    return [pl.Series(f"Energy_{i}", energy[detector == i] * (1 + 0.002 * (i - n_detectors / 2))) for i in np.arange(n_detectors)]
+
+def band_cut_vertices(band: int = 2) -> list[tuple[float, float]]:
+    # polygon around one of the pid_bands
+    energy = np.linspace(200, 4000, 20)
+    center = (band + 1) * 4e5 / (energy + 100)
+    upper = [(e, c + 60) for e, c in zip(energy, center)]
+    lower = [(e, c - 60) for e, c in zip(energy[::-1], center[::-1])]
+    return upper + lower + [upper[0]]
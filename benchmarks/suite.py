@@ -0,0 +1,263 @@
+# Benchmark suite of the hot paths (binning, plotting, gating, stats callbacks, fitting) on synthetic data.
+# Runs headless (Agg). For every case and data size the best wall time of a few repeats and the peak memory
+# traced by tracemalloc (numpy buffers included, polars/arrow buffers are not) are written to a JSON file.
+#
+#   python benchmarks/suite.py                                   # 1e5, 1e6, 1e7 events, all cases
+#   python benchmarks/suite.py --sizes 1e5 1e8 --cases histo1d histo2d --output before.json
+#   python benchmarks/suite.py --compare before.json            # prints the ratios to a previous run
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import polars as pl
+from generators import peaks_on_background, pid_bands, multi_detector, band_cut_vertices, gamma_lines
+from ACHist.binning import fill_histo1d, fill_histo2d
+from ACHist.cut import Cut2D, CutSet, write_cut_json, reduce_df_with_cut, gate_mask
+from ACHist.histo1d_tools import histo1d, matplotlib_1DHistogram_stats, fit_linear_background, fit_region
+from ACHist.histo2d_tools import histo2d, matplotlib_2DHistogram_stats
+from ACHist.query import HistogramQuery
+from ACHist.batch import HistogramBatch
+from ACHist.peak_search import fit_spectrum
+
+BINS_1D, RANGE_1D = 4096, (0, 4096)
+BINS_2D, RANGE_2D = (1024, 1024), [[0, 4096], [0, 2500]]
+N_WINDOWS = 200 # limit changes per stats callback case
+
+# Each case is (setup, run): setup(size) builds the inputs outside of the measurement, run(inputs) is measured.
+
+def setup_energy(size):
+    return pl.Series("Energy", peaks_on_background(size))
+
+def setup_pid(size):
+    return pid_bands(size)
+
+def setup_cut(size):
+    directory = tempfile.mkdtemp()
+    cut_file = os.path.join(directory, "band.json")
+    write_cut_json(Cut2D("band", band_cut_vertices()), cut_file)
+    return pid_bands(size), cut_file
+
+def run_histo1d(energy):
+    fig, ax = plt.subplots()
+    histo1d(energy, bins=BINS_1D, range=RANGE_1D, subplots=(fig, ax))
+    fig.canvas.draw()
+    plt.close(fig)
+
+def run_histo1d_sources(detectors):
+    fig, ax = plt.subplots()
+    histo1d(detectors, bins=BINS_1D, range=RANGE_1D, subplots=(fig, ax), keep_sources=True)
+    fig.canvas.draw()
+    plt.close(fig)
+
+def run_histo2d(df):
+    fig, ax = plt.subplots()
+    histo2d(df["E"], df["dE"], bins=BINS_2D, range=RANGE_2D, subplots=(fig, ax))
+    fig.canvas.draw()
+    plt.close(fig)
+
+def storage_runner(**options): # histo2d of a 4096x4096 matrix, the size of a gamma-gamma matrix
+    def run(df):
+        fig, ax = plt.subplots()
+        histo2d(df["E"], df["dE"], bins=(4096, 4096), range=RANGE_2D, subplots=(fig, ax), **options)
+        fig.canvas.draw()
+        plt.close(fig)
+    return run
+
+def zoom_windows(low, high, seed=42): # limits of N_WINDOWS random zooms
+    rng = np.random.default_rng(seed)
+    edges = np.sort(rng.uniform(low, high, (N_WINDOWS, 2)), axis=1)
+    return edges
+
+def run_stats_1d(energy):
+    # builds the stats box (exact mode) and redraws it for a series of zooms
+    fig, ax = plt.subplots()
+    data = energy.to_numpy()
+    counts, edges = fill_histo1d(data, bins=BINS_1D, range=RANGE_1D)
+    text_box = matplotlib_1DHistogram_stats(ax, data, BINS_1D, mode="exact", hist_counts=counts, hist_bins=edges)
+    renderer = fig.canvas.get_renderer()
+    for low, high in zoom_windows(*RANGE_1D):
+        ax.set_xlim(low, high)
+        text_box.draw(renderer)
+    plt.close(fig)
+
+def run_stats_2d(df):
+    fig, ax = plt.subplots()
+    hist, x_edges, y_edges = fill_histo2d(df["E"].to_numpy(), df["dE"].to_numpy(), bins=BINS_2D, range=RANGE_2D)
+    text_box = matplotlib_2DHistogram_stats(ax, hist, x_edges, y_edges)
+    renderer = fig.canvas.get_renderer()
+    for (x_low, x_high), (y_low, y_high) in zip(zoom_windows(*RANGE_2D[0]), zoom_windows(*RANGE_2D[1], seed=7)):
+        ax.set_xlim(x_low, x_high)
+        ax.set_ylim(y_low, y_high)
+        text_box.draw(renderer)
+    plt.close(fig)
+
+def run_cut(inputs):
+    df, cut_file = inputs
+    reduce_df_with_cut(df, cut_file, "E", "dE")
+
+def run_histo1d_filtered(inputs): # filter the frame with the cut, then histogram
+    df, cut_file = inputs
+    fig, ax = plt.subplots()
+    histo1d(reduce_df_with_cut(df, cut_file, "E", "dE")["E"], bins=BINS_1D, range=RANGE_1D, subplots=(fig, ax))
+    plt.close(fig)
+
+def run_histo1d_gated(inputs): # the cut is applied during the fill
+    df, cut_file = inputs
+    fig, ax = plt.subplots()
+    histo1d(df["E"], bins=BINS_1D, range=RANGE_1D, subplots=(fig, ax), cuts=(cut_file, df["E"], df["dE"]))
+    plt.close(fig)
+
+def run_histogram_query(inputs): # three histograms of the same frame in one query
+    df, cut_file = inputs
+    query = HistogramQuery(df)
+    query.histo1d("E", "E", bins=BINS_1D, range=RANGE_1D)
+    query.histo1d("E_band", "E", bins=BINS_1D, range=RANGE_1D, cuts=(cut_file, "E", "dE"))
+    query.histo2d("pid", "E", "dE", bins=BINS_2D, range=RANGE_2D, filter=pl.col("band") > 0)
+    query.collect()
+
+def run_histogram_numpy(inputs): # the same histograms with the numpy fill engine
+    df, cut_file = inputs
+    energy, delta_e = df["E"].to_numpy(), df["dE"].to_numpy()
+    fill_histo1d(energy, bins=BINS_1D, range=RANGE_1D)
+    fill_histo1d(energy, bins=BINS_1D, range=RANGE_1D, mask=gate_mask((cut_file, df["E"], df["dE"])))
+    fill_histo2d(energy, delta_e, bins=BINS_2D, range=RANGE_2D, mask=df["band"].to_numpy() > 0)
+
+def run_histogram_batch(inputs): # the same histograms filled in one pass
+    df, cut_file = inputs
+    batch = HistogramBatch()
+    batch.histo1d("E", "E", bins=BINS_1D, range=RANGE_1D)
+    batch.histo1d("E_band", "E", bins=BINS_1D, range=RANGE_1D, cuts=(cut_file, "E", "dE"))
+    batch.histo2d("pid", "E", "dE", bins=BINS_2D, range=RANGE_2D, filter=pl.col("band") > 0)
+    batch.fill(df)
+
+def setup_cut_set(size): # one cut per particle band, all on the same columns
+    cuts = CutSet()
+    for band in np.arange(5):
+        cuts.add(Cut2D(f"band_{band}", band_cut_vertices(band)), "E", "dE")
+    return pid_bands(size), cuts
+
+def run_cut_set(inputs):
+    df, cuts = inputs
+    cuts.with_bitmask(df)
+
+def setup_fit(size):
+    counts, edges = fill_histo1d(peaks_on_background(size), bins=BINS_1D, range=RANGE_1D)
+    centers = (edges[:-1] + edges[1:]) / 2
+    region = (1150, 1360) # the two 60Co lines
+    background_result, _ = fit_linear_background(region, counts, centers)
+    return counts, centers, region, background_result
+
+def fit_runner(backend, objective="chi2"):
+    def run_fit(inputs):
+        counts, centers, region, background_result = inputs
+        fit_region(counts, centers, region, [1173.2, 1332.5], background_result, backend=backend, objective=objective)
+    return run_fit
+
+def setup_spectrum(size): # 200 gamma lines, 8192 bins
+    return fill_histo1d(gamma_lines(size), bins=2 * BINS_1D, range=RANGE_1D)
+
+def run_fit_spectrum(spectrum): # search and fit of every line
+    fit_spectrum(*spectrum, verbose=False)
+
+CASES = {
+    "fill_histo1d": (lambda size: peaks_on_background(size), lambda energy: fill_histo1d(energy, bins=BINS_1D, range=RANGE_1D)),
+    "fill_histo1d_threads": (lambda size: peaks_on_background(size), lambda energy: fill_histo1d(energy, bins=BINS_1D, range=RANGE_1D, workers=-1)),
+    "fill_histo2d": (lambda size: pid_bands(size).select("E", "dE").to_numpy().T.copy(), lambda xy: fill_histo2d(xy[0], xy[1], bins=BINS_2D, range=RANGE_2D)),
+    "histo1d": (setup_energy, run_histo1d),
+    "histo1d_sources": (lambda size: multi_detector(size), run_histo1d_sources),
+    "histo2d": (setup_pid, run_histo2d),
+    "histo2d_4096_compact": (setup_pid, storage_runner(count_dtype="auto")),
+    "histo2d_4096_sparse": (setup_pid, storage_runner(storage="sparse")),
+    "reduce_df_with_cut": (setup_cut, run_cut),
+    "cut_set_bitmask": (setup_cut_set, run_cut_set),
+    "histo1d_filtered": (setup_cut, run_histo1d_filtered),
+    "histo1d_gated": (setup_cut, run_histo1d_gated),
+    "histogram_query": (setup_cut, run_histogram_query),
+    "histogram_numpy": (setup_cut, run_histogram_numpy),
+    "histogram_batch": (setup_cut, run_histogram_batch),
+    "stats_1d_callbacks": (setup_energy, run_stats_1d),
+    "stats_2d_callbacks": (setup_pid, run_stats_2d),
+    "fit_lmfit": (setup_fit, fit_runner("lmfit")),
+    "fit_fast_chi2": (setup_fit, fit_runner("fast", "chi2")),
+    "fit_fast_poisson": (setup_fit, fit_runner("fast", "poisson")),
+    "fit_spectrum": (setup_spectrum, run_fit_spectrum),
+}
+
+def measure(run, inputs, repeat: int):
+    run(inputs) # warm up (lazy imports, caches)
+
+    times = []
+    for _ in np.arange(repeat):
+        start = time.perf_counter()
+        run(inputs)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    run(inputs)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(times), peak_memory
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "polars": pl.__version__,
+        "matplotlib": matplotlib.__version__,
+    }
+
+def compare(results: list, previous_file: str):
+    with open(previous_file) as input_file:
+        previous = {(row["case"], row["size"]): row for row in json.load(input_file)["results"]}
+
+    print(f"\nCompared to {previous_file} (ratio > 1 is slower/larger now)")
+    for row in results:
+        old = previous.get((row["case"], row["size"]))
+        if old is None:
+            continue
+        time_ratio = row["wall_time_s"] / old["wall_time_s"]
+        memory_ratio = row["peak_memory_bytes"] / old["peak_memory_bytes"] if old["peak_memory_bytes"] else float("nan")
+        print(f"{row['case']:22s} {row['size']:>11} time x{time_ratio:6.2f}  memory x{memory_ratio:6.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", nargs="+", type=float, default=[1e5, 1e6, 1e7], help="numbers of events")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="JSON file of a previous run")
+    args = parser.parse_args()
+
+    results = []
+    for case in args.cases:
+        setup, run = CASES[case]
+        for size in [int(size) for size in args.sizes]:
+            inputs = setup(size)
+            wall_time, peak_memory = measure(run, inputs, args.repeat)
+            del inputs
+            results.append({"case": case, "size": size, "wall_time_s": wall_time, "peak_memory_bytes": peak_memory, "repeat": args.repeat})
+            print(f"{case:22s} {size:>11} {wall_time * 1e3:10.1f} ms {peak_memory / 1e6:10.1f} MB")
+
+    with open(args.output, "w") as output_file:
+        json.dump({"metadata": metadata(), "results": results}, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare is not None:
+        compare(results, args.compare)
@@ -0,0 +1,286 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import polars as pl
+from .binning import (FILL_CHUNK_SIZE, MIN_PARALLEL_CHUNK_SIZE, is_uniform, in_range, bin_indices, edge_indices, resolve_workers, as_array)
+from .cut import CutSet
+from .histogram import Histogram1D, Histogram2D
+from .histogram_cache import cache_key, file_identity, binning_identity, cut_identity, source_files
+from .query import histogram_edges, expr_identity, histogram_arrays
+from .stream import iter_batches, DEFAULT_BATCH_SIZE
+from . import profiling
+
+COMBINED_FILL_BINS = 1 << 20 # largest (selection code, bin) table filled at once for a group of histograms on the same axes
+
+# Many histograms (per-detector spectra, PID plots, gated spectra, ...) filled in a single pass over the data,
+# instead of one histo1d/histo2d call per histogram, each reading the columns again. The histograms are declared
+# first, then fill() reads the source batch by batch and fills every histogram from each chunk of events:
+#
+#  - the columns are read and converted once per batch, whatever the number of histograms using them
+#  - all the cuts of all the histograms are evaluated together into one bitmask (CutSet), the gate of a
+#    histogram is then a bitwise test of that column
+#  - the filters (polars expressions) are evaluated once each per batch
+#  - the bin of every event is computed once per column and binning, histograms of the same column and binning
+#    (e.g. an energy spectrum under ten different gates) share it and only differ by the bincount
+#
+# so the time grows with the events and the number of distinct columns/cuts rather than events x histograms. With
+# workers > 1 the chunks are filled on a thread pool. The counts and edges are identical to fill_histo1d/fill_histo2d
+# of the gated data, and the result is a dict of Histogram1D/Histogram2D that histo1d/histo2d plot (and fit) directly.
+#
+#   batch = HistogramBatch()
+#   for detector in range(16):
+#       batch.histo1d(f"energy_{detector}", f"Energy{detector}", bins=4096, range=(0, 4096))
+#   batch.histo1d("energy_protons", "Energy0", bins=4096, range=(0, 4096), cuts=("proton.json", "E", "dE"))
+#   batch.histo2d("pid", "E", "dE", bins=(512, 512), range=[[0, 4096], [0, 2500]], filter=pl.col("Multiplicity") == 1)
+#   histograms = batch.fill("run_*.parquet", workers=-1)
+#   histo1d(histograms["energy_protons"])
+#
+# The histograms can also be declared as a list of dicts with the arguments of histo1d/histo2d:
+#
+#   batch = HistogramBatch([{"name": "energy", "column": "Energy", "bins": 4096, "range": (0, 4096)},
+#                           {"name": "pid", "x_column": "E", "y_column": "dE", "bins": (512, 512), "range": [[0, 4096], [0, 2500]]}])
+
+"""
+Declaration of the histograms of a batch and the single-pass fill. Every histogram is an axis (column and
+edges) for 1D, two axes for 2D, a filter and a gate on the shared cut bitmask.
+"""
+class HistogramBatch:
+    def __init__(self, specs: list[dict] = None):
+        self.histograms = {} # name -> {"kind", "axes", "filter", "filter_key", "cut_mask", "identity"}, an axis is (column, edges, uniform, key)
+        self.cut_set = CutSet()
+        self.cut_bits = {} # (cut file or id of the Cut2D, x column, y column) -> bit in cut_set
+        for spec in specs or []:
+            self.add_spec(spec)
+
+    def __len__(self):
+        return len(self.histograms)
+
+    def __contains__(self, name: str):
+        return name in self.histograms
+
+    def add_spec(self, spec: dict):
+        spec = dict(spec)
+        if "column" in spec:
+            return self.histo1d(**spec)
+        if "x_column" in spec and "y_column" in spec:
+            return self.histo2d(**spec)
+        raise ValueError(f"A histogram spec needs a 'column' (1D) or 'x_column' and 'y_column' (2D), got {sorted(spec)}.")
+
+    def add_cuts(self, cuts) -> int:
+        # adds the cuts (cut, x_column, y_column), the cut a Cut2D or a cut file, to the shared CutSet and returns the mask of their bits
+        if isinstance(cuts, tuple):
+            cuts = [cuts]
+
+        mask = 0
+        for cut, x_column, y_column in cuts or []:
+            key = (cut if isinstance(cut, str) else id(cut), x_column, y_column)
+            if key not in self.cut_bits:
+                name = f"cut_{len(self.cut_bits)}"
+                self.cut_bits[key] = self.cut_set.add_file(cut, x_column, y_column, name=name) if isinstance(cut, str) else self.cut_set.add(cut, x_column, y_column, name=name)
+            mask |= 1 << self.cut_bits[key]
+        return mask
+
+    def add(self, name: str, kind: str, axes: list, filter: pl.Expr, cuts, identity: dict):
+        if name in self.histograms:
+            raise ValueError(f"A histogram named '{name}' is already in the batch.")
+        if filter is not None and not isinstance(filter, pl.Expr):
+            raise TypeError(f"The filter must be a polars expression, got {type(filter).__name__}.")
+
+        axes = [(column, edges, uniform, (column, edges.tobytes())) for column, edges, uniform in axes] # the key identifies the bins shared by histograms
+        self.histograms[name] = {"kind": kind, "axes": axes, "filter": filter, "filter_key": expr_identity(filter), "cut_mask": self.add_cuts(cuts),
+                                 "identity": {**identity, "filter": expr_identity(filter), "cuts": cut_identity(cuts)}}
+        return self
+
+    def histo1d(self, name: str, column: str, bins, range, filter: pl.Expr = None, cuts=None):
+        axis = (column, histogram_edges(bins, range), is_uniform(bins))
+        return self.add(name, "histo1d", [axis], filter, cuts, {"kind": "batch_histo1d", "column": column, **binning_identity(bins, range)})
+
+    def histo2d(self, name: str, x_column: str, y_column: str, bins, range, filter: pl.Expr = None, cuts=None):
+        axes = [(x_column, histogram_edges(bins[0], range[0]), is_uniform(bins[0])), (y_column, histogram_edges(bins[1], range[1]), is_uniform(bins[1]))]
+        return self.add(name, "histo2d", axes, filter, cuts, {"kind": "batch_histo2d", "columns": [x_column, y_column], **binning_identity(bins, range)})
+
+    def selection_atoms(self, name: str) -> list[tuple]: # ("filter", key) and ("cuts", mask) the events of a histogram must pass
+        histogram = self.histograms[name]
+        atoms = [] if histogram["filter"] is None else [("filter", histogram["filter_key"])]
+        return atoms + ([("cuts", histogram["cut_mask"])] if histogram["cut_mask"] else [])
+
+    def columns(self, names: list[str] = None) -> list[str]: # columns read from the source: histogram axes, cut and filter columns
+        names = list(self.histograms) if names is None else names
+        columns = [column for name in names for column, *_ in self.histograms[name]["axes"]]
+        columns += [column for entry in self.cut_set.entries for column in (entry["x_column"], entry["y_column"])]
+        columns += [column for name in names if self.histograms[name]["filter"] is not None for column in self.histograms[name]["filter"].meta.root_names()]
+        return list(dict.fromkeys(columns))
+
+    def cache_keys(self, source) -> dict: # name -> key in a HistogramCache, only for parquet path/glob sources
+        if not isinstance(source, (str, os.PathLike)):
+            raise TypeError("Only the histograms of a parquet path/glob source can be cached, the data of a frame cannot be identified by its files.")
+        identity = file_identity(source)
+        return {name: cache_key(source=identity, **histogram["identity"]) for name, histogram in self.histograms.items()}
+
+    def new_counts(self, name: str) -> np.ndarray:
+        axes = self.histograms[name]["axes"]
+        return np.zeros(np.prod([len(edges) - 1 for _, edges, *_ in axes]), dtype=np.int64)
+
+    def result(self, name: str, counts: np.ndarray):
+        histogram = self.histograms[name]
+        axes = histogram["axes"]
+        if histogram["kind"] == "histo1d":
+            return Histogram1D(counts, axes[0][1], name=axes[0][0])
+        return Histogram2D(counts.reshape(len(axes[0][1]) - 1, len(axes[1][1]) - 1), axes[0][1], axes[1][1], x_name=axes[0][0], y_name=axes[1][0])
+
+    def restore(self, name: str, arrays: dict):
+        histogram = self.histograms[name]
+        if histogram["kind"] == "histo1d":
+            return Histogram1D(arrays["counts"], arrays["edges"], name=histogram["axes"][0][0])
+        return Histogram2D(arrays["counts"], arrays["x_edges"], arrays["y_edges"], x_name=histogram["axes"][0][0], y_name=histogram["axes"][1][0])
+
+    @profiling.profiled("batch.fill")
+    def fill(self, source, workers: int = None, batch_size: int = DEFAULT_BATCH_SIZE, cache=None) -> dict:
+        # source: DataFrame (filled in place, without a copy of the columns), LazyFrame or parquet path/glob (read
+        # batch_size rows at a time). Returns name -> Histogram1D/Histogram2D, in the order the histograms were declared
+        histograms, keys = {}, {}
+        if cache is not None:
+            keys = self.cache_keys(source)
+            for name, key in keys.items():
+                arrays = cache.get(key)
+                if arrays is not None:
+                    histograms[name] = self.restore(name, arrays)
+
+        names = [name for name in self.histograms if name not in histograms]
+        if names:
+            counts = {name: self.new_counts(name) for name in names}
+            batches = [source] if isinstance(source, pl.DataFrame) else iter_batches(source, self.columns(names), batch_size=batch_size)
+            for batch in batches:
+                self.fill_batch(batch, names, counts, workers=workers)
+
+            for name in names:
+                histograms[name] = self.result(name, counts[name])
+                if cache is not None:
+                    cache.put(keys[name], histogram_arrays(histograms[name]), sources=source_files(source), description=f"batch {name}")
+
+        return {name: histograms[name] for name in self.histograms}
+
+    def fill_batch(self, batch: pl.DataFrame, names: list[str], counts: dict, workers: int = None):
+        missing = set(self.columns(names)) - set(batch.columns)
+        if missing:
+            raise ValueError(f"{sorted(missing)} do not exist in the DataFrame columns.")
+
+        columns = {column: as_array(batch[column]) for column in self.columns(names)}
+
+        # the distinct filters in one select for the batch (evaluated in parallel by polars), nulls are outside the filter
+        filter_exprs = {self.histograms[name]["filter_key"]: self.histograms[name]["filter"] for name in names if self.histograms[name]["filter"] is not None}
+        filter_frame = batch.select([expr.fill_null(False).alias(f"filter_{index}") for index, expr in enumerate(filter_exprs.values())]) if filter_exprs else None
+        filters = {key: filter_frame.to_series(index).to_numpy() for index, key in enumerate(filter_exprs)}
+
+        has_cuts = any(self.histograms[name]["cut_mask"] for name in names)
+        if has_cuts:
+            self.cut_set.bitmask({column: columns[column][:0] for column in columns}) # builds the lookup grids before the workers share them
+
+        # Histograms on the same axes are filled together. Each event gets a code with one bit per selection (filter or
+        # set of cuts) used by the group, and a single bincount over (code, bin) gives the counts of every combination
+        # of selections, from which each histogram sums the codes passing its own selection. The events are then
+        # binned once per group instead of once per histogram. Groups whose table would exceed COMBINED_FILL_BINS
+        # (many selections on a large binning) fill each histogram with its own mask
+        plans = [] # (names, selections, name -> codes passing its selection, or None to fill the histograms one by one)
+        groups = {}
+        for name in names:
+            groups.setdefault(tuple(axis[3] for axis in self.histograms[name]["axes"]), []).append(name)
+        for group in groups.values():
+            atoms = list(dict.fromkeys(atom for name in group for atom in self.selection_atoms(name)))
+            rows = None
+            if len(group) > 1 and len(counts[group[0]]) << len(atoms) <= COMBINED_FILL_BINS:
+                codes = np.arange(1 << len(atoms))
+                required = {name: sum(1 << atoms.index(atom) for atom in self.selection_atoms(name)) for name in group}
+                rows = {name: codes[(codes & required[name]) == required[name]] for name in group}
+            plans.append((group, atoms, rows))
+
+        # the binned columns of a chunk are released after the last group using them
+        last_use = {}
+        for index, (group, _, _) in enumerate(plans):
+            for column, _, _, key in self.histograms[group[0]]["axes"]:
+                last_use[key] = last_use[column] = index
+
+        def fill_chunk(start, stop):
+            chunk_columns = {} # column -> float64 values of the chunk
+            chunk_indices = {} # axis key -> bin of every event, -1 outside the range
+            chunk_valid = {} # axis key -> events inside the range
+
+            def values(column):
+                if column not in chunk_columns:
+                    chunk_columns[column] = np.asarray(columns[column][start:stop], dtype=np.float64)
+                return chunk_columns[column]
+
+            def indices(column, edges, uniform, key):
+                if key not in chunk_indices:
+                    chunk = values(column)
+                    inside = in_range(chunk, (edges[0], edges[-1]))
+                    axis_indices = np.full(len(chunk), -1, dtype=np.intp)
+                    axis_indices[inside] = bin_indices(chunk[inside], len(edges) - 1, (edges[0], edges[-1]), edges) if uniform else edge_indices(chunk[inside], edges)
+                    chunk_indices[key] = axis_indices
+                    chunk_valid[key] = inside
+                return chunk_indices[key]
+
+            bitmask = self.cut_set.bitmask({column: columns[column][start:stop] for column in columns}) if has_cuts else None
+
+            def selection(atom): # events passing a filter ("filter", key) or inside a set of cuts ("cuts", mask)
+                kind, value = atom
+                return filters[value][start:stop] if kind == "filter" else (bitmask & value) == value
+
+            partial_counts = {}
+            for index, (group, atoms, rows) in enumerate(plans):
+                axes = self.histograms[group[0]]["axes"]
+                axis_indices = [indices(*axis) for axis in axes]
+                valid = chunk_valid[axes[0][3]]
+                flat = axis_indices[0]
+                for indices_of_axis, (_, edges, _, key) in zip(axis_indices[1:], axes[1:]):
+                    valid = valid & chunk_valid[key]
+                    flat = flat * (len(edges) - 1) + indices_of_axis
+                n_bins = len(counts[group[0]])
+
+                for column, _, _, key in axes:
+                    if last_use[key] == index:
+                        chunk_indices.pop(key, None)
+                        chunk_valid.pop(key, None)
+                    if last_use[column] == index:
+                        chunk_columns.pop(column, None)
+
+                if rows is not None:
+                    # one bincount of (selection code, bin), every histogram sums the rows of the codes passing its selection
+                    code = np.zeros(len(valid), dtype=np.intp)
+                    for bit, atom in enumerate(atoms):
+                        code |= selection(atom).astype(np.intp) << bit
+                    table = np.bincount(code[valid] * n_bins + flat[valid], minlength=n_bins << len(atoms)).reshape(1 << len(atoms), n_bins)
+                    for name in group:
+                        partial_counts[name] = table[rows[name]].sum(axis=0)
+                    continue
+
+                for name in group:
+                    keep = valid.copy()
+                    for atom in self.selection_atoms(name): keep &= selection(atom)
+                    partial_counts[name] = np.bincount(flat[keep], minlength=n_bins)
+            return partial_counts
+
+        fill_events(fill_chunk, counts, batch.height, workers=workers)
+
+def fill_events(fill_chunk, counts: dict, length: int, workers=None):
+    # fill_chunk(start, stop) returns name -> counts of the events [start, stop), they are summed into counts.
+    # The chunks are filled on a thread pool with workers > 1, the sums do not depend on the order of completion
+    workers = resolve_workers(workers)
+    chunk_size = FILL_CHUNK_SIZE if workers == 1 else int(np.clip(-(-length // workers), MIN_PARALLEL_CHUNK_SIZE, FILL_CHUNK_SIZE))
+    starts = np.arange(0, length, chunk_size)
+    lock = threading.Lock()
+
+    def fill_and_add(start):
+        partial_counts = fill_chunk(start, start + chunk_size)
+        with lock:
+            for name, partial in partial_counts.items():
+                np.add(counts[name], partial, out=counts[name])
+
+    if workers == 1 or len(starts) <= 1:
+        for start in starts:
+            fill_and_add(start)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(fill_and_add, starts)) # list() re-raises the exceptions of the workers
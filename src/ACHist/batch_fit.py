@@ -0,0 +1,134 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import polars as pl
+from colorama import Fore, Style
+from .histogram import Histogram1D
+from .binning import resolve_workers
+from .histo1d_tools import fit_linear_background, fit_region
+
+# Non-interactive Gaussian fitting of many regions (one per detector strip, run, ...) with the same
+# background/initial parameter/fit steps as the 'f' key of interactive_1DHistogram_fitting.
+#
+# A job is a tuple (histogram, region, peaks) or (histogram, region, peaks, background) where
+#   histogram:  a Histogram1D or a (counts, bin edges) tuple
+#   region:     (low, high) of the fit region
+#   peaks:      peak position guesses, an empty list assumes one peak at the maximum
+#   background: positions of the background markers, None estimates the background at the region
+#
+# backend/objective select the fit engine as in fit_region ('lmfit', or 'fast' with a 'chi2' or 'poisson' objective).
+# The jobs are fitted on a process pool and the results are returned as a polars DataFrame with one row per peak.
+
+FIT_RESULT_SCHEMA = {
+    "job": pl.Int64,
+    "name": pl.Utf8,
+    "peak": pl.Int64,
+    "center": pl.Float64,
+    "center_uncertainty": pl.Float64,
+    "area": pl.Float64,
+    "area_uncertainty": pl.Float64,
+    "fwhm": pl.Float64,
+    "fwhm_uncertainty": pl.Float64,
+    "sigma": pl.Float64,
+    "height": pl.Float64,
+    "background_slope": pl.Float64,
+    "background_intercept": pl.Float64,
+    "redchi": pl.Float64,
+    "success": pl.Boolean,
+    "error": pl.Utf8,
+}
+
+def make_fit_job(index: int, job) -> tuple:
+    # normalizes a job and keeps only the bins needed by the fit, so little data is sent to the workers
+    histogram, region, peaks = job[0], job[1], job[2]
+    background = job[3] if len(job) > 3 else None
+
+    if isinstance(histogram, Histogram1D):
+        name, hist_counts, hist_bins = histogram.name, histogram.counts, histogram.edges
+    else:
+        name, (hist_counts, hist_bins) = f"job_{index}", histogram
+
+    region = sorted(region)
+    positions = list(region) + (list(background) if background is not None else [])
+
+    # one extra bin on each side so the bins closest to the markers are included
+    start = int(np.clip(np.searchsorted(hist_bins, min(positions), side='right') - 2, 0, len(hist_counts) - 1))
+    stop = int(np.clip(np.searchsorted(hist_bins, max(positions), side='left') + 1, start + 2, len(hist_counts)))
+
+    return (index, name, np.asarray(hist_counts[start:stop], dtype=np.float64), np.asarray(hist_bins[start:stop + 1]),
+            region, sorted(peaks), None if background is None else sorted(background))
+
+def fit_job(job: tuple) -> list[dict]:
+    index, name, hist_counts, hist_bins, region, peaks, background, backend, objective = job
+
+    hist_bin_centers = (hist_bins[:-1] + hist_bins[1:]) / 2
+    hist_bin_width = hist_bins[1] - hist_bins[0]
+
+    # same peak selection as the interactive fit: only the peaks between the region markers, a peak on a marker is kept
+    # (peak_regions clips regions at the ends of the spectrum, so a found peak can sit exactly on the region edge)
+    peak_positions = [peak for peak in peaks if region[0] <= peak <= region[1]]
+
+    try:
+        background_result, _ = fit_linear_background(background if background is not None else region, hist_counts, hist_bin_centers)
+        result, _ = fit_region(hist_counts=hist_counts, hist_bin_centers=hist_bin_centers, region=region,
+                               peak_positions=peak_positions, background_result=background_result, backend=backend, objective=objective)
+        if backend == "fast": # the background was fitted together with the Gaussians
+            background_result = result.background
+    except Exception as error:
+        return [dict(job=index, name=name, success=False, error=f"{type(error).__name__}: {error}")]
+
+    rows = []
+    for i in np.arange(len(peak_positions)):
+        prefix = f"g{i}_"
+        params = result.params
+
+        def uncertainty(param, scale=1):
+            return None if params[param].stderr is None else params[param].stderr / scale
+
+        rows.append(dict(
+            job=index,
+            name=name,
+            peak=int(i),
+            center=params[f"{prefix}center"].value,
+            center_uncertainty=uncertainty(f"{prefix}center"),
+            area=params[f"{prefix}amplitude"].value / hist_bin_width,
+            area_uncertainty=uncertainty(f"{prefix}amplitude", hist_bin_width),
+            fwhm=abs(params[f"{prefix}fwhm"].value),
+            fwhm_uncertainty=uncertainty(f"{prefix}fwhm"),
+            sigma=params[f"{prefix}sigma"].value,
+            height=params[f"{prefix}height"].value,
+            background_slope=background_result.params["slope"].value,
+            background_intercept=background_result.params["intercept"].value,
+            redchi=result.redchi,
+            success=bool(result.success),
+            error=None,
+        ))
+
+    return rows
+
+def fit_peaks_batch(jobs: list, workers: int = None, verbose: bool = True, backend: str = "lmfit", objective: str = "chi2") -> pl.DataFrame:
+    # workers: None fits serially, -1 uses one process per cpu
+
+    fit_jobs = [make_fit_job(index, job) + (backend, objective) for index, job in enumerate(jobs)]
+    workers = resolve_workers(workers)
+
+    start_time = time.perf_counter()
+
+    if workers == 1 or len(fit_jobs) <= 1:
+        job_rows = [fit_job(job) for job in fit_jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            job_rows = list(pool.map(fit_job, fit_jobs, chunksize=max(1, len(fit_jobs) // (workers * 4))))
+
+    elapsed = time.perf_counter() - start_time
+
+    results = pl.DataFrame([row for rows in job_rows for row in rows], schema=FIT_RESULT_SCHEMA)
+
+    if verbose:
+        failed = results.filter(~pl.col("success"))["job"].n_unique()
+        fits_per_second = len(fit_jobs) / elapsed if elapsed > 0 else float("inf")
+        print(f"{Fore.GREEN}{Style.BRIGHT}Fitted {len(fit_jobs)} regions ({results.filter(pl.col('success')).height} peaks) in {elapsed:.2f} s: {fits_per_second:.1f} fits/s{Style.RESET_ALL}")
+        if failed:
+            print(f"{Fore.RED}{Style.BRIGHT}{failed} fits failed, see the 'error' column{Style.RESET_ALL}")
+
+    return results
@@ -0,0 +1,318 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Histogram fill engine. Uniform bins are filled with integer index arithmetic and np.bincount instead of
+# a search over the bin edges. The bin assignment follows np.histogram exactly (values on an inner edge go
+# to the upper bin, the last edge is inclusive, values outside the range and NaNs are dropped) so the
+# counts are identical to np.histogram/np.histogram2d. Non-uniform bins (arrays of edges) fall back to numpy.
+
+#
+# A serial 1D fill is left to np.histogram, which already bins uniform edges arithmetically and is faster than
+# the chunked fill below. 2D fills, and 1D fills with workers > 1, bin the events in chunks. With workers > 1
+# the chunks are filled on a thread pool (numpy releases the GIL in the arithmetic and comparisons that dominate
+# the fill) and the partial counts are added to a shared integer array, so the result is identical to the serial
+# fill whatever the order of completion. Whether the threads pay off depends on the machine, compare the
+# fill_histo1d and fill_histo1d_threads cases of benchmarks/suite.py.
+#
+# A boolean mask (e.g. the events inside a set of cuts) is applied chunk by chunk together with the range
+# check, so a gated histogram is filled without making a filtered copy of the data.
+
+FILL_CHUNK_SIZE = 1 << 22 # number of events binned at once, bounds the size of the temporary index arrays
+MIN_PARALLEL_CHUNK_SIZE = 1 << 16 # smallest chunk handed to a worker
+
+def is_uniform(bins) -> bool:
+    return np.ndim(bins) == 0
+
+def bin_edges(bins: int, range) -> np.ndarray:
+    return np.linspace(range[0], range[1], bins + 1)
+
+def in_range(data: np.ndarray, range) -> np.ndarray: # mask of the values inside the (inclusive) range
+    return (data >= range[0]) & (data <= range[1])
+
+def bin_indices(values: np.ndarray, bins: int, range, edges: np.ndarray) -> np.ndarray:
+    # bin index of every value, the values must already be inside the range
+    first_edge, last_edge = float(range[0]), float(range[1])
+
+    indices = ((values - first_edge) / (last_edge - first_edge) * bins).astype(np.intp)
+    indices[indices == bins] -= 1
+
+    # correct the rounding of the arithmetic against the actual edges, as np.histogram does
+    indices[values < edges[indices]] -= 1
+    increment = (values >= edges[indices + 1]) & (indices != bins - 1)
+    indices[increment] += 1
+
+    return indices
+
+def resolve_workers(workers) -> int: # None -> serial, negative -> one worker per cpu
+    if workers is None:
+        return 1
+    if workers < 0:
+        return os.cpu_count() or 1
+    return max(int(workers), 1)
+
+def fill_chunks(counts: np.ndarray, fill_chunk, length: int, workers=None) -> np.ndarray:
+    # fill_chunk(start, stop) returns the counts of the events [start, stop), they are summed into counts
+    workers = resolve_workers(workers)
+
+    if workers == 1:
+        chunk_size = FILL_CHUNK_SIZE
+    else:
+        chunk_size = int(np.clip(-(-length // workers), MIN_PARALLEL_CHUNK_SIZE, FILL_CHUNK_SIZE))
+
+    starts = np.arange(0, length, chunk_size)
+
+    if workers == 1 or len(starts) <= 1:
+        for start in starts:
+            counts += fill_chunk(start, start + chunk_size)
+        return counts
+
+    lock = threading.Lock()
+
+    def fill_and_add(start):
+        partial_counts = fill_chunk(start, start + chunk_size)
+        with lock:
+            np.add(counts, partial_counts, out=counts)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(fill_and_add, starts)) # list() re-raises the exceptions of the workers
+
+    return counts
+
+def check_mask(mask, length: int):
+    if mask is not None and len(mask) != length:
+        raise ValueError(f"The mask must have one entry per event ({len(mask)} != {length}).")
+
+def data_range(sources: list, masks: list = None) -> tuple:
+    # range np.histogram uses when none is given: min and max of the (masked) values, widened by 0.5 if they are equal
+    if masks is None: masks = [None] * len(sources)
+    values = [np.asarray(data) if mask is None else np.asarray(data)[mask] for data, mask in zip(sources, masks)]
+    values = [data for data in values if len(data) > 0]
+    if not values:
+        return (0.0, 1.0)
+
+    first_edge, last_edge = float(min(data.min() for data in values)), float(max(data.max() for data in values))
+    if not (np.isfinite(first_edge) and np.isfinite(last_edge)):
+        raise ValueError(f"autodetected range of [{first_edge}, {last_edge}] is not finite")
+    if first_edge == last_edge:
+        first_edge, last_edge = first_edge - 0.5, last_edge + 0.5
+    return (first_edge, last_edge)
+
+def fill_histo1d(data, bins, range, workers=None, mask=None):
+
+    check_mask(mask, len(data))
+
+    if not is_uniform(bins):
+        return np.histogram(np.asarray(data) if mask is None else np.asarray(data)[mask], bins=bins, range=range)
+
+    if range is None:
+        range = data_range([data], [mask])
+
+    if resolve_workers(workers) == 1:
+        if mask is None:
+            return np.histogram(np.asarray(data), bins=int(bins), range=range)
+
+        def fill_chunk(start, stop): # gated chunk by chunk, so no filtered copy of the whole column is made
+            return np.histogram(np.asarray(data[start:stop])[mask[start:stop]], bins=int(bins), range=range)[0]
+    else:
+        def fill_chunk(start, stop):
+            chunk = np.asarray(data[start:stop], dtype=np.float64)
+            keep = in_range(chunk, range)
+            if mask is not None: keep &= mask[start:stop]
+            values = chunk[keep]
+            return np.bincount(bin_indices(values, bins, range, edges), minlength=bins)
+
+    edges = bin_edges(bins, range)
+    counts = fill_chunks(np.zeros(bins, dtype=np.int64), fill_chunk, len(data), workers=workers)
+
+    return counts, edges
+
+def fill_histo2d(x_data, y_data, bins, range, workers=None, mask=None):
+
+    if len(x_data) != len(y_data):
+        raise ValueError(f"x and y must have the same length ({len(x_data)} != {len(y_data)}).")
+    check_mask(mask, len(x_data))
+
+    if not (is_uniform(bins[0]) and is_uniform(bins[1])):
+        x_data, y_data = np.asarray(x_data), np.asarray(y_data)
+        if mask is not None: x_data, y_data = x_data[mask], y_data[mask]
+        hist, x_edges, y_edges = np.histogram2d(x_data, y_data, bins=bins, range=range)
+        return hist.astype(np.int64), x_edges, y_edges
+
+    x_bins, y_bins = int(bins[0]), int(bins[1])
+    x_edges = bin_edges(x_bins, range[0])
+    y_edges = bin_edges(y_bins, range[1])
+
+    def fill_chunk(start, stop):
+        x_chunk = np.asarray(x_data[start:stop], dtype=np.float64)
+        y_chunk = np.asarray(y_data[start:stop], dtype=np.float64)
+
+        keep = in_range(x_chunk, range[0]) & in_range(y_chunk, range[1])
+        if mask is not None: keep &= mask[start:stop]
+        x_indices = bin_indices(x_chunk[keep], x_bins, range[0], x_edges)
+        y_indices = bin_indices(y_chunk[keep], y_bins, range[1], y_edges)
+
+        return np.bincount(x_indices * y_bins + y_indices, minlength=x_bins * y_bins)
+
+    counts = fill_chunks(np.zeros(x_bins * y_bins, dtype=np.int64), fill_chunk, len(x_data), workers=workers)
+
+    return counts.reshape(x_bins, y_bins), x_edges, y_edges
+
+# Compact 2D counts. np.histogram2d returns float64 and the fill above int64, 8 bytes per bin even though most
+# matrices fit in 16 or 32 bits and are mostly empty. fill_histo2d_compact keeps the counts in the smallest
+# unsigned integer dtype that holds them: it starts from uint8 (or the given dtype) and the matrix is promoted
+# to a wider dtype before a bin would overflow. fill_histo2d_sparse keeps only the non-empty bins, as sorted
+# flat bin indices (x bin * y bins + y bin) and their counts. Both take lists of sources and masks like
+# fill_histo2d_sources, and every chunk is reduced to (bin, count) pairs, so no chunk needs an int64 array
+# over all the bins. The counts are identical to fill_histo2d.
+
+COUNT_DTYPES = (np.uint8, np.uint16, np.uint32, np.uint64)
+
+def count_dtype(max_count: int) -> np.dtype: # smallest unsigned integer dtype holding max_count
+    for dtype in COUNT_DTYPES:
+        if max_count <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise OverflowError(f"{max_count} counts do not fit in 64 bits.")
+
+def add_counts(counts: np.ndarray, indices: np.ndarray, values: np.ndarray) -> np.ndarray:
+    # counts[indices] += values for unique indices, returns counts (a promoted copy when a bin would overflow)
+    if len(indices) == 0:
+        return counts
+    totals = counts[indices].astype(np.uint64) + values.astype(np.uint64)
+    largest = int(totals.max())
+    if largest > np.iinfo(counts.dtype).max:
+        counts = counts.astype(count_dtype(largest))
+    counts[indices] = totals
+    return counts
+
+def edge_indices(values: np.ndarray, edges: np.ndarray) -> np.ndarray: # bin index for arrays of edges, values inside the range
+    return np.minimum(np.searchsorted(edges, values, side='right') - 1, len(edges) - 2)
+
+def chunk_bin_counts(flat_indices: np.ndarray, n_bins: int):
+    # sorted unique bins of a chunk and their counts, a sort (no array over all the bins) for chunks with fewer events than bins
+    if len(flat_indices) < n_bins:
+        return np.unique(flat_indices, return_counts=True)
+    counts = np.bincount(flat_indices, minlength=n_bins)
+    nonzero = np.flatnonzero(counts)
+    return nonzero, counts[nonzero]
+
+def histo2d_edges(bins, range):
+    x_edges = bin_edges(int(bins[0]), range[0]) if is_uniform(bins[0]) else np.asarray(bins[0], dtype=np.float64)
+    y_edges = bin_edges(int(bins[1]), range[1]) if is_uniform(bins[1]) else np.asarray(bins[1], dtype=np.float64)
+    return x_edges, y_edges
+
+def iter_histo2d_bin_counts(x_sources: list, y_sources: list, bins, range, workers=None, masks: list = None):
+    # yields the (bins, counts) pairs of every chunk of every source, the chunks are binned on a thread pool with workers > 1
+    if len(x_sources) != len(y_sources):
+        raise ValueError(f"Got {len(x_sources)} x sources for {len(y_sources)} y sources.")
+    if masks is None: masks = [None] * len(x_sources)
+
+    x_edges, y_edges = histo2d_edges(bins, range)
+    x_range, y_range = (x_edges[0], x_edges[-1]), (y_edges[0], y_edges[-1])
+    x_bins, y_bins = len(x_edges) - 1, len(y_edges) - 1
+
+    def axis_indices(values, axis_bins, axis_range, edges):
+        return bin_indices(values, axis_bins, axis_range, edges) if is_uniform(axis_bins) else edge_indices(values, edges)
+
+    workers = resolve_workers(workers)
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    try:
+        for x_data, y_data, mask in zip(x_sources, y_sources, masks):
+            x_data, y_data = as_array(x_data), as_array(y_data)
+            if len(x_data) != len(y_data):
+                raise ValueError(f"x and y must have the same length ({len(x_data)} != {len(y_data)}).")
+            check_mask(mask, len(x_data))
+
+            def fill_chunk(start):
+                x_chunk = np.asarray(x_data[start:start + FILL_CHUNK_SIZE], dtype=np.float64)
+                y_chunk = np.asarray(y_data[start:start + FILL_CHUNK_SIZE], dtype=np.float64)
+
+                keep = in_range(x_chunk, x_range) & in_range(y_chunk, y_range)
+                if mask is not None: keep &= mask[start:start + FILL_CHUNK_SIZE]
+                x_indices = axis_indices(x_chunk[keep], bins[0], x_range, x_edges)
+                y_indices = axis_indices(y_chunk[keep], bins[1], y_range, y_edges)
+
+                return chunk_bin_counts(x_indices * y_bins + y_indices, x_bins * y_bins)
+
+            starts = np.arange(0, len(x_data), FILL_CHUNK_SIZE)
+            if pool is None:
+                for start in starts:
+                    yield fill_chunk(start)
+            else:
+                for first in np.arange(0, len(starts), 2 * workers): # a few chunks ahead, not all the results at once
+                    yield from pool.map(fill_chunk, starts[first:first + 2 * workers])
+    finally:
+        if pool is not None: pool.shutdown()
+
+def fill_histo2d_compact(x_sources: list, y_sources: list, bins, range, workers=None, masks: list = None, dtype=np.uint8):
+
+    x_edges, y_edges = histo2d_edges(bins, range)
+    counts = np.zeros((len(x_edges) - 1) * (len(y_edges) - 1), dtype=dtype)
+
+    for indices, values in iter_histo2d_bin_counts(x_sources, y_sources, bins, range, workers=workers, masks=masks):
+        counts = add_counts(counts, indices, values)
+
+    return counts.reshape(len(x_edges) - 1, len(y_edges) - 1), x_edges, y_edges
+
+def merge_bin_counts(indices: np.ndarray, counts: np.ndarray, new_indices: np.ndarray, new_counts: np.ndarray):
+    # sum of two sorted (bins, counts) lists
+    if len(indices) == 0:
+        return new_indices, new_counts.astype(np.int64)
+
+    positions = np.searchsorted(indices, new_indices)
+    existing = positions < len(indices)
+    existing[existing] = indices[positions[existing]] == new_indices[existing]
+
+    counts[positions[existing]] += new_counts[existing]
+    return np.insert(indices, positions[~existing], new_indices[~existing]), np.insert(counts, positions[~existing], new_counts[~existing])
+
+def fill_histo2d_sparse(x_sources: list, y_sources: list, bins, range, workers=None, masks: list = None):
+
+    x_edges, y_edges = histo2d_edges(bins, range)
+    indices, counts = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    for new_indices, new_counts in iter_histo2d_bin_counts(x_sources, y_sources, bins, range, workers=workers, masks=masks):
+        indices, counts = merge_bin_counts(indices, counts, new_indices, new_counts)
+
+    return indices, counts, x_edges, y_edges
+
+# Several sources (e.g. one series per detector, each with its own filter) are accumulated into the same
+# counts one after the other, each read through a zero-copy numpy view where possible. Nothing is
+# concatenated, so the memory needed on top of the data scales with the number of bins. With keep_sources
+# the counts of every source are returned as well. masks holds an optional boolean mask per source.
+
+def as_array(data) -> np.ndarray: # numpy view of a polars series (copied only when it has nulls) or array
+    return data.to_numpy() if hasattr(data, "to_numpy") else np.asarray(data)
+
+def fill_histo1d_sources(sources: list, bins, range, workers=None, keep_sources: bool = False, masks: list = None):
+
+    if masks is None: masks = [None] * len(sources)
+    if range is None and is_uniform(bins): # one range for all sources, as np.histogram of the concatenated data
+        range = data_range(sources, masks)
+    counts, edges = fill_histo1d(np.empty(0), bins, range)
+    source_counts = []
+
+    for data, mask in zip(sources, masks):
+        data_counts, _ = fill_histo1d(as_array(data), bins, range, workers=workers, mask=mask)
+        counts += data_counts
+        if keep_sources: source_counts.append(data_counts)
+
+    return counts, edges, source_counts
+
+def fill_histo2d_sources(x_sources: list, y_sources: list, bins, range, workers=None, keep_sources: bool = False, masks: list = None):
+
+    if len(x_sources) != len(y_sources):
+        raise ValueError(f"Got {len(x_sources)} x sources for {len(y_sources)} y sources.")
+
+    if masks is None: masks = [None] * len(x_sources)
+    counts, x_edges, y_edges = fill_histo2d(np.empty(0), np.empty(0), bins, range)
+    source_counts = []
+
+    for x_data, y_data, mask in zip(x_sources, y_sources, masks):
+        data_counts, _, _ = fill_histo2d(as_array(x_data), as_array(y_data), bins, range, workers=workers, mask=mask)
+        counts += data_counts
+        if keep_sources: source_counts.append(data_counts)
+
+    return counts, x_edges, y_edges, source_counts
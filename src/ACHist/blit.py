@@ -0,0 +1,62 @@
+import weakref
+from . import profiling
+
+# Blitting for the interactive overlays (markers, fit and background lines, projection lines, stats boxes).
+# These artists are animated: a full draw renders the static histogram, the draw_event handler saves it as
+# the background and draws the overlays on top. Adding, moving or removing an overlay then restores the saved
+# background and redraws only the overlays instead of re-rasterizing a 65k channel step line or a 2k x 2k image.
+# Canvases that cannot blit fall back to draw_idle.
+
+blit_managers = weakref.WeakKeyDictionary() # one manager per figure
+
+class BlitManager:
+    def __init__(self, figure):
+        self.figure = figure
+        self.artists = []
+        self.background = None
+        figure.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def add_artist(self, artist):
+        artist.set_animated(True)
+        if artist not in self.artists:
+            self.artists.append(artist)
+        return artist
+
+    def visible_artists(self): # drops the artists that were removed from the figure
+        self.artists = [artist for artist in self.artists if artist.figure is not None]
+        return self.artists
+
+    def on_draw(self, event):
+        if event is not None and getattr(event.canvas, "_is_saving", False):
+            # savefig: the overlays are part of the figure, but the print renderer is not a background for blitting
+            for artist in self.visible_artists():
+                artist.draw(event.renderer)
+            return
+
+        canvas = self.figure.canvas
+        self.background = canvas.copy_from_bbox(self.figure.bbox) if canvas.supports_blit else None
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in self.visible_artists():
+            self.figure.draw_artist(artist)
+
+    @profiling.profiled("render.blit")
+    def update(self): # shows the current overlays
+        canvas = self.figure.canvas
+        if self.background is None or not canvas.supports_blit:
+            canvas.draw_idle()
+            return
+
+        canvas.restore_region(self.background)
+        self.draw_artists()
+        canvas.blit(self.figure.bbox)
+        canvas.flush_events()
+
+def blit_manager(figure) -> BlitManager:
+    if figure not in blit_managers:
+        blit_managers[figure] = BlitManager(figure)
+    return blit_managers[figure]
+
+def animated(artist): # registers an overlay artist with the blit manager of its figure
+    return blit_manager(artist.figure).add_artist(artist)
@@ -3,9 +3,14 @@ from matplotlib.path import Path
 import numpy as np
 import json
 import os
+from .binning import as_array
+from . import profiling
 
 # CutHandler and Cut2D classes were create by Gordon McCann
 
+GATE_CHUNK_SIZE = 1 << 20 # number of events evaluated at once by the vectorized gating kernel
+GATE_GRID_SIZE = 512 # cells per axis of the lookup grid used by CutSet
+
 """ 
 Handler to recieve vertices from a matplotlib selector (i.e. PolygonSelector).
 Typically will be used interactively, most likely via cmd line interpreter. The onselect
@@ -20,6 +25,12 @@ class CutHandler:
         cut_default_name = f"cut_{len(self.cuts)}"
         self.cuts[cut_default_name] = Cut2D(cut_default_name, vertices)
 
+    def cut_set(self, x_column: str, y_column: str) -> "CutSet": # all the cuts drawn so far, on the same pair of columns
+        cuts = CutSet()
+        for name, cut in self.cuts.items():
+            cuts.add(cut, x_column, y_column, name=name)
+        return cuts
+
 """
 Implementation of 2D cuts as used in many types of graphical analyses with matplotlib
 Path objects. Takes in a name (to identify the cut) and a list of points. The Path
@@ -41,6 +52,92 @@ class Cut2D:
     def is_cols_inside(self, columns: pl.Series) -> pl.Series:
         return pl.Series(values=self.path.contains_points(columns.to_list()))
 
+    @profiling.profiled("cut.is_xy_inside")
+    def is_xy_inside(self, x, y) -> np.ndarray:
+        # Vectorized equivalent of path.contains_points for two columns (numpy arrays or polars series).
+        # The columns are read as numpy buffers, events outside the bounding box of the polygon are
+        # rejected first and the remaining ones go through the crossing test used by matplotlib.
+        if isinstance(x, pl.Series): x = x.to_numpy()
+        if isinstance(y, pl.Series): y = y.to_numpy()
+        
+        if len(x) != len(y):
+            raise ValueError(f"x and y must have the same length ({len(x)} != {len(y)}).")
+
+        inside = np.zeros(len(x), dtype=bool)
+        if not self.get_polygons():
+            return inside
+
+        for start in range(0, len(x), GATE_CHUNK_SIZE):
+            # matplotlib tests the points in double precision
+            x_chunk = np.asarray(x[start:start + GATE_CHUNK_SIZE], dtype=np.float64)
+            y_chunk = np.asarray(y[start:start + GATE_CHUNK_SIZE], dtype=np.float64)
+            inside[start:start + len(x_chunk)] = self.is_chunk_inside(x_chunk, y_chunk)
+
+        return inside
+
+    def is_chunk_inside(self, x_chunk: np.ndarray, y_chunk: np.ndarray) -> np.ndarray:
+        # gating kernel on float64 buffers: bounding box rejection, then the crossing test on the remaining events
+        inside = np.zeros(len(x_chunk), dtype=bool)
+        polygons = self.get_polygons()
+        if not polygons:
+            return inside
+
+        x_min, y_min, x_max, y_max = self.get_bounds()
+        in_box = np.flatnonzero((x_chunk >= x_min) & (x_chunk <= x_max) & (y_chunk >= y_min) & (y_chunk <= y_max))
+        if len(in_box) == 0:
+            return inside
+
+        x_box = x_chunk[in_box]
+        y_box = y_chunk[in_box]
+
+        box_inside = np.zeros(len(in_box), dtype=bool)
+        for polygon in polygons:
+            box_inside |= points_inside_polygon(x_box, y_box, polygon)
+
+        inside[in_box] = box_inside
+        return inside
+
+    def get_bounds(self) -> tuple[float, float, float, float]: # (x_min, y_min, x_max, y_max) of the polygons
+        polygons = self.get_polygons()
+        x_min, y_min = np.min([polygon.min(axis=0) for polygon in polygons], axis=0)
+        x_max, y_max = np.max([polygon.max(axis=0) for polygon in polygons], axis=0)
+        return x_min, y_min, x_max, y_max
+
+    def is_expr_inside(self, x_column, y_column) -> pl.Expr:
+        # is_xy_inside as a polars expression on two columns (names or expressions), so a cut can be part of a
+        # lazy query: the bounding box and the crossing test of every edge, combined with exclusive ors
+        x = (pl.col(x_column) if isinstance(x_column, str) else x_column).cast(pl.Float64)
+        y = (pl.col(y_column) if isinstance(y_column, str) else y_column).cast(pl.Float64)
+
+        polygons = self.get_polygons()
+        if not polygons:
+            return pl.lit(False)
+
+        x_min, y_min, x_max, y_max = self.get_bounds()
+        inside = []
+        for polygon in polygons:
+            toggles = []
+            for (vtx0, vty0), (vtx1, vty1) in zip(polygon, np.vstack([polygon[1:], polygon[:1]])):
+                yflag0, yflag1 = pl.lit(vty0) >= y, pl.lit(vty1) >= y
+                toggles.append((yflag0 != yflag1) & (((pl.lit(vty1) - y) * (vtx0 - vtx1) >= (pl.lit(vtx1) - x) * (vty0 - vty1)) == yflag1))
+            while len(toggles) > 1: # balanced tree, keeps the expression shallow for polygons with many vertices
+                toggles = [toggles[i] ^ toggles[i + 1] if i + 1 < len(toggles) else toggles[i] for i in range(0, len(toggles), 2)]
+            inside.append(toggles[0])
+
+        return (x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max) & pl.any_horizontal(inside)
+
+    def get_polygons(self) -> list[np.ndarray]: # vertices of each sub-polygon as matplotlib sees the path (the CLOSEPOLY vertex is ignored)
+        if self.path.codes is None:
+            return [self.path.vertices]
+        
+        polygons = []
+        for vertex, code in zip(self.path.vertices, self.path.codes):
+            if code == Path.MOVETO:
+                polygons.append([vertex])
+            elif code != Path.CLOSEPOLY:
+                polygons[-1].append(vertex)
+        return [np.array(polygon) for polygon in polygons]
+
     def get_vertices(self) -> np.ndarray:
         return self.path.vertices
 
@@ -48,6 +145,30 @@ class Cut2D:
         return json.dumps(self, default=lambda obj: {"name": obj.name, "vertices": obj.path.vertices.tolist()} )
     
     
+def points_inside_polygon(x: np.ndarray, y: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    # Even-odd crossing test from matplotlib's point_in_path (src/_path.h), vectorized over the points
+    # and looped over the edges of the polygon, which is always closed back to its first vertex. Keeping
+    # the exact comparisons means points on edges and vertices are classified the same way Path.contains_points does.
+    inside = np.zeros(len(x), dtype=bool)
+
+    vtx0, vty0 = polygon[0]
+    yflag0 = vty0 >= y
+
+    for vtx1, vty1 in np.vstack([polygon[1:], polygon[:1]]):
+        yflag1 = vty1 >= y
+
+        crossing = np.flatnonzero(yflag0 != yflag1) # only the points whose y lies between the edge end points
+        if len(crossing) > 0:
+            x_crossing = x[crossing]
+            y_crossing = y[crossing]
+            toggle = ((vty1 - y_crossing) * (vtx0 - vtx1) >= (vtx1 - x_crossing) * (vty0 - vty1)) == yflag1[crossing]
+            inside[crossing[toggle]] ^= True
+
+        yflag0 = yflag1
+        vtx0, vty0 = vtx1, vty1
+
+    return inside
+    
 def write_cut_json(cut: Cut2D, filepath):
     json_str = cut.to_json_str()
     try:
@@ -71,13 +192,270 @@ def load_cut_json(filepath: str):
         print(f"An error occurred reading trying to read a cut from file {filepath}: {error}")
         return None
 
+cut_file_cache = {} # absolute path -> (modification time, Cut2D)
+
+def load_cut_cached(filepath: str) -> Cut2D:
+    # load_cut_json that keeps the parsed cut until the file is modified
+    if not os.path.exists(filepath):
+        raise FileNotFoundError(f"The file '{filepath}' does not exist.")
+
+    path = os.path.abspath(filepath)
+    mtime = os.stat(path).st_mtime_ns
+    cached = cut_file_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    cut = load_cut_json(path)
+    if cut is None:
+        raise ValueError(f"Could not load a cut from '{filepath}'.")
+    cut_file_cache[path] = (mtime, cut)
+    return cut
+
+"""
+Lookup grid for the cuts on one pair of columns, spanning the bounding box of all of them. Every cell stores
+two bitmasks: the cuts that contain the whole cell, and the cuts with an edge through the cell or one of its
+neighbours. An event gets the first bitmask of its cell, and is tested exactly (crossing test) only against the
+cuts of the second, so the result is identical to Cut2D.is_xy_inside while most events cost one table lookup.
+"""
+class GateGrid:
+    def __init__(self, cuts: list[tuple[int, Cut2D]], dtype: np.dtype, grid_size: int = GATE_GRID_SIZE):
+        self.cuts = cuts # [(bit flag, cut)]
+        self.dtype = dtype
+        self.grid_size = grid_size
+
+        bounds = np.array([cut.get_bounds() for _, cut in cuts])
+        self.x_min, self.y_min = bounds[:, :2].min(axis=0)
+        self.x_max, self.y_max = bounds[:, 2:].max(axis=0)
+        self.x_scale = grid_size / (self.x_max - self.x_min) if self.x_max > self.x_min else 0.0
+        self.y_scale = grid_size / (self.y_max - self.y_min) if self.y_max > self.y_min else 0.0
+
+        self.inside = np.zeros((grid_size, grid_size), dtype=dtype) # [y cell, x cell]
+        self.boundary = np.zeros((grid_size, grid_size), dtype=dtype)
+        for flag, cut in cuts:
+            boundary = self.boundary_cells(cut)
+            self.boundary[boundary] |= flag
+            self.inside[self.inside_cells(cut) & ~boundary] |= flag
+
+        self.inside = self.inside.ravel()
+        self.boundary = self.boundary.ravel()
+
+    def cell_index(self, values: np.ndarray, low: float, scale: float) -> np.ndarray:
+        return np.minimum(((values - low) * scale).astype(np.int64), self.grid_size - 1)
+
+    def boundary_cells(self, cut: Cut2D) -> np.ndarray:
+        # cells crossed by an edge: the edges are sampled at half a cell, then the cells are grown by one in each
+        # direction, which also covers the corners clipped between two samples and any rounding of the cell index
+        cells = np.zeros((self.grid_size, self.grid_size), dtype=bool)
+        cell_width = 1 / self.x_scale if self.x_scale > 0 else np.inf
+        cell_height = 1 / self.y_scale if self.y_scale > 0 else np.inf
+
+        for polygon in cut.get_polygons():
+            for (x0, y0), (x1, y1) in zip(polygon, np.vstack([polygon[1:], polygon[:1]])):
+                n_samples = int(np.ceil(2 * max(abs(x1 - x0) / cell_width, abs(y1 - y0) / cell_height))) + 2
+                t = np.linspace(0, 1, n_samples)
+                x_cells = self.cell_index(x0 + t * (x1 - x0), self.x_min, self.x_scale)
+                y_cells = self.cell_index(y0 + t * (y1 - y0), self.y_min, self.y_scale)
+                cells[np.maximum(y_cells, 0), np.maximum(x_cells, 0)] = True
+
+        grown = cells.copy()
+        grown[1:, :] |= cells[:-1, :]
+        grown[:-1, :] |= cells[1:, :]
+        cells = grown.copy()
+        grown[:, 1:] |= cells[:, :-1]
+        grown[:, :-1] |= cells[:, 1:]
+        return grown
+
+    def inside_cells(self, cut: Cut2D) -> np.ndarray:
+        # even-odd test of the cell centres, row by row: the crossings of each polygon with the horizontal line
+        # through the centres are counted to the left of every centre (only used for cells away from the edges)
+        x_centers = self.x_min + (np.arange(self.grid_size) + 0.5) / self.x_scale if self.x_scale > 0 else np.full(self.grid_size, self.x_min)
+        y_centers = self.y_min + (np.arange(self.grid_size) + 0.5) / self.y_scale if self.y_scale > 0 else np.full(self.grid_size, self.y_min)
+        inside = np.zeros((self.grid_size, self.grid_size), dtype=bool)
+
+        for polygon in cut.get_polygons():
+            start, end = polygon, np.vstack([polygon[1:], polygon[:1]])
+            x0, y0 = start[:, 0][None, :], start[:, 1][None, :]
+            x1, y1 = end[:, 0][None, :], end[:, 1][None, :]
+            y = y_centers[:, None]
+
+            crossing = (y0 >= y) != (y1 >= y) # [row, edge]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                x_crossing = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+
+            rows, edges = np.nonzero(crossing)
+            first_right = np.searchsorted(x_centers, x_crossing[rows, edges], side="right") # first centre right of the crossing
+            counts = np.zeros((self.grid_size, self.grid_size + 1), dtype=np.int32)
+            np.add.at(counts, (rows, first_right), 1)
+            inside |= (np.cumsum(counts[:, :-1], axis=1) & 1).astype(bool)
+
+        return inside
+
+    def evaluate(self, x_chunk: np.ndarray, y_chunk: np.ndarray) -> np.ndarray: # bitmask of a chunk of float64 events
+        bitmask = np.zeros(len(x_chunk), dtype=self.dtype)
+        in_box = np.flatnonzero((x_chunk >= self.x_min) & (x_chunk <= self.x_max) & (y_chunk >= self.y_min) & (y_chunk <= self.y_max))
+        if len(in_box) == 0:
+            return bitmask
+
+        x_box = x_chunk[in_box]
+        y_box = y_chunk[in_box]
+        cells = self.cell_index(y_box, self.y_min, self.y_scale) * self.grid_size + self.cell_index(x_box, self.x_min, self.x_scale)
+
+        box_bits = self.inside[cells]
+        boundary = self.boundary[cells]
+        for flag, cut in self.cuts:
+            near_edge = np.flatnonzero(boundary & flag)
+            if len(near_edge) > 0:
+                box_bits[near_edge[cut.is_chunk_inside(x_box[near_edge], y_box[near_edge])]] |= flag
+
+        bitmask[in_box] = box_bits
+        return bitmask
+
+def bitmask_dtype(n_cuts: int) -> np.dtype: # smallest unsigned integer with one bit per cut
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n_cuts <= np.iinfo(dtype).bits:
+            return np.dtype(dtype)
+    raise ValueError(f"A CutSet holds at most 64 cuts ({n_cuts} given).")
+
+"""
+Set of 2D cuts, each on its own pair of columns, evaluated together. The events are read once per pair of
+columns and in chunks: a chunk is converted to float64 once, events outside the bounding box of all cuts on
+these columns are dropped and the others are looked up on a grid over the cuts (GateGrid), so only the events near a cut edge go through the
+crossing test. The result is an integer bitmask with bit i set
+when the event is inside cut i (in the order the cuts were added), so selections on several cuts are bitwise
+operations on one column. Cuts added from files are re-read only when the file changes.
+
+    cuts = CutSet()
+    cuts.add_file("proton.json", "E", "dE")
+    cuts.add_file("alpha.json", "E", "dE")
+    cuts.add(Cut2D("forward", vertices), "Theta", "Phi")
+    df = cuts.with_bitmask(df)                          # adds the "cuts" column
+    protons = df.filter(cuts.expr("proton", "forward")) # inside both cuts
+"""
+class CutSet:
+    def __init__(self):
+        self.entries: list[dict] = [] # {"name", "x_column", "y_column", "cut" or "file"}
+        self.grids: dict[tuple[str, str], GateGrid] = {} # lookup grid of the cuts on each pair of columns
+
+    def add(self, cut: Cut2D, x_column: str, y_column: str, name: str = None) -> int: # returns the bit of the cut
+        return self.add_entry({"name": cut.name if name is None else name, "x_column": x_column, "y_column": y_column, "cut": cut})
+
+    def add_file(self, filepath: str, x_column: str, y_column: str, name: str = None) -> int:
+        if name is None:
+            name = os.path.splitext(os.path.basename(filepath))[0]
+        load_cut_cached(filepath) # fails early on a missing or malformed file
+        return self.add_entry({"name": name, "x_column": x_column, "y_column": y_column, "file": filepath})
+
+    def add_entry(self, entry: dict) -> int:
+        if entry["name"] in self.names:
+            raise ValueError(f"A cut named '{entry['name']}' is already in the set.")
+        bitmask_dtype(len(self.entries) + 1)
+        self.entries.append(entry)
+        return len(self.entries) - 1
+
+    @property
+    def names(self) -> list[str]:
+        return [entry["name"] for entry in self.entries]
+
+    @property
+    def dtype(self) -> np.dtype:
+        return bitmask_dtype(len(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_cut(self, name: str) -> Cut2D:
+        entry = self.entries[self.bit(name)]
+        return load_cut_cached(entry["file"]) if "file" in entry else entry["cut"]
+
+    def bit(self, name: str) -> int:
+        try:
+            return self.names.index(name)
+        except ValueError:
+            raise ValueError(f"No cut named '{name}' in the set ({', '.join(self.names)}).") from None
+
+    def mask(self, *names: str) -> int: # integer with the bits of the named cuts
+        return sum(1 << self.bit(name) for name in names)
+
+    def columns(self) -> dict[tuple[str, str], list[int]]: # (x_column, y_column) -> bits of the cuts on these columns
+        groups = {}
+        for index, entry in enumerate(self.entries):
+            groups.setdefault((entry["x_column"], entry["y_column"]), []).append(index)
+        return groups
+
+    @profiling.profiled("cut.bitmask")
+    def bitmask(self, df: pl.DataFrame) -> np.ndarray:
+        # df can also be a dict of columns (polars series or numpy arrays of the same length)
+        columns = df.columns if isinstance(df, pl.DataFrame) else list(df)
+        missing = {column for entry in self.entries for column in (entry["x_column"], entry["y_column"])} - set(columns)
+        if missing:
+            raise ValueError(f"{sorted(missing)} do not exist in the DataFrame columns.")
+
+        dtype = self.dtype
+        length = df.height if isinstance(df, pl.DataFrame) else (len(df[columns[0]]) if columns else 0)
+        bitmask = np.zeros(length, dtype=dtype)
+
+        for (x_column, y_column), bits in self.columns().items():
+            cuts = [(dtype.type(1 << bit), self.get_cut(self.names[bit])) for bit in bits]
+            cuts = [(flag, cut) for flag, cut in cuts if cut.get_polygons()]
+            if not cuts:
+                continue
+
+            grid = self.grids.get((x_column, y_column))
+            if grid is None or grid.cuts != cuts: # the cuts of the group changed (added, or a cut file was modified)
+                grid = GateGrid(cuts, dtype)
+                self.grids[(x_column, y_column)] = grid
+
+            x, y = as_array(df[x_column]), as_array(df[y_column])
+            if len(x) != length or len(y) != length:
+                raise ValueError(f"The columns '{x_column}' and '{y_column}' must have {length} entries ({len(x)}, {len(y)}).")
+            for start in range(0, len(x), GATE_CHUNK_SIZE):
+                x_chunk = np.asarray(x[start:start + GATE_CHUNK_SIZE], dtype=np.float64)
+                y_chunk = np.asarray(y[start:start + GATE_CHUNK_SIZE], dtype=np.float64)
+                bitmask[start:start + len(x_chunk)] |= grid.evaluate(x_chunk, y_chunk)
+
+        return bitmask
+
+    def with_bitmask(self, df: pl.DataFrame, column: str = "cuts") -> pl.DataFrame:
+        return df.with_columns(pl.Series(column, self.bitmask(df)))
+
+    def expr(self, *names: str, column: str = "cuts", any_of: bool = False) -> pl.Expr:
+        # filter expression on the bitmask column: inside all the named cuts, or inside at least one with any_of=True
+        mask = pl.lit(self.mask(*names), dtype=pl.Series(np.zeros(0, dtype=self.dtype)).dtype)
+        selected = pl.col(column) & mask
+        return selected != 0 if any_of else selected == mask
+
+def gate_mask(cuts) -> np.ndarray:
+    # Boolean mask of the events inside all the cuts, evaluated with a CutSet. cuts is a (cut, x, y) tuple or a
+    # list of them: the cut is a Cut2D or a cut file, x and y the series/arrays the cut is applied to (any pair
+    # of columns). Columns passed more than once (the same buffer) are read once and share a lookup grid.
+    if isinstance(cuts, tuple):
+        cuts = [cuts]
+
+    cut_set = CutSet()
+    columns, buffers = {}, {}
+
+    def column_name(data) -> str:
+        data = as_array(data)
+        key = (data.__array_interface__["data"][0], data.shape, data.strides, data.dtype.str)
+        if key not in buffers:
+            buffers[key] = f"column_{len(buffers)}"
+            columns[buffers[key]] = data
+        return buffers[key]
+
+    for index, (cut, x, y) in enumerate(cuts):
+        if isinstance(cut, str):
+            cut = load_cut_cached(cut)
+        cut_set.add(cut, column_name(x), column_name(y), name=f"gate_{index}")
+
+    return cut_set.bitmask(columns) == cut_set.mask(*cut_set.names)
+
 def reduce_df_with_cut(df:pl.DataFrame, CutFile: str, XColumn: str, YColumn: str):
     if os.path.exists(CutFile):
         
-        cut = load_cut_json(CutFile)
+        cut = load_cut_cached(CutFile)
         
         if XColumn in df.columns and YColumn in df.columns: # Check if XColumn and YColumn exist in the DataFrame
-            df = df.filter(pl.col(XColumn).list.concat(YColumn).map(cut.is_cols_inside))   
+            df = df.filter(pl.Series(values=cut.is_xy_inside(df[XColumn], df[YColumn])))
             return df
         else:
             raise ValueError(f"'{XColumn}' and/or '{YColumn}' do not exist in the DataFrame columns.")
@@ -0,0 +1,183 @@
+import numpy as np
+from . import profiling
+
+# Fit backend for N Gaussians on a linear background. The whole model and its analytic derivatives are
+# evaluated in one vectorized call (no lmfit model tree, no numerical derivatives), with two objectives:
+#   "chi2":    least squares weighted by sqrt(max(counts, 1))
+#   "poisson": binned Poisson likelihood (deviance 2 * sum(f - y + y ln(y/f))), unbiased for low counts
+# The Gaussians use the same parametrization and parameter names as lmfit's GaussianModel (g{i}_amplitude,
+# g{i}_center, g{i}_sigma and the derived g{i}_fwhm/g{i}_height) so the results work with gaussian_result_formatted.
+
+SQRT_2PI = np.sqrt(2 * np.pi)
+FWHM_FACTOR = 2 * np.sqrt(2 * np.log(2))
+
+"""
+Sum of N Gaussians and a line. The parameter vector is [amplitude_0, center_0, sigma_0, ..., slope, intercept].
+"""
+class MultiGaussianModel:
+    def __init__(self, n_peaks: int):
+        self.n_peaks = n_peaks
+
+    def components(self, x: np.ndarray, theta: np.ndarray):
+        amplitude, center, sigma = theta[:-2:3], theta[1:-2:3], theta[2:-2:3]
+        z = (x[:, None] - center) / sigma
+        gauss = np.exp(-0.5 * z**2) / (sigma * SQRT_2PI)
+        return amplitude * gauss, gauss, z
+
+    def eval(self, x: np.ndarray, theta: np.ndarray) -> np.ndarray:
+        peaks, _, _ = self.components(x, theta)
+        return peaks.sum(axis=1) + theta[-2] * x + theta[-1]
+
+    def jacobian(self, x: np.ndarray, theta: np.ndarray) -> np.ndarray:
+        amplitude, sigma = theta[:-2:3], theta[2:-2:3]
+        peaks, gauss, z = self.components(x, theta)
+
+        jacobian = np.empty((len(x), len(theta)))
+        jacobian[:, :-2:3] = gauss
+        jacobian[:, 1:-2:3] = peaks * z / sigma
+        jacobian[:, 2:-2:3] = peaks * (z**2 - 1) / sigma
+        jacobian[:, -2] = x
+        jacobian[:, -1] = 1.0
+        return jacobian
+
+    def __repr__(self):
+        return f"MultiGaussianModel(n_peaks={self.n_peaks})"
+
+class FitParameter:
+    def __init__(self, value: float, stderr: float = None):
+        self.value = value
+        self.stderr = stderr
+
+    def __repr__(self):
+        return f"FitParameter(value={self.value}, stderr={self.stderr})"
+
+class LinearBackground: # evaluates like the lmfit LinearModel result of fit_background
+    def __init__(self, slope: FitParameter, intercept: FitParameter):
+        self.params = {"slope": slope, "intercept": intercept}
+
+    def eval(self, x):
+        return self.params["slope"].value * np.asarray(x) + self.params["intercept"].value
+
+"""
+Result of fit_gaussians_fast. Like an lmfit ModelResult, params maps names to objects with value/stderr,
+eval(x) returns the sum of the Gaussians and eval_components(x) each Gaussian by prefix. The fitted
+background is available as result.background.
+"""
+class FastFitResult:
+    def __init__(self, model: MultiGaussianModel, theta: np.ndarray, covariance: np.ndarray, objective: str,
+                 statistic: float, ndata: int, success: bool, message: str, nfev: int):
+        self.model = model
+        self.theta = theta
+        self.covariance = covariance
+        self.objective = objective
+        self.ndata = ndata
+        self.nvarys = len(theta)
+        self.redchi = statistic / max(ndata - len(theta), 1) # chi-square or Poisson deviance per degree of freedom
+        self.success = success
+        self.message = message
+        self.nfev = nfev
+
+        errors = None if covariance is None else np.sqrt(np.clip(np.diag(covariance), 0, None))
+
+        def parameter(index):
+            return FitParameter(theta[index], None if errors is None else errors[index])
+
+        self.params = {}
+        for i in np.arange(model.n_peaks):
+            prefix = f"g{i}_"
+            a, c, s = 3 * i, 3 * i + 1, 3 * i + 2
+            self.params[f"{prefix}amplitude"] = parameter(a)
+            self.params[f"{prefix}center"] = parameter(c)
+            self.params[f"{prefix}sigma"] = parameter(s)
+
+            height = theta[a] / (theta[s] * SQRT_2PI)
+            fwhm_stderr = height_stderr = None
+            if covariance is not None:
+                fwhm_stderr = FWHM_FACTOR * errors[s]
+                gradient = np.array([height / theta[a], -height / theta[s]]) # d height / d (amplitude, sigma)
+                block = covariance[np.ix_([a, s], [a, s])]
+                height_stderr = np.sqrt(max(gradient @ block @ gradient, 0))
+
+            self.params[f"{prefix}fwhm"] = FitParameter(FWHM_FACTOR * theta[s], fwhm_stderr)
+            self.params[f"{prefix}height"] = FitParameter(height, height_stderr)
+
+        self.background = LinearBackground(parameter(-2), parameter(-1))
+
+    def eval(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        peaks, _, _ = self.model.components(x, self.theta)
+        return peaks.sum(axis=1)
+
+    def eval_components(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        peaks, _, _ = self.model.components(x, self.theta)
+        return {f"g{i}_": peaks[:, i] for i in np.arange(self.model.n_peaks)}
+
+@profiling.profiled("fit.fast")
+def fit_gaussians_fast(hist_counts, hist_bin_centers, initial_parameters, background=(0.0, 0.0), objective: str = "chi2") -> FastFitResult:
+    # initial_parameters: output of initial_gaussian_parameters, [sigma, center, height, amplitude] dicts per peak
+    # background: initial (slope, intercept) of the linear background, fitted together with the Gaussians
+    from scipy.optimize import least_squares, minimize
+
+    y = np.asarray(hist_counts, dtype=np.float64)
+    x = np.asarray(hist_bin_centers, dtype=np.float64)
+    bin_width = abs(x[1] - x[0]) if len(x) > 1 else 1.0
+
+    model = MultiGaussianModel(len(initial_parameters))
+
+    theta0, lower, upper = [], [], []
+    for sigma, center, height, amplitude in initial_parameters:
+        theta0 += [amplitude["value"], center["value"], sigma["value"]]
+        lower += [0.0, center.get("min", -np.inf), max(sigma.get("min", 0.0), 1e-3 * bin_width)]
+        upper += [np.inf, center.get("max", np.inf), sigma.get("max", np.inf)]
+    theta0 += list(background)
+    lower += [-np.inf, -np.inf]
+    upper += [np.inf, np.inf]
+
+    lower, upper = np.array(lower), np.array(upper)
+    # start strictly inside the bounds
+    margin = 1e-9 * (np.abs(np.where(np.isfinite(lower), lower, 0)) + np.abs(np.where(np.isfinite(upper), upper, 0)) + 1)
+    theta0 = np.clip(np.array(theta0, dtype=np.float64), lower + margin, upper - margin)
+
+    if objective == "chi2":
+        weights = 1 / np.sqrt(np.maximum(y, 1))
+
+        solution = least_squares(lambda theta: (model.eval(x, theta) - y) * weights, theta0,
+                                 jac=lambda theta: model.jacobian(x, theta) * weights[:, None],
+                                 bounds=(lower, upper), method='trf', x_scale='jac')
+
+        theta = solution.x
+        statistic = 2 * solution.cost
+        jacobian = model.jacobian(x, theta) * weights[:, None]
+        covariance = invert(jacobian.T @ jacobian)
+        if covariance is not None: # scaled by the reduced chi-square, like lmfit does by default
+            covariance = covariance * statistic / max(len(x) - len(theta), 1)
+        success, message, nfev = solution.success, solution.message, solution.nfev
+
+    elif objective == "poisson":
+        positive = 1e-12 # the model is kept positive in the logarithm
+
+        def deviance(theta):
+            f = np.maximum(model.eval(x, theta), positive)
+            gradient = 2 * model.jacobian(x, theta).T @ (1 - y / f)
+            return 2 * np.sum(f - y + y * np.log(np.where(y > 0, y, 1) / f) * (y > 0)), gradient
+
+        solution = minimize(deviance, theta0, jac=True, method='L-BFGS-B', bounds=list(zip(lower, upper)))
+
+        theta = solution.x
+        statistic = solution.fun
+        f = np.maximum(model.eval(x, theta), positive)
+        jacobian = model.jacobian(x, theta)
+        covariance = invert(jacobian.T @ (jacobian / f[:, None])) # inverse of the Fisher information
+        success, message, nfev = solution.success, solution.message, solution.nfev
+
+    else:
+        raise ValueError(f"Unknown objective '{objective}', expected 'chi2' or 'poisson'.")
+
+    return FastFitResult(model, theta, covariance, objective, statistic, len(x), bool(success), str(message), int(nfev))
+
+def invert(matrix: np.ndarray): # covariance from the curvature, None when it is singular
+    try:
+        return np.linalg.inv(matrix)
+    except np.linalg.LinAlgError:
+        return None
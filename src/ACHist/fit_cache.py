@@ -0,0 +1,73 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+"""
+LRU cache of Gaussian fits. A fit is keyed on a hash of the counts and bin centres in the region, the region,
+the background line, the peak positions and the fit backend, so pressing 'f' again without changing anything
+returns the previous result immediately. When there is no exact match the nearest cached fit with the same
+number of peaks (overlapping region, closest markers) is used as the starting point instead of the
+initial_gaussian_parameters estimate, so a fit after moving a marker by a bin converges in a few iterations.
+"""
+class FitCache:
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (signature, result, model)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: str):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        _, result, model = self.entries[key]
+        return result, model
+
+    def put(self, key: str, signature: tuple, result, model):
+        self.entries[key] = (signature, result, model)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def nearest(self, signature: tuple):
+        # cached result closest to the signature (backend, objective, region, peak positions), None if no
+        # fit of the same backend and number of peaks has an overlapping region
+        backend, objective, region, peaks = signature
+        best, best_distance = None, np.inf
+        for (cached_backend, cached_objective, cached_region, cached_peaks), result, _ in self.entries.values():
+            if (cached_backend, cached_objective) != (backend, objective) or len(cached_peaks) != len(peaks):
+                continue
+            if cached_region[1] < region[0] or region[1] < cached_region[0]:
+                continue
+            distance = abs(cached_region[0] - region[0]) + abs(cached_region[1] - region[1]) + np.sum(np.abs(np.subtract(cached_peaks, peaks)))
+            if distance < best_distance:
+                best, best_distance = result, distance
+        return best
+
+    def clear(self):
+        self.entries.clear()
+
+def fit_key(hist_counts, hist_bin_centers, region, peak_positions, background: tuple, backend: str, objective: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(hist_counts, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(hist_bin_centers, dtype=np.float64).tobytes())
+    digest.update(np.array([*region, *background, *peak_positions], dtype=np.float64).tobytes())
+    digest.update(f"{backend}/{objective}".encode())
+    return digest.hexdigest()
+
+def warm_start_parameters(initial_parameters: list, result) -> list:
+    # initial parameters (as from initial_gaussian_parameters) with the values of a previous fit, kept inside the new limits
+    warm_parameters = []
+    for i, (sigma, center, height, amplitude) in enumerate(initial_parameters):
+        prefix = f"g{i}_"
+        values = []
+        for name, parameter in [("sigma", sigma), ("center", center), ("amplitude", amplitude)]:
+            value = float(np.clip(result.params[f"{prefix}{name}"].value, parameter.get("min", -np.inf), parameter.get("max", np.inf)))
+            values.append(dict(parameter, value=value))
+        warm_parameters.append([values[0], values[1], height, values[2]]) # the height follows from sigma and amplitude
+    return warm_parameters
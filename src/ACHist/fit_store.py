@@ -0,0 +1,165 @@
+import io
+import json
+import os
+import shutil
+import zipfile
+import numpy as np
+import polars as pl
+from .fast_fit import MultiGaussianModel, FastFitResult
+
+# Store of Gaussian fits, one zip archive per spectrum. Every fit is written as two members:
+#   fits/<fit_id>.json  region, backend, parameter vector, parameter values/uncertainties and fit quality
+#   fits/<fit_id>.npy   full covariance of the parameter vector (missing when the fit has none)
+# The parameter vector is [amplitude_0, center_0, sigma_0, ..., slope, intercept] for both fit backends, so a
+# stored fit is plotted and evaluated with the vectorized model of fast_fit.py without rebuilding lmfit objects.
+# Fits are appended to the archive, the zip directory is the index, and a fit is only read when it is loaded.
+# An append writes a copy of the archive next to it and replaces the archive with os.replace, so a crash never
+# leaves a corrupt store. The store is single-writer: two processes appending to the same file at once lose fits.
+
+"""
+A fit read back from a FitStore. record holds the json metadata, result the fit as a FastFitResult
+(params with value/stderr, eval, eval_components, background).
+"""
+class StoredFit:
+    def __init__(self, record: dict, covariance: np.ndarray):
+        self.record = record
+        self.fit_id = record["fit_id"]
+        self.region = tuple(record["region"])
+
+        theta = np.array(record["theta"], dtype=np.float64)
+        self.result = FastFitResult(MultiGaussianModel(record["n_peaks"]), theta, covariance, record["objective"],
+                                    statistic=0.0, ndata=record["ndata"], success=record["success"], message="", nfev=record["nfev"])
+        self.result.redchi = record["redchi"]
+
+class FitStore:
+    def __init__(self, path: str):
+        self.path = path
+
+    def ids(self) -> list[str]: # ids of the stored fits, in the order they were appended
+        if not os.path.exists(self.path):
+            return []
+        with zipfile.ZipFile(self.path, "r") as archive:
+            return [name[len("fits/"):-len(".json")] for name in archive.namelist() if name.startswith("fits/") and name.endswith(".json")]
+
+    def __len__(self):
+        return len(self.ids())
+
+    def __contains__(self, fit_id):
+        return fit_id in self.ids()
+
+    def append(self, result, background_result, region, backend: str = "lmfit", objective: str = "chi2", name: str = "", fit_id: str = None) -> str:
+        # adds a fit (lmfit or fast backend result) and returns its id
+        ids = self.ids()
+        if fit_id is None:
+            fit_id = f"fit_{len(ids)}"
+            while fit_id in ids: fit_id += "_"
+        elif fit_id in ids:
+            raise ValueError(f"A fit with id '{fit_id}' is already stored in {self.path}.")
+
+        theta, covariance = parameter_vector(result, background_result)
+        n_peaks = (len(theta) - 2) // 3
+
+        parameters = {param_name: [float(param.value), None if param.stderr is None else float(param.stderr)] for param_name, param in result.params.items()}
+        for param_name, param in background_result.params.items():
+            parameters[f"bg_{param_name}"] = [float(param.value), None if param.stderr is None else float(param.stderr)]
+
+        record = {
+            "fit_id": fit_id,
+            "name": name,
+            "region": [float(region[0]), float(region[1])],
+            "backend": backend,
+            "objective": objective,
+            "n_peaks": n_peaks,
+            "theta": theta.tolist(),
+            "parameters": parameters,
+            "redchi": float(result.redchi),
+            "success": bool(result.success),
+            "ndata": int(result.ndata),
+            "nfev": int(result.nfev),
+        }
+
+        # the fit is appended to a copy, the archive is only replaced once the copy is complete
+        temporary_path = self.path + ".tmp"
+        try:
+            if os.path.exists(self.path):
+                shutil.copyfile(self.path, temporary_path)
+            with zipfile.ZipFile(temporary_path, "a" if os.path.exists(self.path) else "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(f"fits/{fit_id}.json", json.dumps(record))
+                if covariance is not None:
+                    buffer = io.BytesIO()
+                    np.save(buffer, covariance)
+                    archive.writestr(f"fits/{fit_id}.npy", buffer.getvalue())
+            os.replace(temporary_path, self.path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+        return fit_id
+
+    def record(self, fit_id: str) -> dict: # metadata of a fit, without the covariance
+        with zipfile.ZipFile(self.path, "r") as archive:
+            return json.loads(archive.read(f"fits/{fit_id}.json"))
+
+    def load(self, fit_id: str) -> StoredFit:
+        with zipfile.ZipFile(self.path, "r") as archive:
+            record = json.loads(archive.read(f"fits/{fit_id}.json"))
+            covariance = None
+            if f"fits/{fit_id}.npy" in archive.namelist():
+                covariance = np.load(io.BytesIO(archive.read(f"fits/{fit_id}.npy")))
+        return StoredFit(record, covariance)
+
+    def table(self) -> pl.DataFrame:
+        # one row per stored peak (fit id, name, region, centre, amplitude, fwhm and uncertainties, reduced chi-square)
+        rows = []
+        with zipfile.ZipFile(self.path, "r") as archive:
+            for fit_id in self.ids():
+                record = json.loads(archive.read(f"fits/{fit_id}.json"))
+                parameters = record["parameters"]
+                for i in np.arange(record["n_peaks"]):
+                    prefix = f"g{i}_"
+                    rows.append(dict(
+                        fit_id=fit_id,
+                        name=record["name"],
+                        peak=int(i),
+                        region_low=record["region"][0],
+                        region_high=record["region"][1],
+                        center=parameters[f"{prefix}center"][0],
+                        center_uncertainty=parameters[f"{prefix}center"][1],
+                        amplitude=parameters[f"{prefix}amplitude"][0],
+                        amplitude_uncertainty=parameters[f"{prefix}amplitude"][1],
+                        fwhm=abs(parameters[f"{prefix}fwhm"][0]),
+                        fwhm_uncertainty=parameters[f"{prefix}fwhm"][1],
+                        redchi=record["redchi"],
+                        success=record["success"],
+                    ))
+
+        return pl.DataFrame(rows, schema={"fit_id": pl.Utf8, "name": pl.Utf8, "peak": pl.Int64, "region_low": pl.Float64, "region_high": pl.Float64,
+                                          "center": pl.Float64, "center_uncertainty": pl.Float64, "amplitude": pl.Float64, "amplitude_uncertainty": pl.Float64,
+                                          "fwhm": pl.Float64, "fwhm_uncertainty": pl.Float64, "redchi": pl.Float64, "success": pl.Boolean})
+
+def parameter_vector(result, background_result):
+    # [amplitude_0, center_0, sigma_0, ..., slope, intercept] and its covariance from a fit of either backend
+    if isinstance(result, FastFitResult):
+        return np.array(result.theta, dtype=np.float64), result.covariance
+
+    # lmfit: the Gaussians and the background are separate fits, their covariances are put in one block diagonal
+    # matrix. The background is held fixed in the Gaussian fit, so the cross terms between the two blocks are zero in
+    # that fit, not unknown, and uncertainties derived from both blocks stay finite after a round trip
+    n_peaks = len([param_name for param_name in result.params if param_name.endswith("_center")])
+    names = [f"g{i}_{param_name}" for i in np.arange(n_peaks) for param_name in ("amplitude", "center", "sigma")]
+    theta = np.array([result.params[param_name].value for param_name in names] +
+                     [background_result.params["slope"].value, background_result.params["intercept"].value], dtype=np.float64)
+
+    if getattr(result, "covar", None) is None:
+        return theta, None
+
+    covariance = np.zeros((len(theta), len(theta)))
+    indices = [result.var_names.index(param_name) for param_name in names]
+    covariance[:-2, :-2] = result.covar[np.ix_(indices, indices)]
+    if getattr(background_result, "covar", None) is not None:
+        indices = [background_result.var_names.index(param_name) for param_name in ("slope", "intercept")]
+        covariance[-2:, -2:] = background_result.covar[np.ix_(indices, indices)]
+    else: # background without uncertainties
+        covariance[-2:, -2:] = np.nan
+
+    return theta, covariance
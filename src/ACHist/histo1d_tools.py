@@ -2,26 +2,34 @@ import matplotlib.pyplot as plt
 import polars as pl
 import numpy as np
 import os
-from lmfit.models import GaussianModel, LinearModel
-from lmfit.model import save_modelresult, load_modelresult, save_model, load_model
-from scipy.signal import find_peaks
 from colorama import Fore, Style
-from tabulate import tabulate
-
-plt.rcParams['keymap.pan'].remove('p')
-plt.rcParams['keymap.home'].remove('r')
-plt.rcParams['keymap.fullscreen'].remove('f')
-plt.rcParams['keymap.grid'].remove('g')
-plt.rcParams['keymap.grid_minor'].remove('G')
-plt.rcParams['keymap.quit_all'].append('Q')
-plt.rcParams['keymap.xscale'].remove('L')
-plt.rcParams['keymap.xscale'].remove('k')
-plt.rcParams['keymap.yscale'].remove('l')
+from .stats import StatsIndex1D, LimitsText
+from .histogram import Histogram1D
+from .binning import fill_histo1d, fill_histo1d_sources
+from .fast_fit import fit_gaussians_fast
+from .fit_cache import FitCache, fit_key, warm_start_parameters
+from .fit_store import FitStore
+from .blit import blit_manager, animated
+from .cut import gate_mask
+from .histogram_cache import histogram_key, source_files
+from . import profiling
+
+# lmfit, scipy.signal and tabulate are imported where they are first used, so importing the package (e.g. in
+# batch jobs that only fill histograms) does not load the fitting stack. The matplotlib keymaps that clash with
+# the fitting/projection keys are released when an interactive figure is set up, not at import.
+
+def set_interactive_keymaps():
+    for keymap, key in [('keymap.pan', 'p'), ('keymap.home', 'r'), ('keymap.fullscreen', 'f'), ('keymap.grid', 'g'), ('keymap.grid_minor', 'G'),
+                        ('keymap.xscale', 'L'), ('keymap.xscale', 'k'), ('keymap.yscale', 'l')]:
+        if key in plt.rcParams[keymap]:
+            plt.rcParams[keymap].remove(key)
+    if 'Q' not in plt.rcParams['keymap.quit_all']:
+        plt.rcParams['keymap.quit_all'].append('Q')
 
 def histo1d(
     xdata: list,
-    bins: int,
-    range: list,
+    bins: int = None,
+    range: list = None,
     subplots: (plt.figure, plt.Axes) = None,
     xlabel: str = None,
     ylabel: str = None,
@@ -31,27 +39,92 @@ def histo1d(
     linestyle: str = None,
     linewidth: float = None,
     display_stats: bool = True,
+    stats_mode: str = None,
+    workers: int = None,
+    keep_sources: bool = False,
+    fit_backend: str = "lmfit",
+    fit_objective: str = "chi2",
+    cuts=None,
+    cache=None,
+    source: str = None,
     ):
+
+    # cuts: (cut, x, y) or a list of them (see cut.gate_mask), only the events inside all the cuts are filled. The
+    # cuts can be on any columns, e.g. a particle identification cut on (E, dE) while histogramming the energy.
+    # The gate is applied as a mask during the fill, the data is never copied into a filtered frame.
+    # cache: HistogramCache, the counts are read from it when the same histogram was filled before. source is the
+    # parquet path/glob the series were read from, its files are added to the key (the series are always identified
+    # by their values as well, so a series of a filtered frame does not get the entry of the full column).
     
     if isinstance(xdata, np.ndarray): # when the data is a numpy array, i.e. handles the case for the x/y projections 
         data = xdata
         column = ""
         
     if isinstance(xdata, pl.Series): # checks if xdata is a polars series
-        data = xdata.to_numpy()
+        with profiling.stage("histo1d.convert") as timing:
+            data = xdata.to_numpy()
+            timing.add_bytes(data.nbytes)
         column = xdata.name
 
-    if isinstance(xdata, list): # if xdata is a list of polars series
-        data = np.concatenate([data.to_numpy() for data in xdata])
+    if isinstance(xdata, list): # if xdata is a list of polars series, each is filled on its own instead of concatenating them
+        with profiling.stage("histo1d.convert") as timing:
+            data = [item.to_numpy() for item in xdata]
+            timing.add_bytes(sum(item.nbytes for item in data))
         column = '_'.join([item.name for item in xdata])
         
-    hist_counts, hist_bins = np.histogram(data, bins=bins, range=range)
+    if isinstance(xdata, Histogram1D): # already filled (e.g. a projection of a 2D histogram), no raw data
+        data = None
+        column = xdata.name
+        hist_counts, hist_bins = xdata.counts, xdata.edges
+        if range is None: range = xdata.range
+        stats_mode = "fast"
+    else:
+        if cuts and isinstance(data, list):
+            raise ValueError("Cuts can only be applied to a single series or array, not to a list of sources.")
+
+        cached = None
+        if cache is not None:
+            with profiling.stage("histo1d.cache"):
+                key = histogram_key("histo1d", xdata if isinstance(xdata, list) else [xdata], bins, range, cuts=cuts, source=source,
+                                    sources_kept=bool(keep_sources and isinstance(data, list)))
+                cached = cache.get(key)
+
+        gate = None
+        if cuts and (cached is None or (display_stats and stats_mode in (None, "exact"))):
+            with profiling.stage("histo1d.gate") as timing:
+                gate = gate_mask(cuts)
+                timing.add_bytes(gate.nbytes)
+
+        if cached is not None:
+            hist_counts, hist_bins = cached["counts"], cached["edges"]
+            source_counts = list(cached["source_counts"]) if "source_counts" in cached else []
+        else:
+            with profiling.stage("histo1d.fill") as timing:
+                if isinstance(data, list):
+                    hist_counts, hist_bins, source_counts = fill_histo1d_sources(data, bins=bins, range=range, workers=workers, keep_sources=keep_sources)
+                    timing.add_bytes(sum(counts.nbytes for counts in source_counts))
+                else:
+                    hist_counts, hist_bins = fill_histo1d(data, bins=bins, range=range, workers=workers, mask=gate)
+                timing.add_bytes(hist_counts.nbytes)
+
+            if cache is not None:
+                arrays = {"counts": hist_counts, "edges": hist_bins}
+                if isinstance(data, list) and keep_sources: arrays["source_counts"] = np.array(source_counts)
+                cache.put(key, arrays, sources=source_files(source), description=f"histo1d {column}")
+
+        if gate is not None: # the exact stats need the gated events themselves
+            data = data[gate] if display_stats and stats_mode in (None, "exact") else None
+            if data is None: stats_mode = "fast"
+        
+    if stats_mode is None: # the exact stats need a sorted copy of the data, lists of sources use the bin centres to keep the memory low
+        stats_mode = "fast" if isinstance(data, list) else "exact"
     
     fig, ax = (plt.subplots() if subplots is None else subplots)
+    profiling.instrument_figure(fig, "histo1d")
 
     if linewidth is None: linewidth = 0.5
     
-    ax.step(hist_bins[:-1], hist_counts, where='post', label=label, linewidth=linewidth, color=color, linestyle=linestyle)
+    step_line = ax.step(hist_bins[:-1], hist_counts, where='post', label=label, linewidth=linewidth, color=color, linestyle=linestyle)[0]
     ax.set_xlim(range)
     ax.set_ylim(bottom=0)
     ax.set_xlabel(xlabel if xlabel is not None else column)
@@ -63,43 +136,73 @@ def histo1d(
     ax.tick_params(axis='both',which='minor',direction='in',top=True,right=True,left=True,bottom=True,length=2)
     ax.tick_params(axis='both',which='major',direction='in',top=True,right=True,left=True,bottom=True,length=4)
             
-    if display_stats: matplotlib_1DHistogram_stats(ax=ax, data=data, bins=bins)
+    stats_box = matplotlib_1DHistogram_stats(ax=ax, data=data, bins=bins, mode=stats_mode, hist_counts=hist_counts, hist_bins=hist_bins) if display_stats else None
         
-    interactive_1DHistogram_fitting(hist_counts=hist_counts, hist_bins=hist_bins, subplot=(fig,ax))
+    interactive_1DHistogram_fitting(hist_counts=hist_counts, hist_bins=hist_bins, subplot=(fig,ax), fit_backend=fit_backend, fit_objective=fit_objective)
+
+    if isinstance(data, list) and keep_sources:
+        interactive_1DHistogram_sources(subplot=(fig,ax), hist_counts=hist_counts, hist_bins=hist_bins, source_counts=source_counts,
+                                        source_names=[item.name for item in xdata], step_line=step_line, stats_box=stats_box)
 
     fig.tight_layout()
     
-    return
+    return hist_counts, hist_bins
 
-def matplotlib_1DHistogram_stats(ax, data, bins):
-    
-    def on_xlims_change(ax): # A function to update the stats box when the x-axis limits change
-            
-        x_lims = ax.get_xlim()
-        
-        filtered_data = data[(data >= x_lims[0]) & (data <= x_lims[1])] # Filter the data based on the new x-axis limits
-        
-        new_counts, _ = np.histogram(filtered_data, bins=bins, range=(x_lims[0], x_lims[1]))  # Calculate the new counts
-                    
-        stats = f"Mean: {np.mean(filtered_data):.2f}\nStd Dev: {np.std(filtered_data):.2f}\nIntegral: {np.sum(new_counts):.0f}"
-        
-        text_box.set_text(stats)
-                        
-        ax.figure.canvas.draw()
-        
-    x_lims = ax.get_xlim()
-    on_screen_data = data[(data >= x_lims[0]) & (data <= x_lims[1])] # Filter the data based on the new x-axis limits
-    
-    # stats = f"Mean: {np.mean(data[(data >= range[0]) & (data <= range[1])]):.2f}\nStd Dev: {np.std(data[(data >= range[0]) & (data <= range[1])]):.2f}\nIntegral: {np.sum(hist):.0f}"
-    stats = f"Mean: {np.mean(on_screen_data):.2f}\nStd Dev: {np.std(on_screen_data):.2f}\nIntegral: {np.sum(on_screen_data):.0f}"
+def matplotlib_1DHistogram_stats(ax, data, bins, mode: str = "exact", hist_counts=None, hist_bins=None):
     
+    # mode="exact" uses the moments of the raw data, mode="fast" the moments of the bin centres.
+    # The stats box refreshes itself when it is drawn with new x-axis limits.
     props = dict(boxstyle='round', facecolor='white', alpha=0.5, edgecolor='black')
-    text_box = ax.text(0.95, 0.95, stats, transform=ax.transAxes, fontsize=10, verticalalignment='top', horizontalalignment='right', bbox=props)
+    with profiling.stage("stats.index_1d") as timing:
+        stats_index = StatsIndex1D(data=data, hist_counts=hist_counts, hist_bins=hist_bins, mode=mode)
+        timing.add_bytes(stats_index.positions.nbytes + stats_index.cumulative_sum.nbytes * 3)
+    text_box = LimitsText(0.95, 0.95, "", stats_text=stats_text_1d(stats_index),
+                          transform=ax.transAxes, fontsize=10, verticalalignment='top', horizontalalignment='right', bbox=props)
+    ax.add_artist(text_box)
+    animated(text_box)
 
+    return text_box
 
-    ax.callbacks.connect('xlim_changed', on_xlims_change) # Connect the on_xlims_change function to the 'xlim_changed' event
+def stats_text_1d(stats_index: StatsIndex1D):
 
-    return 
+    def stats_text(x_lims, y_lims):
+        integral, mean, std = stats_index.window(min(x_lims), max(x_lims))
+        return f"Mean: {mean:.2f}\nStd Dev: {std:.2f}\nIntegral: {integral:.0f}"
+    
+    return stats_text
+
+def interactive_1DHistogram_sources(subplot: (plt.figure, plt.Axes), hist_counts, hist_bins, source_counts, source_names, step_line, stats_box=None):
+    # Toggles the contribution of single sources (detectors) to the summed histogram from their retained counts.
+    # hist_counts is updated in place so the fitting works on what is shown.
+    fig, ax = subplot
+
+    enabled = [True] * len(source_counts)
+
+    def on_key(event):
+        if event.inaxes is not None and event.key == 't':
+
+            for i, name in enumerate(source_names):
+                state = f"{Fore.GREEN}on{Style.RESET_ALL}" if enabled[i] else f"{Fore.RED}off{Style.RESET_ALL}"
+                print(f"  {Fore.YELLOW}{i}{Style.RESET_ALL}: {name} ({state})")
+
+            selection = input(f"{Fore.YELLOW}Enter the index of the source to toggle: {Style.RESET_ALL}")
+            if not selection.strip().isdigit() or int(selection) >= len(source_counts):
+                print(f"{Fore.RED}{Style.BRIGHT}Not a valid source index: {selection}{Style.RESET_ALL}")
+                return
+
+            enabled[int(selection)] = not enabled[int(selection)]
+
+            hist_counts[:] = 0
+            for counts, on in zip(source_counts, enabled):
+                if on: np.add(hist_counts, counts, out=hist_counts)
+
+            step_line.set_ydata(hist_counts)
+            if stats_box is not None:
+                stats_box.set_stats_text(stats_text_1d(StatsIndex1D(hist_counts=hist_counts, hist_bins=hist_bins, mode="fast")))
+
+            fig.canvas.draw_idle()
+
+    ax.figure.canvas.mpl_connect('key_press_event', on_key)
 
 def fit_background(background_markers, hist_counts, hist_bin_centers, background_lines:list, ax):
     
@@ -108,22 +211,31 @@ def fit_background(background_markers, hist_counts, hist_bin_centers, background
         return None, None
     
     background_pos = get_marker_positions(background_markers)
-    background_y_values = [hist_counts[np.argmin(np.abs(hist_bin_centers - pos))] for pos in background_pos]
-    
-    background_model = LinearModel()
-    background_result = background_model.fit(background_y_values, x=background_pos)
+    background_result, background_model = fit_linear_background(background_pos, hist_counts, hist_bin_centers)
 
     background_x_values = np.linspace(background_pos[0], background_pos[-1], 1000)
     background_values = background_result.eval(x=background_x_values)
     
     background_line = ax.plot(background_x_values, background_values, color='green', linewidth=0.5)
+    animated(background_line[0])
     background_lines.append(background_line[0])
         
     return background_result, background_model, background_line[0]
 
+@profiling.profiled("fit.background")
+def fit_linear_background(background_pos, hist_counts, hist_bin_centers): # fits a line through the counts of the bins closest to the positions
+    from lmfit.models import LinearModel
+    
+    background_y_values = [hist_counts[np.argmin(np.abs(hist_bin_centers - pos))] for pos in background_pos]
+    
+    background_model = LinearModel()
+    background_result = background_model.fit(background_y_values, x=background_pos)
+    
+    return background_result, background_model
+
 def initial_gaussian_parameters(hist_data, hist_bin_centers, peak_positions, position_uncertainty): # estimates the initital fit parameters
     
-    hist_bin_width = (hist_data[1] - hist_data[0])
+    hist_bin_width = abs(hist_bin_centers[1] - hist_bin_centers[0])
     
     if len(peak_positions) == 0: # if there are no peak markers, guess the center is at the max value and append that value to the list
         peak_positions.append(hist_bin_centers[np.argmax(hist_data)])
@@ -160,13 +272,12 @@ def initial_gaussian_parameters(hist_data, hist_bin_centers, peak_positions, pos
 
     return initial_parameters
 
+@profiling.profiled("fit.lmfit")
 def fit_multiple_gaussians(hist_data, hist_bin_centers, peak_positions, initial_parameters):
+    from lmfit.models import GaussianModel
     
-    hist_bin_width = abs(hist_bin_centers[1]-hist_bin_centers[0])
     # Initialize the list of Gaussian models and their parameters
     gaussian_models = []
-    initial_parameters = initial_gaussian_parameters(hist_data=hist_data, hist_bin_centers=hist_bin_centers, 
-                                                        peak_positions=peak_positions, position_uncertainty=3*hist_bin_width)
     # Loop over the peak_positions and create Gaussian models and parameters
     for i, peak_position in enumerate(peak_positions):
         gauss = GaussianModel(prefix=f'g{i}_')
@@ -196,7 +307,50 @@ def fit_multiple_gaussians(hist_data, hist_bin_centers, peak_positions, initial_
     
     return result, composite_model
       
+@profiling.profiled("fit.region")
+def fit_region(hist_counts, hist_bin_centers, region, peak_positions, background_result, backend: str = "lmfit", objective: str = "chi2", cache: FitCache = None):
+    # lmfit backend: fits Gaussians to the background subtracted counts in the region (least squares)
+    # fast backend: fits Gaussians and the line together to the counts in the region, starting from the background fit (see fast_fit.py)
+    # cache: returns an identical previous fit or starts from the nearest one (see fit_cache.py)
+    
+    if backend not in ("lmfit", "fast"):
+        raise ValueError(f"Unknown fit backend '{backend}', expected 'lmfit' or 'fast'.")
+    
+    hist_bin_width = abs(hist_bin_centers[1] - hist_bin_centers[0])
+    
+    fit_range = (hist_bin_centers >= region[0]) & (hist_bin_centers <= region[1])
+    
+    background = (background_result.params['slope'].value, background_result.params['intercept'].value)
+    hist_counts_subtracted = hist_counts - background_result.eval(x=hist_bin_centers)
+    
+    initial_parameters = initial_gaussian_parameters(hist_data=hist_counts_subtracted[fit_range], hist_bin_centers=hist_bin_centers[fit_range], 
+                                                     peak_positions=peak_positions, position_uncertainty=3*hist_bin_width)
+    
+    if cache is not None:
+        key = fit_key(hist_counts[fit_range], hist_bin_centers[fit_range], region, peak_positions, background, backend, objective)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        
+        signature = (backend, objective, tuple(region), tuple(peak_positions))
+        previous = cache.nearest(signature)
+        if previous is not None:
+            initial_parameters = warm_start_parameters(initial_parameters, previous)
+    
+    if backend == "fast":
+        result = fit_gaussians_fast(hist_counts=hist_counts[fit_range], hist_bin_centers=hist_bin_centers[fit_range], initial_parameters=initial_parameters,
+                                    background=background, objective=objective)
+        model = result.model
+    else:
+        result, model = fit_multiple_gaussians(hist_data=hist_counts_subtracted[fit_range], hist_bin_centers=hist_bin_centers[fit_range], peak_positions=peak_positions, initial_parameters=initial_parameters)
+    
+    if cache is not None:
+        cache.put(key, signature, result, model)
+    
+    return result, model
+      
 def gaussian_result_formatted(result, hist_bin_width, prefix, name, print_table=False):
+    from tabulate import tabulate
     
     # Get the center, amplitude, sigma, and FWHM for each Gaussian
     center_value = result.params[f'{prefix}center'].value
@@ -243,8 +397,9 @@ def gaussian_result_formatted(result, hist_bin_width, prefix, name, print_table=
 
     return fit_result
 
-def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure, plt.Axes)):
+def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure, plt.Axes), fit_backend: str = "lmfit", fit_objective: str = "chi2"):
     fig, ax = subplot
+    set_interactive_keymaps()
     
     hist_bin_centers = (hist_bins[:-1] + hist_bins[1:]) / 2
     hist_bin_width = (hist_bins[1] - hist_bins[0])
@@ -259,6 +414,9 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
     temp_fits = {}
     stored_fits = {}
     
+    fit_cache = FitCache() # repeated 'f' presses reuse or warm-start from the previous fits
+    blit = blit_manager(fig) # the markers and fit lines are blitted over the histogram
+    
     
     
     def show_keybindings_help(): # Function to display the keybindings help
@@ -278,7 +436,7 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
             },
             'P': {
                 'description': "Auto peak finder",
-                'note': "Trys to find all the peaks between the region markers",
+                'note': "Trys to find all the peaks between the region markers (4 sigma above the background)",
             },
             '-': {
                 'description': "Remove all markers and temp fits",
@@ -298,12 +456,20 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
             },
             'S': {
                 'description': "Save fits to file",
-                'note': "Saves the stored fits to a ASCII (user must input the file name)",
+                'note': "Appends the stored fits to a fit store file (user must input the file name)",
             },
             'L': {
                 'description': "Load fits from file",
                 'note': "",
             },
+            't': {
+                'description': "Toggle a source (detector) in the summed histogram",
+                'note': "Only when histo1d is called with a list of series and keep_sources=True. User has to input the source index in the terminal",
+            },
+            'i': {
+                'description': "Print the profiling summary",
+                'note': "Stage timings recorded since ACHist.profiling.enable() (or with ACHIST_PROFILE=1)",
+            },
             'space-bar': {
                 'description': "Show keybindings help",
                 'note': "",
@@ -327,21 +493,24 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
             if event.key == ' ': # display the help cheat sheet
                 show_keybindings_help()
                 
+            if event.key == 'i': # profiling summary
+                profiling.print_summary()
+                
             if event.key == 'r': # region markers 
                 if len(region_markers) >= 2:
                     print(f"{Fore.BLUE}Removed region markers{Style.RESET_ALL}")
                     remove_lines(region_markers)  # If two lines are present, remove them from the plot and the list
                                     
                 place_line_marker(event.xdata, ax, region_markers, color='blue')
-                fig.canvas.draw()
+                blit.update()
 
             if event.key == 'b': # background markers
                 place_line_marker(event.xdata, ax, background_markers, color='green')
-                fig.canvas.draw()
+                blit.update()
 
             if event.key == 'p': # peak markers
                 place_line_marker(event.xdata, ax, peak_markers, color='purple')
-                fig.canvas.draw()
+                blit.update()
                     
             if event.key == '_': # remove all markers and temp fits
                 remove_lines(region_markers)
@@ -350,7 +519,7 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
                 remove_lines(background_lines)
                 remove_lines(fit_lines)
                 temp_fits.clear()
-                fig.canvas.draw()
+                blit.update()
             
             if event.key == '-': # remove the closest marker to cursor in axes
                 remove_lines(background_lines)
@@ -358,12 +527,12 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
                 temp_fits.clear()
                 remove_nearest_marker(event, region_markers, background_markers, peak_markers)
 
-                fig.canvas.draw()   
+                blit.update()   
                            
             if event.key == 'B':  # fit background
                 remove_lines(background_lines)
-                background_result, background_model, background_line = fit_background(background_markers, hist_counts, hist_bin_centers, background_lines)
-                fig.canvas.draw()
+                background_result, background_model, background_line = fit_background(background_markers, hist_counts, hist_bin_centers, background_lines, ax)
+                blit.update()
                 
             if event.key == 'P': # auto fit peaks 
                 if len(region_markers) != 2:
@@ -373,26 +542,20 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
                     remove_lines(peak_markers)
                     
                     region_markers_pos = get_marker_positions(region_markers)
-                    
-                    fit_range = (hist_bin_centers >= region_markers_pos[0]) & (hist_bin_centers <= region_markers_pos[1])
-                    
-                    if not background_markers: # if no background markers/fit estimate the background at the region markers
-                        remove_lines(background_lines)
-                        background_result, background_model, background_line = fit_background(region_markers, hist_counts, hist_bin_centers, background_lines, ax)
-                    else:
-                        remove_lines(background_lines)
-                        background_result, background_model, background_line = fit_background(background_markers, hist_counts, hist_bin_centers, background_lines, ax)
 
-                    hist_counts_subtracted = hist_counts - background_result.eval(x=hist_bin_centers)
+                    # peaks significant above the SNIP background (see peak_search), searched around the region markers only.
+                    # The linear background of the markers is not used by the search, it is fitted by 'f'
+                    from .peak_search import search_region_peaks
+                    try:
+                        found = search_region_peaks(hist_counts, hist_bins, region=region_markers_pos)["position"].to_numpy()
+                    except ValueError as error:
+                        print(f"{Fore.RED}{Style.BRIGHT}{error}{Style.RESET_ALL}")
+                        found = np.array([])
                     
-                    peak_find_hist = hist_counts_subtracted[fit_range]
-                    peak_find_hist_bin_centers = hist_bin_centers[fit_range]
-                    peaks, _ = find_peaks(x=peak_find_hist, height=np.max(peak_find_hist)*0.05, threshold=0.05)
-                    
-                    for peak in peak_find_hist_bin_centers[peaks]:
+                    for peak in found:
                         place_line_marker(position=peak, ax=ax, markers=peak_markers, color='purple')
                         
-                    fig.canvas.draw()
+                    blit.update()
                            
             if event.key == 'f':  # Fit Gaussians to region
                 remove_lines(background_lines)
@@ -407,14 +570,12 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
                     # removes peak markers that are not in between the region markers
                     peak_positions = []
                     for marker in peak_markers:
-                        if region_markers_pos[0] < marker.get_xdata()[0] < region_markers_pos[1]:
+                        if region_markers_pos[0] <= marker.get_xdata()[0] <= region_markers_pos[1]:
                             peak_positions.append(marker.get_xdata()[0])
                     peak_positions.sort()
                     
                     remove_lines(peak_markers)
 
-                    fit_range = (hist_bin_centers >= region_markers_pos[0]) & (hist_bin_centers <= region_markers_pos[1])
-
                     if not background_markers: # if no background markers/fit estimate the background at the region markers
                         remove_lines(background_lines)
                         background_result, background_model, background_line = fit_background(region_markers, hist_counts, hist_bin_centers, background_lines, ax)
@@ -422,18 +583,19 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
                         remove_lines(background_lines)
                         background_result, background_model, background_line = fit_background(background_markers, hist_counts, hist_bin_centers, background_lines, ax)
 
-                    hist_counts_subtracted = hist_counts - background_result.eval(x=hist_bin_centers)
-                    
                     # try:
                     
-                    initial_parameters = initial_gaussian_parameters(hist_data=hist_counts_subtracted[fit_range], hist_bin_centers=hist_bin_centers[fit_range], 
-                                                                     peak_positions=peak_positions, position_uncertainty=3*hist_bin_width)
+                    result, composite_model = fit_region(hist_counts=hist_counts, hist_bin_centers=hist_bin_centers, region=region_markers_pos,
+                                                         peak_positions=peak_positions, background_result=background_result,
+                                                         backend=fit_backend, objective=fit_objective, cache=fit_cache)
                     
-                    result, composite_model = fit_multiple_gaussians(hist_data=hist_counts_subtracted[fit_range], hist_bin_centers=hist_bin_centers[fit_range], peak_positions=peak_positions, initial_parameters=initial_parameters)
+                    if fit_backend == "fast": # the background was fitted together with the Gaussians
+                        background_result = result.background
                     
                     # plot result on top of the background
                     total_x = np.linspace(region_markers_pos[0], region_markers_pos[1],2000)
                     fit_p_background_line = ax.plot(total_x, result.eval(x=total_x) + background_result.eval(x=total_x), color='blue', linewidth=0.5) 
+                    animated(fit_p_background_line[0])
                     fit_lines.append(fit_p_background_line[0])
                     
                     print(f"{Fore.GREEN}{Style.BRIGHT}Fit Report{Style.RESET_ALL}")
@@ -454,10 +616,10 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
                         fit_results.append(gaussian_result_formatted(result=result, hist_bin_width=hist_bin_width, prefix=prefix, name=i))
 
                         fit_line_comp = ax.plot(x_comp, components[prefix], color='blue', linewidth=0.5)  # Gaussian without background
-                        fit_lines.append(fit_line_comp[0])
+                        fit_lines.append(animated(fit_line_comp[0]))
                         
                         fit_line_comp_p_background = ax.plot(x_comp, components[prefix]+ background_result.eval(x=x_comp), color='blue', linewidth=0.5)  # Gaussian and background
-                        fit_lines.append(fit_line_comp_p_background[0])
+                        fit_lines.append(animated(fit_line_comp_p_background[0]))
 
                         place_line_marker(position=result.params[f'{prefix}center'].value, ax=ax, markers=peak_markers, color='purple')
                         
@@ -465,6 +627,7 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
                     headers = ["Gaussian", "Position", "Volume", "FWHM", "Relative Width [%]"]
 
                     # Print the table
+                    from tabulate import tabulate
                     table = tabulate(fit_results, headers, tablefmt="pretty")
                     print(table)
                             
@@ -477,10 +640,12 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
                         "background_model": background_model,
                         "background_result": background_result,
                         "background_line": background_line,
-                        "fit_p_background_line": fit_p_background_line[0]
+                        "fit_p_background_line": fit_p_background_line[0],
+                        "backend": fit_backend,
+                        "objective": fit_objective,
                     }
                         
-                    fig.canvas.draw()
+                    blit.update()
                         
                     # except:
                     #         print(f"{Fore.RED}{Style.BRIGHT}\n⚠ Fit Failed ⚠\n{Style.RESET_ALL}")
@@ -493,65 +658,33 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
                     
                     for i, fit in enumerate(stored_fits[fit_id]["fit_lines"]):
                         stored_fits[fit_id]["fit_lines"][i].set_color('m')
-                        ax.add_line(stored_fits[fit_id]["fit_lines"][i])
+                        animated(ax.add_line(stored_fits[fit_id]["fit_lines"][i]))
                         
                     stored_fits[fit_id]["background_line"].set_color('m')
-                    ax.add_line(stored_fits[fit_id]["background_line"])
+                    animated(ax.add_line(stored_fits[fit_id]["background_line"]))
                     
                     stored_fits[fit_id]["fit_p_background_line"].set_color('m')
-                    ax.add_line(stored_fits[fit_id]["fit_p_background_line"])
+                    animated(ax.add_line(stored_fits[fit_id]["fit_p_background_line"]))
                     
 
-                fig.canvas.draw()
+                blit.update()
                 
             if event.key == "S":  # Save fits to file
                 if stored_fits:
-                    formatted_results = {}  # Initialize a dictionary to store combined results
-                    for fit_id, fit_data in stored_fits.items():
-                        model_filename = f'temp_{fit_id}_model.sav'
-                        background_model_filename = f'temp_{fit_id}_background_model.sav'
-                        result_filename = f'temp_{fit_id}_result.sav'
-                        background_result_filename = f'temp_{fit_id}_background_result.sav'
-
-                        # Save model, background model, fit result, and background result
-                        save_model(fit_data["fit_model"], model_filename)
-                        save_model(fit_data["background_model"], background_model_filename)
-                        save_modelresult(fit_data["fit_result"], result_filename)
-                        save_modelresult(fit_data["background_result"], background_result_filename)
-
-                        # Extract fit parameters and calculate volume
-                        fit_params = fit_data["fit_result"].params
-                        fit_parameters = {}
-                        for param_name, param_value in fit_params.items():
-                            fit_parameters[param_name] = param_value.value
-                            fit_parameters[f"{param_name}_uncertainty"] = param_value.stderr
-
-                        # fit_parameters["volume"] = fit_params['amplitude'].value / hist_bin_width
-                        # fit_parameters["volume_uncertainty"] = fit_params['amplitude'].stderr / hist_bin_width
-
-                        
-                        # Append the saved contents to the formatted_results dictionary
-                        formatted_results[fit_id] = {
-                            "fit_parameters": fit_parameters,
-                            "region_markers": fit_data["region_markers"],
-                            "fit_model": open(model_filename, 'r').read(),
-                            "background_model": open(background_model_filename, 'r').read(),
-                            "fit_result": open(result_filename, 'r').read(),
-                            "background_result": open(background_result_filename, 'r').read()
-                        }
-
-                        # Remove the temporary files
-                        os.remove(model_filename)
-                        os.remove(background_model_filename)
-                        os.remove(result_filename)
-                        os.remove(background_result_filename)
-
                     filename = input(f"{Fore.YELLOW}{Style.BRIGHT}Enter a filename to save the fits to: {Style.RESET_ALL}")
                     
-                    # Save the formatted_results dictionary to a new file
-                    with open(f"{filename}", "w") as output_file:
-                        output_file.write(str(formatted_results))
-                    print(f"{Fore.GREEN}{Style.BRIGHT}Saved fits to file: {filename} {Style.RESET_ALL}")
+                    # the fits are appended to the store, fits already saved to this file are skipped
+                    fit_store = FitStore(filename)
+                    saved = 0
+                    for fit_id, fit_data in stored_fits.items():
+                        if filename in fit_data.setdefault("saved_to", set()):
+                            continue
+                        fit_store.append(result=fit_data["fit_result"], background_result=fit_data["background_result"], region=fit_data["region_markers"],
+                                         backend=fit_data.get("backend", "lmfit"), objective=fit_data.get("objective", "chi2"), name=fit_id)
+                        fit_data["saved_to"].add(filename)
+                        saved += 1
+                        
+                    print(f"{Fore.GREEN}{Style.BRIGHT}Saved {saved} fits to file: {filename} ({len(fit_store)} fits stored){Style.RESET_ALL}")
                 else:
                     print(f"{Fore.RED}{Style.BRIGHT}No fits to save{Style.RESET_ALL}")
                     
@@ -559,89 +692,52 @@ def interactive_1DHistogram_fitting(hist_counts, hist_bins, subplot: (plt.figure
                 filename = input(f"{Fore.YELLOW}{Style.BRIGHT}Enter the filename to load fits from: {Style.RESET_ALL}")
                 
                 if os.path.exists(f"{filename}"):
-                    with open(f"{filename}", "r") as input_file:
-                        loaded_fits = eval(input_file.read())
+                    fit_store = FitStore(filename)
+                    fit_ids = fit_store.ids()
+                    
+                    for fit_id in fit_ids:
+                        print('Fit id: ',fit_id)
+                        stored_fit = fit_store.load(fit_id)
+                        loaded_fit_result = stored_fit.result
+                        loaded_fit_background_result = loaded_fit_result.background
+                        loaded_region_markers = stored_fit.region
                         
-                        for fit_id, fit_data in loaded_fits.items():
-                            print('Fit id: ',fit_id)
-                            model_filename = f'temp_{fit_id}_model.sav'
-                            background_model_filename = f'temp_{fit_id}_background_model.sav'
-                            result_filename = f'temp_{fit_id}_result.sav'
-                            background_result_filename = f'temp_{fit_id}_background_result.sav'
-                            
-                            # Save model and result data to temporary files
-                            with open(model_filename, "w") as temp_file:
-                                temp_file.write(f"{fit_data['fit_model']}")
-                            with open(background_model_filename, "w") as temp_file:
-                                temp_file.write(f"{fit_data['background_model']}")
-                            with open(result_filename, "w") as temp_file:
-                                temp_file.write(f"{fit_data['fit_result']}")
-                            with open(background_result_filename, "w") as temp_file:
-                                temp_file.write(f"{fit_data['background_result']}")
-                            
-                            # Load model and result data from temporary files
-                            loaded_fit_model = load_model(model_filename)
-                            loaded_fit_background_model = load_model(background_model_filename)
-                            loaded_fit_result = load_modelresult(result_filename)
-                            loaded_fit_background_result = load_modelresult(background_result_filename)
-                            
-                            # Clean up: delete the temporary files
-                            os.remove(model_filename)
-                            os.remove(background_model_filename)
-                            os.remove(result_filename)
-                            os.remove(background_result_filename)
-                            
-                            loaded_region_markers = fit_data['region_markers']
-                            
-                            
-                            loaded_total_x = np.linspace(loaded_region_markers[0], loaded_region_markers[1], 2000)
-                            loaded_fit_p_background_line = ax.plot(loaded_total_x, loaded_fit_result.eval(x=loaded_total_x) + loaded_fit_background_result.eval(x=loaded_total_x), color='blue', linewidth=0.5) 
-                            loaded_fit_background_line = ax.plot(loaded_total_x, loaded_fit_background_result.eval(x=loaded_total_x), 'green', linewidth=0.5)
+                        loaded_total_x = np.linspace(loaded_region_markers[0], loaded_region_markers[1], 2000)
+                        loaded_fit_p_background_line = ax.plot(loaded_total_x, loaded_fit_result.eval(x=loaded_total_x) + loaded_fit_background_result.eval(x=loaded_total_x), color='blue', linewidth=0.5) 
+                        loaded_fit_background_line = ax.plot(loaded_total_x, loaded_fit_background_result.eval(x=loaded_total_x), 'green', linewidth=0.5)
+                        animated(loaded_fit_p_background_line[0])
+                        animated(loaded_fit_background_line[0])
+                        
+                        for i in np.arange(loaded_fit_result.model.n_peaks):
                             
+                            prefix = f"g{i}_"
                             
-                            # Get the parameter names
-                            param_names = loaded_fit_result.params.keys()
-
-                            # Initialize a set to collect unique prefixes
-                            unique_prefixes = set()
-
-                            # Iterate through parameter names and extract prefixes
-                            for param_name in param_names:
-                                # Split the parameter name by '_' to get the prefix
-                                parts = param_name.split('_')
-                                
-                                if len(parts) > 1:
-                                    # Add the prefix to the set
-                                    unique_prefixes.add(parts[0])
-
-                            for i, pre in  enumerate(unique_prefixes):
-                                
-                                prefix = f"{pre}_"
-                                
-                                sigma_plot_width = 4
-                                loaded_x_comp = np.linspace(loaded_fit_result.params[f'{prefix}center'].value - sigma_plot_width * loaded_fit_result.params[f'{prefix}sigma'].value,
-                                                            loaded_fit_result.params[f'{prefix}center'].value + sigma_plot_width * loaded_fit_result.params[f'{prefix}sigma'].value, 1000)
-                                                            
-                                loaded_components = loaded_fit_result.eval_components(x=loaded_x_comp)
-                                
-                                loaded_fit_line_comp_p_background = ax.plot(loaded_x_comp, loaded_components[prefix]+ loaded_fit_background_result.eval(x=loaded_x_comp), color='red', linewidth=0.5)  # Gaussian and background
-                                fit_lines.append(loaded_fit_line_comp_p_background[0])
+                            sigma_plot_width = 4
+                            loaded_x_comp = np.linspace(loaded_fit_result.params[f'{prefix}center'].value - sigma_plot_width * loaded_fit_result.params[f'{prefix}sigma'].value,
+                                                        loaded_fit_result.params[f'{prefix}center'].value + sigma_plot_width * loaded_fit_result.params[f'{prefix}sigma'].value, 1000)
+                                                        
+                            loaded_components = loaded_fit_result.eval_components(x=loaded_x_comp)
                             
-                            temp_fit_id = f"temp_fit_{len(temp_fits)}"
-                            temp_fits[temp_fit_id] = {
-                                "region_markers": loaded_region_markers,
-                                "fit_model": loaded_fit_model,
-                                "fit_result": loaded_fit_result,
-                                "fit_lines": fit_lines,
-                                "background_model": loaded_fit_background_model,
-                                "background_result": loaded_fit_background_result,
-                                "background_line": loaded_fit_background_line[0],
-                                "fit_p_background_line": loaded_fit_p_background_line[0]
-                            }
-
-                            fig.canvas.draw()
+                            loaded_fit_line_comp_p_background = ax.plot(loaded_x_comp, loaded_components[prefix]+ loaded_fit_background_result.eval(x=loaded_x_comp), color='red', linewidth=0.5)  # Gaussian and background
+                            fit_lines.append(animated(loaded_fit_line_comp_p_background[0]))
                         
-                        print(f"{Fore.GREEN}{Style.BRIGHT}Loaded {len(loaded_fits)} fits from file: {filename}{Style.RESET_ALL}")
+                        temp_fit_id = f"temp_fit_{len(temp_fits)}"
+                        temp_fits[temp_fit_id] = {
+                            "region_markers": loaded_region_markers,
+                            "fit_model": loaded_fit_result.model,
+                            "fit_result": loaded_fit_result,
+                            "fit_lines": fit_lines,
+                            "background_model": None,
+                            "background_result": loaded_fit_background_result,
+                            "background_line": loaded_fit_background_line[0],
+                            "fit_p_background_line": loaded_fit_p_background_line[0],
+                            "backend": stored_fit.record["backend"],
+                            "objective": stored_fit.record["objective"],
+                        }
+
+                    blit.update()
+                    
+                    print(f"{Fore.GREEN}{Style.BRIGHT}Loaded {len(fit_ids)} fits from file: {filename}{Style.RESET_ALL}")
                                 
     ax.figure.canvas.mpl_connect('key_press_event', on_key)
     
@@ -653,6 +749,7 @@ def remove_lines(lines): # removes axvlines from an array
 def place_line_marker(position, ax, markers, color): # places a axvline 
     line = ax.axvline(position, color=color, linewidth=0.5)
     line.set_antialiased(False)
+    animated(line)
     markers.append(line)
     
     return 
@@ -4,14 +4,22 @@ import numpy as np
 from matplotlib.widgets import PolygonSelector
 import matplotlib.colors as colors
 from colorama import Fore, Style
-from .cut import CutHandler, write_cut_json
-from .histo1d_tools import histo1d
+from .cut import CutHandler, write_cut_json, gate_mask
+from .histogram_cache import histogram_key, source_files
+from .histo1d_tools import histo1d, set_interactive_keymaps
+from .stats import SummedAreaTable2D, WindowStats2D, LimitsText
+from .binning import fill_histo2d_sources, fill_histo2d_compact, fill_histo2d_sparse, bin_edges, is_uniform, count_dtype as compact_count_dtype
+from .pyramid import HistogramPyramid, PyramidImage, pyramid_base_factor
+from .histogram import Histogram2D, snap_to_edges
+from .sparse import SparseHistogram2D, CountsImage, sparse_from_bins, sparse_from_dense
+from .blit import blit_manager, animated
+from . import profiling
 
 def histo2d(
         xdata: list,
-        ydata: list,
-        bins: list,
-        range: list,
+        ydata: list = None,
+        bins: list = None,
+        range: list = None,
         title: str = None,
         xlabel: str = None,
         ylabel: str = None,
@@ -19,32 +27,146 @@ def histo2d(
         display_stats: bool = True,
         cmap: str = None,
         cbar: bool = True,
+        projection_mode: str = "edges",
+        pyramid: bool = False,
+        max_base_bins: int = 8192,
+        memory_budget: float = 512e6,
+        workers: int = None,
+        cuts=None,
+        cache=None,
+        source: str = None,
+        count_dtype=None,
+        storage: str = "dense",
         ):
 
-        if isinstance(xdata, pl.Series): # checks if xdata is a polars series
-            x_data = xdata.to_numpy()
-            xcolumn_name = ydata.name
-            
-        if isinstance(ydata, pl.Series): # checks if xdata is a polars series
-            y_data = ydata.to_numpy()
-            ycolumn_name = ydata.name
-        
-        if isinstance(xdata, list): # if xdata is a list of polars series
-            # Concatenate the arrays horizontally to get the final result
-            x_data = np.concatenate([data.to_numpy() for data in xdata])
-            xcolumn_name = '_'.join([item.name for item in xdata])
+        # cuts: (cut, x, y) or a list of them (see cut.gate_mask), only the events inside all the cuts are filled
+        # cache/source: see histo1d, with the pyramid the base histogram is cached
+        # count_dtype: None keeps int64 counts, "auto" (or a starting unsigned dtype such as np.uint16) stores the counts
+        # in the smallest unsigned dtype that holds them, promoted while filling when a bin would overflow
+        # storage: "dense" matrix or "sparse" (SparseHistogram2D, only the non-empty bins, uniform bins only), which is
+        # returned in place of the matrix
+
+        if storage not in ("dense", "sparse"):
+            raise ValueError(f"Unknown storage '{storage}', expected 'dense' or 'sparse'.")
+        if count_dtype is not None and not (isinstance(count_dtype, str) and count_dtype == "auto") and np.dtype(count_dtype).kind != "u":
+            raise TypeError(f"count_dtype must be None, 'auto' or an unsigned integer dtype, got {count_dtype}.")
+        sparse = storage == "sparse"
+        if sparse and pyramid:
+            raise ValueError("The pyramid needs a dense matrix, it cannot be combined with sparse storage.")
+
+        if isinstance(xdata, (Histogram2D, SparseHistogram2D)): # already filled (e.g. by a HistogramQuery), projections use the counts
+            if pyramid:
+                raise ValueError("The pyramid needs the raw data, it cannot be built from a filled Histogram2D.")
+            hist, x_edges, y_edges = (xdata if isinstance(xdata, SparseHistogram2D) else xdata.counts), xdata.x_edges, xdata.y_edges
+            if sparse and not isinstance(hist, SparseHistogram2D):
+                hist = sparse_from_dense(hist, x_edges, y_edges, x_name=xdata.x_name, y_name=xdata.y_name)
+            elif not sparse and isinstance(hist, SparseHistogram2D):
+                hist = hist.to_dense()
+            if count_dtype is not None and not sparse:
+                hist = hist.astype(compact_count_dtype(int(hist.max(initial=0)))) # the counts are known, no need to promote
+            xcolumn_name, ycolumn_name = xdata.x_name, xdata.y_name
+            x_data = y_data = masks = None
+            bins = [len(x_edges) - 1, len(y_edges) - 1]
+            if range is None: range = [[x_edges[0], x_edges[-1]], [y_edges[0], y_edges[-1]]]
+            projection_mode = "edges"
+        else:
+            # xdata and ydata: polars series or lists of series, or a DataFrame of the two columns (x, y) as xdata
+            if isinstance(xdata, pl.DataFrame) and ydata is None:
+                if xdata.width != 2:
+                    raise ValueError(f"A DataFrame as xdata must have exactly two columns (x, y), got {xdata.columns}.")
+                xdata, ydata = xdata.to_series(0), xdata.to_series(1)
+            if ydata is None:
+                raise ValueError("histo2d needs ydata, or xdata as a Histogram2D or a DataFrame of two columns (x, y).")
+            for name, data in (("xdata", xdata), ("ydata", ydata)):
+                if not (isinstance(data, pl.Series) or (isinstance(data, list) and data and all(isinstance(item, pl.Series) for item in data))):
+                    raise TypeError(f"{name} must be a polars Series or a list of them, got {type(data).__name__}.")
+            if isinstance(xdata, list) != isinstance(ydata, list) or (isinstance(xdata, list) and len(xdata) != len(ydata)):
+                raise ValueError("xdata and ydata must both be a Series or lists of the same number of Series.")
+            if bins is None:
+                raise ValueError("histo2d needs bins=(x_bins, y_bins) to fill the histogram.")
+
+            # the data is kept as a list of sources (one per series), they are filled one by one instead of being concatenated
+            with profiling.stage("histo2d.convert") as timing:
+                if isinstance(xdata, pl.Series): # checks if xdata is a polars series
+                    x_data = [xdata.to_numpy()]
+                    xcolumn_name = xdata.name
+                
+                if isinstance(ydata, pl.Series): # checks if xdata is a polars series
+                    y_data = [ydata.to_numpy()]
+                    ycolumn_name = ydata.name
             
-        if isinstance(ydata, list): # if xdata is a list of polars series
-            # Concatenate the arrays horizontally to get the final result
-            y_data = np.concatenate([data.to_numpy() for data in ydata])
-            ycolumn_name = '_'.join([item.name for item in ydata])
+                if isinstance(xdata, list): # if xdata is a list of polars series
+                    x_data = [data.to_numpy() for data in xdata]
+                    xcolumn_name = '_'.join([item.name for item in xdata])
+                
+                if isinstance(ydata, list): # if xdata is a list of polars series
+                    y_data = [data.to_numpy() for data in ydata]
+                    ycolumn_name = '_'.join([item.name for item in ydata])
             
-        # x_data = np.hstack([column for column in xdata])
-        # y_data = np.hstack([column for column in ydata])
+                timing.add_bytes(sum(data.nbytes for data in x_data + y_data))
+
+            if sparse and not (is_uniform(bins[0]) and is_uniform(bins[1])):
+                raise ValueError("Sparse storage needs uniform bins (a number of bins per axis), its image is drawn on a regular grid.")
+            if pyramid and not (is_uniform(bins[0]) and is_uniform(bins[1])):
+                raise ValueError("The pyramid needs uniform bins (a number of bins per axis), its levels merge blocks of equal bins.")
+
+            if cuts and (len(x_data) != 1 or len(y_data) != 1):
+                raise ValueError("Cuts can only be applied to a single series or array, not to a list of sources.")
+
+            # The base of the level-of-detail pyramid refines the requested binning by the largest power of two
+            # allowed by max_base_bins (per axis) and memory_budget (bytes), so the requested histogram is one of its levels
+            factor = pyramid_base_factor(bins, max_base_bins=max_base_bins, memory_budget=memory_budget) if pyramid else 1
+            fill_bins = [bins[0] * factor, bins[1] * factor] if pyramid else bins
+
+            cached = None
+            if cache is not None:
+                with profiling.stage("histo2d.cache"):
+                    key = histogram_key("histo2d", (xdata if isinstance(xdata, list) else [xdata]) + (ydata if isinstance(ydata, list) else [ydata]),
+                                        fill_bins, range, cuts=cuts, source=source,
+                                        **({} if count_dtype is None and not sparse else {"storage": storage, "count_dtype": str(count_dtype)}))
+                    cached = cache.get(key)
+
+            masks = None
+            if cuts and (cached is None or projection_mode == "exact"):
+                with profiling.stage("histo2d.gate") as timing:
+                    masks = [gate_mask(cuts)]
+                    timing.add_bytes(masks[0].nbytes)
         
-        hist, x_edges, y_edges = np.histogram2d(x_data, y_data, bins=bins, range=range)
+            # bin once, the counts are rendered directly instead of being re-binned by ax.hist2d
+            with profiling.stage("histo2d.fill") as timing:
+                if cached is not None and sparse:
+                    filled = SparseHistogram2D(cached["indptr"], cached["y_indices"], cached["values"], cached["x_edges"], cached["y_edges"],
+                                               x_name=xcolumn_name, y_name=ycolumn_name)
+                    x_edges, y_edges = filled.x_edges, filled.y_edges
+                elif cached is not None:
+                    filled, x_edges, y_edges = cached["counts"], cached["x_edges"], cached["y_edges"]
+                else:
+                    if sparse:
+                        flat_indices, counts, x_edges, y_edges = fill_histo2d_sparse(x_data, y_data, bins=fill_bins, range=range, workers=workers, masks=masks)
+                        filled = sparse_from_bins(flat_indices, counts, x_edges, y_edges, x_name=xcolumn_name, y_name=ycolumn_name)
+                        arrays = {"indptr": filled.indptr, "y_indices": filled.y_indices, "values": filled.values}
+                    elif count_dtype is not None:
+                        start_dtype = np.uint8 if isinstance(count_dtype, str) else count_dtype
+                        filled, x_edges, y_edges = fill_histo2d_compact(x_data, y_data, bins=fill_bins, range=range, workers=workers, masks=masks, dtype=start_dtype)
+                        arrays = {"counts": filled}
+                    else:
+                        filled, x_edges, y_edges, _ = fill_histo2d_sources(x_data, y_data, bins=fill_bins, range=range, workers=workers, masks=masks)
+                        arrays = {"counts": filled}
+                    if cache is not None:
+                        cache.put(key, {**arrays, "x_edges": x_edges, "y_edges": y_edges}, sources=source_files(source),
+                                  description=f"histo2d {xcolumn_name} {ycolumn_name}")
+
+                if pyramid:
+                    histogram_pyramid = HistogramPyramid(filled, range[0], range[1])
+                    hist = histogram_pyramid.levels[int(np.log2(factor))]
+                    x_edges = bin_edges(bins[0], range[0])
+                    y_edges = bin_edges(bins[1], range[1])
+                else:
+                    hist = filled
+                timing.add_bytes(histogram_pyramid.nbytes if pyramid else hist.nbytes)
 
         fig, ax = (plt.subplots() if subplots is None else subplots)
+        profiling.instrument_figure(fig, "histo2d")
                     
         handler = CutHandler()
         
@@ -53,16 +175,30 @@ def histo2d(
         
         if cmap is None: "viridis"
         
-        h = ax.hist2d(x_data, y_data, bins=bins, range=range, cmap=cmap, norm=colors.LogNorm())
+        if pyramid: # the level and window shown follow the axes limits and size
+            ax.set_xlim(range[0])
+            ax.set_ylim(range[1])
+            mesh = PyramidImage(ax, histogram_pyramid, cmap=cmap, norm=colors.LogNorm())
+            ax.add_image(mesh)
+            mesh.update_view()
+        elif sparse or (hist.dtype.kind == "u" and is_uniform(bins[0]) and is_uniform(bins[1])):
+            # compact counts: the bins in the view are drawn at screen resolution, no float copy of the matrix
+            ax.set_xlim(range[0])
+            ax.set_ylim(range[1])
+            mesh = CountsImage(ax, hist, x_edges, y_edges, cmap=cmap, norm=colors.LogNorm())
+            ax.add_image(mesh)
+            mesh.update_view()
+        else:
+            mesh = ax.pcolormesh(x_edges, y_edges, hist.T, cmap=cmap, norm=colors.LogNorm())
         
-        if cbar: fig.colorbar(h[3], ax=ax)
+        if cbar: fig.colorbar(mesh, ax=ax)
             
         ax.set_xlim(range[0])
         ax.set_ylim(range[1])
         # ax.set_xlabel(xlabel)
         
         ax.set_xlabel(xlabel if xlabel is not None else xcolumn_name)
-        ax.set_xlabel(ylabel if ylabel is not None else ycolumn_name)
+        ax.set_ylabel(ylabel if ylabel is not None else ycolumn_name)
         
         # ax.set_ylabel(ylabel)
         ax.set_title(title)
@@ -71,92 +207,59 @@ def histo2d(
         ax.tick_params(axis='both',which='minor',direction='in',top=True,right=True,left=True,bottom=True,length=2)
         ax.tick_params(axis='both',which='major',direction='in',top=True,right=True,left=True,bottom=True,length=4)
         
-        if display_stats: matplotlib_2DHistogram_stats(ax=ax, xdata=x_data, ydata=y_data, bins=bins)
+        if display_stats: matplotlib_2DHistogram_stats(ax=ax, hist=hist, x_edges=x_edges, y_edges=y_edges)
+
+        histogram = hist if sparse else Histogram2D(hist, x_edges, y_edges, x_name=xcolumn_name, y_name=ycolumn_name)
 
-        interactive_2DHistogram(subplot=(fig,ax), x_data=x_data, y_data=y_data, bins=bins, range=range, selector=selector, handler=handler)
+        if masks is not None: # the exact projections re-bin the gated events, the edges mode only needs the counts
+            x_data, y_data = ([x_data[0][masks[0]]], [y_data[0][masks[0]]]) if projection_mode == "exact" else (None, None)
+
+        interactive_2DHistogram(subplot=(fig,ax), x_data=x_data, y_data=y_data, bins=bins, range=range, selector=selector, handler=handler,
+                                histogram=histogram, projection_mode=projection_mode)
         
         fig.tight_layout()
                 
         return hist, x_edges, y_edges
  
-def matplotlib_2DHistogram_stats(ax, xdata, ydata, bins):
-    
-    x_lims = ax.get_xlim()
-    on_screen_x_data = xdata[(xdata >= x_lims[0]) & (xdata <= x_lims[1])] # Filter the data based on the new x-axis limits
-    
-    y_lims = ax.get_ylim()
-    on_screen_y_data = ydata[(ydata >= y_lims[0]) & (ydata <= y_lims[1])] # Filter the data based on the new x-axis limits
-    
-    summed_data = np.sum(on_screen_x_data) + np.sum(on_screen_y_data)
+def matplotlib_2DHistogram_stats(ax, hist, x_edges, y_edges):
+
+    # the stats are served from a summed-area table of the filled histogram. Compact and sparse counts are summed
+    # in the window instead, the table would be a dense int64 copy of the matrix
+    if isinstance(hist, SparseHistogram2D) or hist.dtype.kind == "u":
+        table = WindowStats2D(hist, x_edges, y_edges)
+    else:
+        with profiling.stage("stats.table_2d") as timing:
+            table = SummedAreaTable2D(hist, x_edges, y_edges)
+            timing.add_bytes(table.table.nbytes)
+    stats_text = stats_text_2d(table)
 
-    # Create the stats box
-    stats = f"Integral: {summed_data:.0f}"
+    # Create the stats box. It refreshes itself when the axes are drawn, so the xlim_changed and
+    # ylim_changed of a single zoom result in one update
     props = dict(boxstyle='round', facecolor='white', alpha=0.5, edgecolor='black')
-    text_box = ax.text(0.95, 0.95, stats, transform=ax.transAxes, fontsize=10, verticalalignment='top', horizontalalignment='right', bbox=props)
-    
-    def on_lims_change(ax):
-        # Get the new x-axis limits
-        x_lims = ax.get_xlim()
+    text_box = LimitsText(0.95, 0.95, "", stats_text=stats_text, transform=ax.transAxes, fontsize=10, verticalalignment='top', horizontalalignment='right', bbox=props)
+    ax.add_artist(text_box)
+    animated(text_box)
 
-        # Get the new y-axis limits
-        y_lims = ax.get_ylim()
-        
-        # Create a mask to filter both x_data and y_data
-        mask = (xdata >= x_lims[0]) & (xdata <= x_lims[1]) & (ydata >= y_lims[0]) & (ydata <= y_lims[1])
+    return text_box
 
-        filtered_x_data = xdata[mask]
-        filtered_y_data = ydata[mask]
-    
-        # Create a new 2D histogram using the filtered data
-        filtered_hist, _, _ = np.histogram2d(filtered_x_data, filtered_y_data, bins=bins, range=[[x_lims[0], x_lims[1]], [y_lims[0], y_lims[1]]])
+def stats_text_2d(table: WindowStats2D): # any object with window(x_lims, y_lims), e.g. a SummedAreaTable2D
 
-        # Calculate the new statistics using the filtered histogram
-        stats = f"Integral: {np.sum(filtered_hist):.0f}"
+    def stats_text(x_lims, y_lims):
+        integral, (x_mean, x_std), (y_mean, y_std) = table.window(x_lims, y_lims)
+        return f"Integral: {integral:.0f}\nX Mean: {x_mean:.2f}\nX Std Dev: {x_std:.2f}\nY Mean: {y_mean:.2f}\nY Std Dev: {y_std:.2f}"
 
-        # Update the text of the stats box
-        text_box.set_text(stats)
-        ax.figure.canvas.draw()
+    return stats_text
 
-    # Connect the on_lims_change function to the 'xlim_changed' event
-    ax.callbacks.connect('xlim_changed', on_lims_change)
-    ax.callbacks.connect('ylim_changed', on_lims_change)
-  
-def get_x_projection_data(xdata, ydata, xmarkers):
-    if len(xmarkers) < 2: 
-        return print(f"{Fore.RED}{Style.BRIGHT}Must have two lines!{Style.RESET_ALL}")
-    else:
-        y_coordinates = []
-        for line in xmarkers:
-            y_coordinate = line.get_ydata()[0] 
-            y_coordinates.append(y_coordinate)
-        y_coordinates.sort() 
-        
-        y_mask = (ydata >= y_coordinates[0]) & (ydata <= y_coordinates[1])
-            
-        x_projection_data = xdata[y_mask]
-        
-        return x_projection_data, y_coordinates
-    
-def get_y_projection_data(xdata, ydata, ymarkers):
-    if len(ymarkers) < 2: 
-        print(f"{Fore.RED}{Style.BRIGHT}Must have two lines!{Style.RESET_ALL}")
-        
-    else:
-        x_coordinates = []
-        for line in ymarkers:
-            x_coordinate = line.get_xdata()[0]  # Assuming the line is vertical and has only one x-coordinate
-            x_coordinates.append(x_coordinate)
-        x_coordinates.sort() 
-        
-        x_mask = (xdata >= x_coordinates[0]) & (xdata <= x_coordinates[1])
-            
-        y_projection_data = ydata[x_mask]
-        
-        return y_projection_data, x_coordinates
-        
-def interactive_2DHistogram(subplot: (plt.figure, plt.Axes), x_data, y_data, bins, range, selector, handler):
+def interactive_2DHistogram(subplot: (plt.figure, plt.Axes), x_data, y_data, bins, range, selector, handler, histogram: Histogram2D = None, projection_mode: str = "edges"):
+    # Projections are summed from the filled histogram. With projection_mode="edges" the markers snap to the
+    # bin edges, with "exact" the bins cut by the markers are refined from the raw data.
+    if histogram is None:
+        hist, x_edges, y_edges, _ = fill_histo2d_sources(x_data if isinstance(x_data, list) else [x_data], y_data if isinstance(y_data, list) else [y_data], bins=bins, range=range)
+        histogram = Histogram2D(hist, x_edges, y_edges)
 
     fig, ax = subplot
+    set_interactive_keymaps()
+    blit = blit_manager(fig) # the projection lines are blitted over the histogram
 
     # Keep track of the added lines for the x and y projections
     y_markers = []
@@ -191,6 +294,10 @@ def interactive_2DHistogram(subplot: (plt.figure, plt.Axes), x_data, y_data, bin
                 'note': "User has to input the filename in the terminal (e.g. cut.json)",
             },
 
+            'i': {
+                'description': "Print the profiling summary",
+                'note': "Stage timings recorded since ACHist.profiling.enable() (or with ACHIST_PROFILE=1)",
+            },
             'space-bar': {
                 'description': "Show keybindings help",
                 'note': "",
@@ -211,6 +318,9 @@ def interactive_2DHistogram(subplot: (plt.figure, plt.Axes), x_data, y_data, bin
             
             if event.key == ' ': # display the help cheat sheet
                 show_keybindings_help()
+                
+            if event.key == 'i': # profiling summary
+                profiling.print_summary()
         
             if event.key == 'y': # For drawing lines to do a y-projection
                 # Check if there are already two lines present
@@ -221,16 +331,22 @@ def interactive_2DHistogram(subplot: (plt.figure, plt.Axes), x_data, y_data, bin
                     y_markers.clear()
                 
                 x_coord = event.xdata
+                if projection_mode == "edges": x_coord = histogram.x_edges[snap_to_edges(histogram.x_edges, x_coord, x_coord)[0]]
                 line = ax.axvline(x_coord, color='red')
-                y_markers.append(line)
+                y_markers.append(animated(line))
 
-                fig.canvas.draw()
+                blit.update()
                 
             if event.key == 'Y': # For showing the y-projection
                 
-                y_projection_data, x_coordinates = get_y_projection_data(xdata=x_data, ydata=y_data, ymarkers=y_markers)
-                histo1d(xdata=y_projection_data, bins=bins[1], range=range[1], title=f"Y-Projection: {round(x_coordinates[0], 2)} to {round(x_coordinates[1], 2)}")
-                plt.show()
+                if len(y_markers) < 2:
+                    print(f"{Fore.RED}{Style.BRIGHT}Must have two lines!{Style.RESET_ALL}")
+                else:
+                    x_coordinates = sorted([line.get_xdata()[0] for line in y_markers])
+                    with profiling.stage("histo2d.projection"):
+                        y_projection, x_gate = histogram.project_y(x_coordinates[0], x_coordinates[1], mode=projection_mode, x_data=x_data, y_data=y_data)
+                    histo1d(xdata=y_projection, title=f"Y-Projection: {round(x_gate[0], 2)} to {round(x_gate[1], 2)}")
+                    plt.show()
                     
             if event.key == 'x': # For drawing lines to do a x-projection
                 # Check if there are already two lines present
@@ -241,16 +357,22 @@ def interactive_2DHistogram(subplot: (plt.figure, plt.Axes), x_data, y_data, bin
                     x_markers.clear()
                 
                 y_coord = event.ydata
+                if projection_mode == "edges": y_coord = histogram.y_edges[snap_to_edges(histogram.y_edges, y_coord, y_coord)[0]]
                 line = ax.axhline(y_coord, color='green')
-                x_markers.append(line)
+                x_markers.append(animated(line))
 
-                fig.canvas.draw()
+                blit.update()
                 
             if event.key == 'X': # For showing the X-projection
                 
-                x_projection_data, y_coordinates = get_x_projection_data(xdata=x_data, ydata=y_data, xmarkers=x_markers)
-                histo1d(xdata=x_projection_data, bins=bins[0], range=range[0], title=f"X-Projection: {round(y_coordinates[0], 2)} to {round(y_coordinates[1], 2)}")
-                plt.show()
+                if len(x_markers) < 2:
+                    print(f"{Fore.RED}{Style.BRIGHT}Must have two lines!{Style.RESET_ALL}")
+                else:
+                    y_coordinates = sorted([line.get_ydata()[0] for line in x_markers])
+                    with profiling.stage("histo2d.projection"):
+                        x_projection, y_gate = histogram.project_x(y_coordinates[0], y_coordinates[1], mode=projection_mode, x_data=x_data, y_data=y_data)
+                    histo1d(xdata=x_projection, title=f"X-Projection: {round(y_gate[0], 2)} to {round(y_gate[1], 2)}")
+                    plt.show()
                     
             if event.key == 'c': # create a cut
 
@@ -276,4 +398,4 @@ def interactive_2DHistogram(subplot: (plt.figure, plt.Axes), x_data, y_data, bin
                 except Exception as e:
                     print(f"{Fore.RED}Error: {e}. Failed to save the cut to '{Style.RESET_ALL}'.")
                     
-    ax.figure.canvas.mpl_connect('key_press_event', on_press)
\ No newline at end of file
+    ax.figure.canvas.mpl_connect('key_press_event', on_press)
\ No newline at end of file
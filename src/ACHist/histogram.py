@@ -0,0 +1,103 @@
+import numpy as np
+from .binning import fill_histo1d, as_array
+
+"""
+Filled 1D histogram (counts and bin edges). Can be passed to histo1d in place of the raw data, in which case
+the plot, stats box (bin-centre moments) and fitting all work from the counts.
+"""
+class Histogram1D:
+    def __init__(self, counts: np.ndarray, edges: np.ndarray, name: str = ""):
+        if len(edges) != len(counts) + 1:
+            raise ValueError(f"Expected {len(counts) + 1} bin edges for {len(counts)} bins, got {len(edges)}.")
+
+        self.counts = counts
+        self.edges = edges
+        self.name = name
+
+    @property
+    def centers(self) -> np.ndarray:
+        return (self.edges[:-1] + self.edges[1:]) / 2
+
+    @property
+    def range(self) -> tuple:
+        return (self.edges[0], self.edges[-1])
+
+"""
+Filled 2D histogram. counts[i, j] holds the events in x bin i and y bin j. Projections are sums over
+the rows/columns of the matrix, so they cost O(bins) and never touch the raw events, unless the exact
+mode is asked for, in which case the events in the two bins cut by the gate are re-binned from the raw data.
+"""
+class Histogram2D:
+    def __init__(self, counts: np.ndarray, x_edges: np.ndarray, y_edges: np.ndarray, x_name: str = "", y_name: str = ""):
+        if counts.shape != (len(x_edges) - 1, len(y_edges) - 1):
+            raise ValueError(f"Counts of shape {counts.shape} do not match {len(x_edges) - 1}x{len(y_edges) - 1} bins.")
+
+        self.counts = counts
+        self.x_edges = x_edges
+        self.y_edges = y_edges
+        self.x_name = x_name
+        self.y_name = y_name
+
+    def project_x(self, y_low: float, y_high: float, mode: str = "edges", x_data=None, y_data=None):
+        # X-projection of the events between y_low and y_high, returns the projection and the applied gate
+        counts, gate = project(self.counts, self.x_edges, self.y_edges, y_low, y_high, mode, x_data, y_data)
+        return Histogram1D(counts, self.x_edges, name=self.x_name), gate
+
+    def project_y(self, x_low: float, x_high: float, mode: str = "edges", x_data=None, y_data=None):
+        # Y-projection of the events between x_low and x_high, returns the projection and the applied gate
+        counts, gate = project(self.counts.T, self.y_edges, self.x_edges, x_low, x_high, mode, y_data, x_data)
+        return Histogram1D(counts, self.y_edges, name=self.y_name), gate
+
+def snap_to_edges(edges: np.ndarray, low: float, high: float): # indices of the bin edges closest to the gate
+    low, high = sorted((low, high))
+
+    def nearest_edge(value):
+        index = np.clip(np.searchsorted(edges, value), 1, len(edges) - 1)
+        return index - 1 if value - edges[index - 1] <= edges[index] - value else index
+
+    return nearest_edge(low), nearest_edge(high)
+
+def matrix_column_sum(counts: np.ndarray, start: int, stop: int) -> np.ndarray:
+    # compact unsigned counts are summed as int64, so projections of any count dtype add up with partial bins and fits
+    return counts[:, start:stop].sum(axis=1, dtype=np.int64 if counts.dtype.kind == "u" else None)
+
+def project(counts, edges, gate_edges, low, high, mode, data, gate_data):
+    # Sums counts[:, start:stop] over the gated axis, counts is the matrix or a function returning that sum (e.g. of a
+    # sparse histogram). Returns the projected counts and the gate that was applied.
+    column_sum = counts if callable(counts) else lambda start, stop: matrix_column_sum(counts, start, stop)
+    low, high = sorted((low, high))
+
+    if mode == "edges": # gate snapped to the nearest bin edges, pure matrix sum
+        start, stop = snap_to_edges(gate_edges, low, high)
+        return column_sum(start, stop), (gate_edges[start], gate_edges[stop])
+
+    if mode != "exact":
+        raise ValueError(f"Unknown projection mode '{mode}', expected 'edges' or 'exact'.")
+
+    if data is None or gate_data is None:
+        raise ValueError("The exact projection mode needs the raw x and y data.")
+
+    # bins fully inside the gate come from the matrix, the (at most two) bins cut by the gate from the raw events
+    low = max(low, gate_edges[0])
+    high = min(high, gate_edges[-1])
+    if low > high:
+        return column_sum(0, 0), (low, high)
+
+    n_bins = len(gate_edges) - 1
+    first_bin = min(np.searchsorted(gate_edges, low, side='right') - 1, n_bins - 1)
+    last_bin = min(np.searchsorted(gate_edges, high, side='right') - 1, n_bins - 1)
+
+    projection = column_sum(first_bin + 1, max(last_bin, first_bin + 1))
+
+    # the raw data can be a list of sources (one array per detector)
+    sources = zip(data, gate_data) if isinstance(data, list) else [(data, gate_data)]
+
+    for source_data, source_gate_data in sources:
+        source_data = as_array(source_data)
+        source_gate_data = as_array(source_gate_data)
+        in_partial_bins = (source_gate_data >= low) & (source_gate_data <= high) & ((source_gate_data < gate_edges[first_bin + 1]) | (source_gate_data >= gate_edges[last_bin]))
+
+        partial_counts, _ = fill_histo1d(source_data[in_partial_bins], bins=edges, range=(edges[0], edges[-1]))
+        projection = projection + partial_counts
+
+    return projection, (low, high)
@@ -0,0 +1,243 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+from .binning import as_array
+
+# On-disk cache of filled histograms, so re-running a notebook does not re-bin spectra that did not change.
+# Every entry is a directory of .npy files (counts, edges, ...) that are memory-mapped when read back, and the
+# cache directory holds an index.json with the size, last use and source files of every entry. The key is a
+# hash of everything the counts depend on: the identity of the source (path, size and modification time of
+# every file of a parquet path/glob), a digest of the values of every series or array (so a series of a filtered
+# frame does not share the key of the full column), the columns, the bins and range, the filter expressions and
+# the cuts. A modified source file therefore gives a new key. When the cache grows above max_bytes
+# the least recently used entries are removed. invalidate() drops the entries of a source, clear() all of them.
+# Every read-modify-write of the index holds an index.lock file, so several threads or processes can share a directory.
+#
+#   cache = HistogramCache("histogram_cache", max_bytes=2e9)
+#   histo1d(df["Energy"], bins=4096, range=(0, 4096), cache=cache, source="run_*.parquet")
+#   counts, edges = stream_histo1d("run_*.parquet", "Energy", bins=4096, range=(0, 4096), cache=cache)
+
+DEFAULT_CACHE_BYTES = 1 << 30
+LOCK_TIMEOUT = 60.0 # seconds after which the index lock of a crashed process is broken
+
+"""
+Lock of the index of a cache directory, shared by the threads and processes using the directory. The lock is a
+file created exclusively (portable, no fcntl/msvcrt), the index is read, modified and written while holding it,
+so concurrent writers never drop each other's entries.
+"""
+class IndexLock:
+    def __init__(self, path: str):
+        self.path = path
+        self.descriptor = None
+
+    def __enter__(self):
+        while True:
+            try:
+                self.descriptor = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > LOCK_TIMEOUT:
+                        os.remove(self.path) # left behind by a process that died while holding it
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.001)
+
+    def __exit__(self, *exc_info):
+        os.close(self.descriptor)
+        os.remove(self.path)
+        return False
+
+def file_identity(path) -> list:
+    # [path, size, modification time] of every file of a path or glob, in sorted order
+    paths = sorted(glob.glob(os.fspath(path))) if glob.has_magic(os.fspath(path)) else [os.fspath(path)]
+    if not paths or not all(os.path.exists(file) for file in paths):
+        raise FileNotFoundError(f"The source '{path}' does not exist.")
+    return [[os.path.abspath(file), os.stat(file).st_size, os.stat(file).st_mtime_ns] for file in paths]
+
+def data_digest(data) -> str: # digest of the values of a series/array, for data that is not tied to a file
+    data = np.ascontiguousarray(as_array(data))
+    return hashlib.blake2b(memoryview(data).cast("B"), digest_size=16).hexdigest() + f":{data.dtype.str}:{len(data)}"
+
+def column_identity(data, source=None):
+    # a column name of a known source file is identified by the files and the name (the whole column is read).
+    # A series or array is always identified by its values: a series taken from a filtered or sliced frame
+    # has the name of the column but not its values, with a source the files are kept in the key as well
+    if isinstance(data, str):
+        if source is None:
+            raise ValueError(f"The column '{data}' can only be identified with the source it is read from.")
+        return {"source": file_identity(source), "column": data}
+    if source is not None:
+        return {"source": file_identity(source), "column": getattr(data, "name", ""), "digest": data_digest(data)}
+    return {"digest": data_digest(data)}
+
+def binning_identity(bins, range):
+    # json form of bins (number or edges) and range, also for nested (2D) bins and ranges
+    def plain(value):
+        if value is None or np.ndim(value) == 0:
+            return None if value is None else float(value)
+        return [plain(item) for item in value]
+    return {"bins": plain(bins), "range": plain(range)}
+
+def cut_identity(cuts, source=None):
+    # vertices of the cuts (cut files are read, so a modified cut file gives a new key) and the columns they act on
+    from .cut import load_cut_cached
+
+    if not cuts:
+        return None
+    if isinstance(cuts, tuple):
+        cuts = [cuts]
+
+    identity = []
+    for cut, x, y in cuts:
+        if isinstance(cut, str):
+            cut = load_cut_cached(cut)
+        columns = [x, y] if isinstance(x, str) else [column_identity(x, source), column_identity(y, source)]
+        identity.append({"vertices": np.asarray(cut.get_vertices(), dtype=np.float64).tolist(), "columns": columns})
+    return identity
+
+def cache_key(**parts) -> str:
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode(), digest_size=20).hexdigest()
+
+def histogram_key(kind: str, columns: list, bins, range, cuts=None, source=None, **options) -> str:
+    # key of a histogram filled from the columns (series/arrays, x sources first for 2D) of source
+    return cache_key(kind=kind, columns=[column_identity(column, source) for column in columns], cuts=cut_identity(cuts, source),
+                     **binning_identity(bins, range), **options)
+
+def source_key(kind: str, source, columns: list[str], bins, range, **options) -> str:
+    # key of a histogram of the full named columns of a parquet path/glob (files and column names) or of a
+    # DataFrame (values of the columns, the same key as histo1d/histo2d give for these series)
+    if isinstance(source, (str, os.PathLike)):
+        return histogram_key(kind, columns, bins, range, source=source, **options)
+    if hasattr(source, "get_column"): # DataFrame, identified by the values of the columns
+        return histogram_key(kind, [source.get_column(column) for column in columns], bins, range, **options)
+    raise TypeError("The histogram cache needs a parquet path/glob or a DataFrame as source, the data of a LazyFrame cannot be identified.")
+
+class HistogramCache:
+    def __init__(self, directory: str = ".histogram_cache", max_bytes: float = DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, "index.json")
+
+    def read_index(self) -> dict: # key -> {"bytes", "last_used", "sources", "description"}
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path, "r") as index_file:
+            return json.load(index_file)
+
+    def write_index(self, index: dict):
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, "w") as index_file:
+            json.dump(index, index_file, indent=1)
+        os.replace(temporary_path, self.index_path) # readers never see a partly written index
+
+    def locked(self) -> IndexLock: # hold it around every read-modify-write of the index
+        return IndexLock(os.path.join(self.directory, "index.lock"))
+
+    def entry_directory(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def __len__(self):
+        return len(self.read_index())
+
+    def __contains__(self, key: str):
+        return key in self.read_index()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(entry["bytes"] for entry in self.read_index().values())
+
+    def get(self, key: str) -> dict:
+        # arrays of an entry, memory-mapped copy-on-write (they can be modified in memory, the files are not), or None
+        with self.locked():
+            index = self.read_index()
+            if key not in index or not os.path.isdir(self.entry_directory(key)):
+                self.misses += 1
+                return None
+
+            arrays = {}
+            for name in index[key]["arrays"]:
+                arrays[name] = np.load(os.path.join(self.entry_directory(key), f"{name}.npy"), mmap_mode="c")
+
+            index[key]["last_used"] = time.time()
+            self.write_index(index)
+        self.hits += 1
+        return arrays
+
+    def put(self, key: str, arrays: dict, sources: list = None, description: str = ""):
+        # stores the arrays under key, sources are the files the entry depends on (used by invalidate)
+        directory = self.entry_directory(key)
+        os.makedirs(directory, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, f"{name}.npy"), np.asarray(array))
+
+        with self.locked(): # the index is read again under the lock, entries added meanwhile by other writers are kept
+            index = self.read_index()
+            index[key] = {
+                "arrays": list(arrays),
+                "bytes": int(sum(np.asarray(array).nbytes for array in arrays.values())),
+                "last_used": time.time(),
+                "sources": [os.path.abspath(source) for source in sources or []],
+                "description": description,
+            }
+            self.evict(index, keep=key)
+            self.write_index(index)
+
+    def evict(self, index: dict, keep: str = None):
+        # removes the least recently used entries until the cache fits in max_bytes (the entry just stored is kept)
+        total = sum(entry["bytes"] for entry in index.values())
+        for key in sorted(index, key=lambda key: index[key]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= index[key]["bytes"]
+            self.remove_entry(index, key)
+
+    def remove_entry(self, index: dict, key: str):
+        shutil.rmtree(self.entry_directory(key), ignore_errors=True)
+        del index[key]
+
+    def remove(self, key: str) -> bool:
+        with self.locked():
+            index = self.read_index()
+            if key not in index:
+                return False
+            self.remove_entry(index, key)
+            self.write_index(index)
+        return True
+
+    def invalidate(self, source=None) -> int:
+        # drops the entries that depend on the files of source (path or glob), or every entry, returns how many
+        paths = None
+        if source is not None:
+            paths = {file for file, _, _ in file_identity(source)} if glob.has_magic(os.fspath(source)) or os.path.exists(source) else {os.path.abspath(source)}
+
+        with self.locked():
+            index = self.read_index()
+            keys = list(index) if paths is None else [key for key, entry in index.items() if paths & set(entry["sources"])]
+            for key in keys:
+                self.remove_entry(index, key)
+            self.write_index(index)
+        return len(keys)
+
+    def clear(self) -> int:
+        return self.invalidate()
+
+    def entries(self) -> list[dict]: # index of the entries, most recently used first
+        index = self.read_index()
+        return [{"key": key, **entry} for key, entry in sorted(index.items(), key=lambda item: -item[1]["last_used"])]
+
+def source_files(source) -> list[str]: # files of a path/glob source, [] for in-memory data
+    return [file for file, _, _ in file_identity(source)] if source is not None else []
@@ -0,0 +1,192 @@
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.colors as colors
+from matplotlib.widgets import PolygonSelector
+from .binning import fill_histo1d, fill_histo2d, as_array
+from .histogram import Histogram1D, Histogram2D
+from .stats import StatsIndex1D, SummedAreaTable2D
+from .cut import CutHandler
+from .histo1d_tools import matplotlib_1DHistogram_stats, stats_text_1d, interactive_1DHistogram_fitting
+from .histo2d_tools import matplotlib_2DHistogram_stats, stats_text_2d, interactive_2DHistogram
+from . import profiling
+
+# Histograms that grow while the data is taken. fill() bins a new batch of events into the counts right
+# away, but the plot (step line or image, y/colour limits, stats box) is refreshed at most redraw_rate times
+# per second, so the filling is not slowed down by matplotlib. The counts are updated in place and shared
+# with the fitting/projection key handlers, which therefore always work on the current counts.
+# Call refresh(force=True) after the last batch to show the final counts.
+
+class LiveRedraw:
+    def __init__(self, fig: plt.Figure, redraw_rate: float = 5.0):
+        # redraw_rate: maximum redraws per second, None redraws after every batch
+        self.fig = fig
+        self.redraw_rate = redraw_rate
+        self.last_redraw = -np.inf
+        self.redraw_time = 0.0
+        self.redraws = 0
+        self.entries = 0
+
+    def due(self) -> bool:
+        # a slow figure is redrawn less often, so that drawing takes at most about a fifth of the time
+        if self.redraw_rate is None:
+            return True
+        return time.perf_counter() - self.last_redraw >= max(1 / self.redraw_rate, 4 * self.redraw_time)
+
+    @profiling.profiled("live.redraw")
+    def redraw(self):
+        start = time.perf_counter()
+        self.fig.canvas.draw_idle()
+        self.fig.canvas.flush_events() # lets an interactive backend process the draw and key events between batches
+        self.last_redraw = time.perf_counter()
+        self.redraw_time = self.last_redraw - start
+        self.redraws += 1
+
+"""
+Live 1D histogram with the plot, stats box and fitting keys of histo1d.
+"""
+class LiveHistogram1D(LiveRedraw):
+    def __init__(
+        self,
+        bins: int,
+        range: list,
+        subplots: (plt.figure, plt.Axes) = None,
+        xlabel: str = None,
+        ylabel: str = None,
+        label: str = None,
+        title: str = None,
+        color: str = None,
+        linestyle: str = None,
+        linewidth: float = None,
+        display_stats: bool = True,
+        redraw_rate: float = 5.0,
+        workers: int = None,
+        fit_backend: str = "lmfit",
+        fit_objective: str = "chi2",
+        ):
+
+        self.bins, self.range, self.workers = bins, range, workers
+        self.counts, self.edges = fill_histo1d(np.empty(0), bins=bins, range=range)
+        self.histogram = Histogram1D(self.counts, self.edges, name=xlabel if xlabel is not None else "")
+
+        fig, ax = (plt.subplots() if subplots is None else subplots)
+        super().__init__(fig, redraw_rate)
+        self.ax = ax
+
+        self.step_line = ax.step(self.edges[:-1], self.counts, where='post', label=label, linewidth=0.5 if linewidth is None else linewidth, color=color, linestyle=linestyle)[0]
+        ax.set_xlim(range)
+        ax.set_ylim(0, 1)
+        ax.set_xlabel(xlabel if xlabel is not None else "")
+        ax.set_ylabel(ylabel if ylabel is not None else "Counts")
+        if title is not None: ax.set_title(title)
+        ax.legend() if label is not None else None
+
+        ax.minorticks_on()
+        ax.tick_params(axis='both',which='minor',direction='in',top=True,right=True,left=True,bottom=True,length=2)
+        ax.tick_params(axis='both',which='major',direction='in',top=True,right=True,left=True,bottom=True,length=4)
+
+        self.stats_box = matplotlib_1DHistogram_stats(ax=ax, data=None, bins=bins, mode="fast", hist_counts=self.counts, hist_bins=self.edges) if display_stats else None
+
+        interactive_1DHistogram_fitting(hist_counts=self.counts, hist_bins=self.edges, subplot=(fig,ax), fit_backend=fit_backend, fit_objective=fit_objective)
+
+        fig.tight_layout()
+
+    @profiling.profiled("live.fill_1d")
+    def fill(self, data): # bins a batch of events (array or polars series), returns True when the plot was refreshed
+        data = as_array(data)
+        batch_counts, _ = fill_histo1d(data, bins=self.bins, range=self.range, workers=self.workers)
+        np.add(self.counts, batch_counts, out=self.counts)
+        self.entries += len(data)
+        return self.refresh()
+
+    def refresh(self, force: bool = False) -> bool:
+        if not (force or self.due()):
+            return False
+
+        self.step_line.set_ydata(self.counts)
+        top = self.counts.max(initial=0)
+        if top >= self.ax.get_ylim()[1]: # grow the y-axis in steps so it does not change on every redraw
+            self.ax.set_ylim(0, top * 1.5)
+        if self.stats_box is not None:
+            self.stats_box.set_stats_text(stats_text_1d(StatsIndex1D(hist_counts=self.counts, hist_bins=self.edges, mode="fast")))
+
+        self.redraw()
+        return True
+
+"""
+Live 2D histogram with the image, colour bar, stats box and projection/cut keys of histo2d. Projections are
+made from the current counts (projection_mode="edges", the events are not kept).
+"""
+class LiveHistogram2D(LiveRedraw):
+    def __init__(
+        self,
+        bins: list,
+        range: list,
+        title: str = None,
+        xlabel: str = None,
+        ylabel: str = None,
+        subplots: (plt.figure, plt.Axes) = None,
+        display_stats: bool = True,
+        cmap: str = None,
+        cbar: bool = True,
+        redraw_rate: float = 5.0,
+        workers: int = None,
+        ):
+
+        self.bins, self.range, self.workers = bins, range, workers
+        self.counts, self.x_edges, self.y_edges = fill_histo2d(np.empty(0), np.empty(0), bins=bins, range=range)
+        self.histogram = Histogram2D(self.counts, self.x_edges, self.y_edges,
+                                     x_name=xlabel if xlabel is not None else "", y_name=ylabel if ylabel is not None else "")
+
+        fig, ax = (plt.subplots() if subplots is None else subplots)
+        super().__init__(fig, redraw_rate)
+        self.ax = ax
+
+        handler = CutHandler()
+        selector = PolygonSelector(ax, onselect=handler.onselect)
+        selector.set_active(False)
+
+        if np.ndim(bins[0]) == 0 and np.ndim(bins[1]) == 0: # uniform bins are drawn as an image, much faster to redraw than a mesh
+            self.mesh = ax.imshow(self.counts.T, origin='lower', interpolation='nearest', aspect='auto', cmap=cmap, norm=colors.LogNorm(vmin=1, vmax=1),
+                                  extent=(self.x_edges[0], self.x_edges[-1], self.y_edges[0], self.y_edges[-1]))
+        else:
+            self.mesh = ax.pcolormesh(self.x_edges, self.y_edges, self.counts.T, cmap=cmap, norm=colors.LogNorm(vmin=1, vmax=1))
+        if cbar: fig.colorbar(self.mesh, ax=ax)
+
+        ax.set_xlim(range[0])
+        ax.set_ylim(range[1])
+        ax.set_xlabel(xlabel if xlabel is not None else "")
+        ax.set_ylabel(ylabel if ylabel is not None else "")
+        ax.set_title(title)
+
+        ax.minorticks_on()
+        ax.tick_params(axis='both',which='minor',direction='in',top=True,right=True,left=True,bottom=True,length=2)
+        ax.tick_params(axis='both',which='major',direction='in',top=True,right=True,left=True,bottom=True,length=4)
+
+        self.stats_box = matplotlib_2DHistogram_stats(ax=ax, hist=self.counts, x_edges=self.x_edges, y_edges=self.y_edges) if display_stats else None
+
+        interactive_2DHistogram(subplot=(fig,ax), x_data=None, y_data=None, bins=bins, range=range, selector=selector, handler=handler,
+                                histogram=self.histogram, projection_mode="edges")
+
+        fig.tight_layout()
+
+    @profiling.profiled("live.fill_2d")
+    def fill(self, x_data, y_data): # bins a batch of events, returns True when the plot was refreshed
+        x_data, y_data = as_array(x_data), as_array(y_data)
+        batch_counts, _, _ = fill_histo2d(x_data, y_data, bins=self.bins, range=self.range, workers=self.workers)
+        np.add(self.counts, batch_counts, out=self.counts)
+        self.entries += len(x_data)
+        return self.refresh()
+
+    def refresh(self, force: bool = False) -> bool:
+        if not (force or self.due()):
+            return False
+
+        if hasattr(self.mesh, "set_data"): self.mesh.set_data(self.counts.T)
+        else: self.mesh.set_array(self.counts.T)
+        self.mesh.set_clim(1, max(self.counts.max(initial=0), 1))
+        if self.stats_box is not None:
+            self.stats_box.set_stats_text(stats_text_2d(SummedAreaTable2D(self.counts, self.x_edges, self.y_edges)))
+
+        self.redraw()
+        return True
@@ -0,0 +1,192 @@
+import numpy as np
+import polars as pl
+from .histogram import Histogram1D
+from .batch_fit import fit_peaks_batch, FIT_RESULT_SCHEMA
+
+# Automatic peak search and fitting of a whole spectrum, without markers:
+#
+#  1. the continuum under the peaks is estimated with the SNIP algorithm (iterative clipping of the counts
+#     against the mean of their neighbours at growing distances, on a log-log-sqrt scale), which follows the
+#     Compton continuum and edges but not peaks narrower than the clipping window
+#  2. the background subtracted spectrum is smoothed with a Gaussian of the peak width (matched filter) and
+#     every local maximum whose significance, smoothed net counts over their Poisson uncertainty, is above
+#     threshold is a peak
+#  3. every peak gets a fit region of +-region_width FWHM, peaks whose regions overlap are one multiplet with a
+#     single region, so the regions are independent
+#  4. the regions are fitted on a process pool by fit_peaks_batch (Gaussians plus a linear background fitted to
+#     bins just outside the region), one row per peak in the returned table
+#
+# The FWHM is the same for the whole spectrum. When it is not given it is estimated as the median width of
+# the most prominent peaks.
+#
+#   peaks = fit_spectrum(Histogram1D(counts, edges), workers=-1)           # search + fit, one row per peak
+#   found = search_peaks(counts, edges, fwhm=2.5, threshold=5)             # search only
+#   found = search_region_peaks(counts, edges, region=(1150, 1350))        # search near a region only ('P' key)
+#   regions = peak_regions(found["position"].to_numpy(), fwhm=2.5)         # (low, high, positions) per multiplet
+
+DEFAULT_THRESHOLD = 4.0 # minimum significance (standard deviations) of a peak
+DEFAULT_REGION_WIDTH = 2.0 # half width of a fit region, in FWHM
+BACKGROUND_BINS = 3 # bins on each side of a region used for its linear background
+MIN_REGION_PADDING = 32 # minimum bins searched on each side of a region by search_region_peaks
+
+PEAK_SEARCH_SCHEMA = {
+    "position": pl.Float64,
+    "bin": pl.Int64,
+    "net_height": pl.Float64,
+    "background": pl.Float64,
+    "significance": pl.Float64,
+}
+
+REGION_SCHEMA = { # columns added to the fit results by fit_spectrum
+    "region_low": pl.Float64,
+    "region_high": pl.Float64,
+    "multiplet": pl.Int64,
+    "search_position": pl.Float64,
+    "significance": pl.Float64,
+}
+
+def spectrum_arrays(histogram, edges=None):
+    # counts and edges of a Histogram1D or of counts and edges arrays
+    if isinstance(histogram, Histogram1D):
+        return np.asarray(histogram.counts, dtype=np.float64), np.asarray(histogram.edges, dtype=np.float64)
+    if edges is None:
+        raise ValueError("The bin edges are needed when the counts are not a Histogram1D.")
+    return np.asarray(histogram, dtype=np.float64), np.asarray(edges, dtype=np.float64)
+
+def snip_background(counts: np.ndarray, width: int) -> np.ndarray:
+    # SNIP continuum (Ryan et al. 1988, Morhac 2009) with clipping windows up to width bins, same length as counts.
+    # The spectrum is extended by its end values, so the bins near the ends are clipped too
+    width = max(int(width), 1)
+    counts = np.pad(np.maximum(np.asarray(counts, dtype=np.float64), 0), width, mode="edge")
+    values = np.log(np.log(np.sqrt(counts + 1) + 1) + 1)
+
+    for distance in np.arange(1, width + 1):
+        neighbours = (values[:-2 * distance] + values[2 * distance:]) / 2
+        np.minimum(values[distance:-distance], neighbours, out=values[distance:-distance])
+
+    return ((np.exp(np.exp(values) - 1) - 1)**2 - 1)[width:-width]
+
+def estimate_fwhm_bins(counts: np.ndarray, n_peaks: int = 10) -> float:
+    # median FWHM, in bins, of the most prominent local maxima
+    from scipy.signal import find_peaks, peak_widths
+
+    peaks, properties = find_peaks(counts, prominence=np.sqrt(np.maximum(counts, 1)).max())
+    if len(peaks) == 0:
+        raise ValueError("No peak found to estimate the FWHM from, give fwhm explicitly.")
+
+    strongest = peaks[np.argsort(properties["prominences"])[::-1][:n_peaks]]
+    widths, *_ = peak_widths(counts, strongest, rel_height=0.5)
+    return float(np.median(widths))
+
+def gaussian_kernel(fwhm_bins: float) -> np.ndarray:
+    sigma = max(fwhm_bins, 1.0) / (2 * np.sqrt(2 * np.log(2)))
+    offsets = np.arange(-int(np.ceil(3 * sigma)), int(np.ceil(3 * sigma)) + 1)
+    kernel = np.exp(-offsets**2 / (2 * sigma**2))
+    return kernel / kernel.sum()
+
+def smooth(values: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    # convolution with the spectrum extended by its end values, same length as values
+    return np.convolve(np.pad(values, len(kernel) // 2, mode="edge"), kernel, mode="valid")
+
+def search_peaks(histogram, edges=None, fwhm: float = None, threshold: float = DEFAULT_THRESHOLD, background_width: float = 3.0, return_background: bool = False):
+    # Peaks of a whole spectrum as a DataFrame (position, bin, net_height, background, significance), by position.
+    # fwhm is in the units of the edges (None estimates it), background_width is the SNIP window in FWHM
+    counts, edges = spectrum_arrays(histogram, edges)
+    bin_width = (edges[-1] - edges[0]) / len(counts)
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    fwhm_bins = estimate_fwhm_bins(counts) if fwhm is None else fwhm / bin_width
+    kernel = gaussian_kernel(fwhm_bins)
+
+    # SNIP of the raw counts follows their downward fluctuations and sits below the continuum, the smoothed
+    # counts give an unbiased background
+    background = snip_background(smooth(counts, kernel), width=int(np.ceil(background_width * fwhm_bins)))
+
+    # matched filter: smoothed net counts and their Poisson standard deviation (the variance of a bin is its counts)
+    net = smooth(counts - background, kernel)
+    deviation = np.sqrt(np.maximum(smooth(np.maximum(counts, 0), kernel**2), 1.0))
+    significance = net / deviation
+
+    from scipy.signal import find_peaks
+    peaks, _ = find_peaks(net, distance=max(int(fwhm_bins / 2), 1))
+    peaks = peaks[significance[peaks] >= threshold]
+
+    found = pl.DataFrame({
+        "position": centers[peaks],
+        "bin": peaks.astype(np.int64),
+        "net_height": (counts - background)[peaks],
+        "background": background[peaks],
+        "significance": significance[peaks],
+    }, schema=PEAK_SEARCH_SCHEMA)
+
+    fwhm = fwhm_bins * bin_width
+    return (found, fwhm, background) if return_background else found
+
+def search_region_peaks(histogram, edges=None, region=None, padding: float = None, **options) -> pl.DataFrame:
+    # search_peaks limited to the peaks between region = (low, high), edges included. Only the bins of the region and
+    # padding (in the units of the edges, default the width of the region, at least MIN_REGION_PADDING bins) on each
+    # side are searched, so the background and FWHM come from the neighbourhood of the region, not the whole spectrum
+    counts, edges = spectrum_arrays(histogram, edges)
+    low, high = sorted(region)
+    bin_width = (edges[-1] - edges[0]) / len(counts)
+
+    start = int(np.clip(np.searchsorted(edges, low, side="right") - 1, 0, len(counts)))
+    stop = int(np.clip(np.searchsorted(edges, high, side="left"), start, len(counts)))
+    pad = max(stop - start if padding is None else int(np.ceil(padding / bin_width)), MIN_REGION_PADDING)
+    start, stop = max(start - pad, 0), min(stop + pad, len(counts))
+
+    found = search_peaks(counts[start:stop], edges[start:stop + 1], **options)
+    return (found.filter((pl.col("position") >= low) & (pl.col("position") <= high))
+            .with_columns(pl.col("bin") + start))
+
+def peak_regions(positions, fwhm: float, region_width: float = DEFAULT_REGION_WIDTH, limits=None) -> list[tuple]:
+    # groups the peaks into independent fit regions: (low, high, positions) per region, peaks closer than
+    # 2 * region_width FWHM share a region (multiplet). limits clips the regions to the spectrum
+    positions = np.sort(np.asarray(positions, dtype=np.float64))
+    half_width = region_width * fwhm
+
+    regions = []
+    for position in positions:
+        if regions and position - half_width <= regions[-1][1]:
+            regions[-1][1] = position + half_width
+            regions[-1][2].append(float(position))
+        else:
+            regions.append([position - half_width, position + half_width, [float(position)]])
+
+    if limits is not None:
+        for region in regions:
+            region[0], region[1] = max(region[0], limits[0]), min(region[1], limits[1])
+
+    return [(float(low), float(high), peaks) for low, high, peaks in regions]
+
+def fit_spectrum(histogram, edges=None, fwhm: float = None, threshold: float = DEFAULT_THRESHOLD, region_width: float = DEFAULT_REGION_WIDTH,
+                 background_width: float = 3.0, workers: int = None, backend: str = "fast", objective: str = "poisson", verbose: bool = True) -> pl.DataFrame:
+    # Searches and fits every peak of the spectrum, returns the fit_peaks_batch table (one row per peak) with the
+    # region, the size of the multiplet and the search results (position, significance) of every peak
+    counts, edges = spectrum_arrays(histogram, edges)
+    name = histogram.name if isinstance(histogram, Histogram1D) else ""
+    bin_width = (edges[-1] - edges[0]) / len(counts)
+
+    found, fwhm, _ = search_peaks(counts, edges, fwhm=fwhm, threshold=threshold, background_width=background_width, return_background=True)
+    regions = peak_regions(found["position"].to_numpy(), fwhm, region_width=region_width, limits=(edges[0], edges[-1]))
+
+    # the linear background of a region is fitted to the BACKGROUND_BINS bins on each side of it
+    outside = np.arange(BACKGROUND_BINS) * bin_width
+    spectrum = Histogram1D(counts, edges, name=name)
+    jobs = [(spectrum, (low, high), peaks, np.clip(np.concatenate([low - outside, high + outside]), edges[0], edges[-1]))
+            for low, high, peaks in regions]
+
+    if not jobs:
+        return pl.DataFrame(schema={**FIT_RESULT_SCHEMA, **REGION_SCHEMA})
+
+    results = fit_peaks_batch(jobs, workers=workers, verbose=verbose, backend=backend, objective=objective)
+
+    significance = dict(zip(found["position"].to_list(), found["significance"].to_list()))
+    searched = pl.DataFrame([
+        dict(job=job, peak=peak, region_low=low, region_high=high, multiplet=len(peaks), search_position=position, significance=significance[position])
+        for job, (low, high, peaks) in enumerate(regions) for peak, position in enumerate(peaks)
+    ], schema={"job": pl.Int64, "peak": pl.Int64, **REGION_SCHEMA})
+
+    # a failed region has a single row without a peak index, it gets the search results of its first peak
+    results = results.with_columns(pl.col("peak").fill_null(0))
+    return results.join(searched, on=["job", "peak"], how="left").sort("search_position")
@@ -0,0 +1,120 @@
+import functools
+import os
+import threading
+import time
+
+# Opt-in timing of the hot paths. When enabled, every instrumented stage (conversion of the columns, binning,
+# rendering, stats boxes, projections, cuts, fits) adds its wall time, call count and the bytes of the arrays
+# it produced to a global table, which can be read with report() or printed with print_summary() (also bound
+# to the 'i' key of the interactive histograms). When disabled a stage costs one flag check.
+#
+#   from ACHist import profiling
+#   profiling.enable()            # or set the environment variable ACHIST_PROFILE=1
+#   histo1d(df["Energy"], bins=4096, range=(0, 4096))
+#   profiling.print_summary()
+
+enabled = os.environ.get("ACHIST_PROFILE", "") not in ("", "0")
+stages = {} # name -> [calls, seconds, bytes]
+lock = threading.Lock() # stages are also recorded from the fill and batch worker threads
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    with lock:
+        stages.clear()
+
+def record(name: str, seconds: float, nbytes: int = 0):
+    with lock:
+        entry = stages.setdefault(name, [0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += nbytes
+
+def snapshot() -> dict: # copy of the table, consistent while other threads record
+    with lock:
+        return {name: list(entry) for name, entry in stages.items()}
+
+class Stage:
+    __slots__ = ("name", "start", "nbytes")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.nbytes = 0
+
+    def add_bytes(self, nbytes: int):
+        self.nbytes += int(nbytes)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start, self.nbytes)
+        return False
+
+class NullStage: # stand-in when profiling is disabled
+    __slots__ = ()
+
+    def add_bytes(self, nbytes: int):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = NullStage()
+
+def stage(name: str): # context manager timing a block, use stage.add_bytes() for the arrays it creates
+    return Stage(name) if enabled else NULL_STAGE
+
+def profiled(name: str): # decorator timing every call of a function
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument_figure(fig, name: str):
+    # times the full draws (rasterization) of a figure as render.<name>, only when profiling is enabled
+    if not enabled or getattr(fig.draw, "profiled", False):
+        return
+
+    draw = fig.draw
+
+    @functools.wraps(draw)
+    def timed_draw(*args, **kwargs):
+        if not enabled:
+            return draw(*args, **kwargs)
+        with Stage(f"render.{name}"):
+            return draw(*args, **kwargs)
+
+    timed_draw.profiled = True
+    fig.draw = timed_draw
+
+def report() -> dict: # {stage: {"calls", "seconds", "bytes"}}
+    return {name: {"calls": calls, "seconds": seconds, "bytes": nbytes} for name, (calls, seconds, nbytes) in snapshot().items()}
+
+def summary_table() -> str:
+    from tabulate import tabulate
+
+    rows = [[name, calls, f"{seconds * 1e3:.2f}", f"{seconds / calls * 1e3:.3f}", f"{nbytes / 1e6:.1f}"]
+            for name, (calls, seconds, nbytes) in sorted(snapshot().items(), key=lambda item: -item[1][1])]
+    return tabulate(rows, ["Stage", "Calls", "Total [ms]", "Per call [ms]", "Arrays [MB]"], tablefmt="pretty")
+
+def print_summary():
+    if not stages:
+        print("No profiling data recorded." + ("" if enabled else " Enable it with ACHist.profiling.enable() or ACHIST_PROFILE=1."))
+        return
+    print(summary_table())
@@ -0,0 +1,103 @@
+import numpy as np
+from matplotlib.image import AxesImage
+from .binning import count_dtype, is_uniform
+
+"""
+Multi-resolution (level-of-detail) pyramid of a 2D histogram. Level 0 is the fine base binning and every
+following level sums 2x2 blocks of the previous one. The image shown on the axes is taken from the finest
+level that still has about one bin per screen pixel in the current view, so zooming in reveals the native
+resolution without re-reading the events and zooming out never draws more bins than there are pixels.
+"""
+class HistogramPyramid:
+    def __init__(self, base: np.ndarray, x_range, y_range):
+
+        self.x_origin, self.y_origin = x_range[0], y_range[0]
+        self.x_width = (x_range[1] - x_range[0]) / base.shape[0]
+        self.y_width = (y_range[1] - y_range[0]) / base.shape[1]
+
+        self.levels = [base]
+        while max(self.levels[-1].shape) > 1:
+            self.levels.append(coarsen(self.levels[-1]))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(level.nbytes for level in self.levels)
+
+    def bin_widths(self, level: int):
+        return self.x_width * 2**level, self.y_width * 2**level
+
+    def level_for(self, x_lims, y_lims, x_pixels: float, y_pixels: float) -> int:
+        # finest level with no more visible bins than pixels along either axis
+        for level in np.arange(len(self.levels)):
+            x_width, y_width = self.bin_widths(level)
+            if abs(x_lims[1] - x_lims[0]) / x_width <= x_pixels and abs(y_lims[1] - y_lims[0]) / y_width <= y_pixels:
+                return int(level)
+        return len(self.levels) - 1
+
+    def window(self, level: int, x_lims, y_lims):
+        # counts of the bins at the given level that overlap the limits, and their extent
+        counts = self.levels[level]
+        x_width, y_width = self.bin_widths(level)
+
+        x_start, x_stop = visible_bins(self.x_origin, x_width, counts.shape[0], x_lims)
+        y_start, y_stop = visible_bins(self.y_origin, y_width, counts.shape[1], y_lims)
+
+        extent = (self.x_origin + x_start * x_width, self.x_origin + x_stop * x_width,
+                  self.y_origin + y_start * y_width, self.y_origin + y_stop * y_width)
+
+        return counts[x_start:x_stop, y_start:y_stop], extent
+
+def coarsen(counts: np.ndarray) -> np.ndarray: # sums 2x2 blocks, odd sizes are padded with empty bins
+    x_bins, y_bins = counts.shape
+    padded = np.zeros((x_bins + x_bins % 2, y_bins + y_bins % 2), dtype=counts.dtype)
+    padded[:x_bins, :y_bins] = counts
+    summed = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).sum(axis=(1, 3))
+    if counts.dtype.kind == "u": # compact counts: numpy sums them as uint64, the level is kept in the smallest dtype holding it
+        return summed.astype(count_dtype(int(summed.max(initial=0))))
+    return summed
+
+def visible_bins(origin: float, width: float, n_bins: int, lims): # [start, stop) of the bins overlapping the limits
+    low, high = sorted(lims)
+    start = int(np.clip(np.floor((low - origin) / width), 0, n_bins - 1))
+    stop = int(np.clip(np.ceil((high - origin) / width), start + 1, n_bins))
+    return start, stop
+
+def pyramid_base_factor(bins, max_base_bins: int, memory_budget: float, itemsize: int = 8) -> int:
+    # largest power of two the requested binning can be refined by within the limits. The pyramid of a
+    # base of n bins takes about 4/3 n of memory.
+    if not (is_uniform(bins[0]) and is_uniform(bins[1])):
+        raise ValueError("The pyramid needs uniform bins (a number of bins per axis), not bin edges.")
+    factor = 1
+    while True:
+        refined = (bins[0] * factor * 2, bins[1] * factor * 2)
+        if max(refined) > max_base_bins or refined[0] * refined[1] * itemsize * 4 / 3 > memory_budget:
+            return factor
+        factor *= 2
+
+"""
+Image of a HistogramPyramid. The displayed level and window are refreshed when the artist is drawn and
+the view (limits or axes size in pixels) changed, so both limit changes of a zoom cause a single update.
+"""
+class PyramidImage(AxesImage):
+    def __init__(self, ax, pyramid: HistogramPyramid, **kwargs):
+        super().__init__(ax, origin='lower', interpolation='nearest', **kwargs)
+        self.pyramid = pyramid
+        self.view = None
+
+    def update_view(self):
+        ax = self.axes
+        view = (tuple(ax.get_xlim()), tuple(ax.get_ylim()), ax.bbox.width, ax.bbox.height)
+        if view == self.view:
+            return
+        self.view = view
+
+        level = self.pyramid.level_for(view[0], view[1], view[2], view[3])
+        counts, extent = self.pyramid.window(level, view[0], view[1])
+
+        self.set_data(counts.T)
+        self.set_extent(extent)
+        self.set_clim(1, max(counts.max(initial=0), 1))
+
+    def draw(self, renderer):
+        self.update_view()
+        super().draw(renderer)
@@ -0,0 +1,174 @@
+import os
+import numpy as np
+import polars as pl
+from .binning import is_uniform, bin_edges
+from .cut import load_cut_cached
+from .histogram_cache import cache_key, file_identity, binning_identity, cut_identity, source_files
+from .histogram import Histogram1D, Histogram2D
+from .stream import scan_source
+from . import profiling
+
+# Histograms filled by polars instead of numpy. The bin of every event is a polars expression following the
+# np.histogram convention (values on an inner edge go to the upper bin, the last edge is inclusive, values
+# outside the range, NaNs and nulls are dropped) and the counts come from a group-by on the bin, so the counts
+# and edges are identical to fill_histo1d/fill_histo2d.
+#
+# All the histograms of a HistogramQuery are collected together: the filters and cuts (as expressions) are
+# pushed down into the scan of the source, the scan shared by the histograms is read once, and the work runs
+# on the polars thread pool. The results are Histogram1D/Histogram2D objects that histo1d/histo2d plot directly.
+#
+#   query = HistogramQuery("run_*.parquet")
+#   query.histo1d("energy", "Energy", bins=4096, range=(0, 4096))
+#   query.histo1d("energy_protons", "Energy", bins=4096, range=(0, 4096), cuts=("proton.json", "E", "dE"))
+#   query.histo2d("pid", "E", "dE", bins=(512, 512), range=[[0, 4096], [0, 2500]], filter=pl.col("Detector") == 3)
+#   histograms = query.collect()
+#   histo1d(histograms["energy_protons"])
+#   histo2d(histograms["pid"])
+#
+# collect(cache=HistogramCache(...)) reads the histograms that were already filled from the cache (the key holds
+# the files of the source, the expressions, the binning, the filter and the cuts) and only runs the others.
+
+def as_expr(column) -> pl.Expr: # column name or expression
+    return pl.col(column) if isinstance(column, str) else column
+
+def column_name(column) -> str:
+    return column if isinstance(column, str) else column.meta.output_name(raise_if_undetermined=False) or ""
+
+def in_range_expr(value: pl.Expr, range) -> pl.Expr: # NaNs compare above every number in polars, so they fail the upper bound
+    return (value >= float(range[0])) & (value <= float(range[1]))
+
+def with_bin_index(lazy_frame: pl.LazyFrame, value: str, edges: np.ndarray, name: str) -> pl.LazyFrame:
+    # adds the bin of the column value (inside the range) as the column name, the last edge belongs to the last bin
+    bins = len(edges) - 1
+    first_edge, last_edge = float(edges[0]), float(edges[-1])
+    step = (last_edge - first_edge) / bins
+    value, index = pl.col(value), pl.col(name)
+
+    if not np.array_equal(edges[:-1], np.arange(bins) * step + first_edge):
+        # non-uniform edges: binary search of the edges
+        return lazy_frame.with_columns((pl.lit(pl.Series(edges)).search_sorted(value, side="right").cast(pl.Int64) - 1).clip(upper_bound=bins - 1).alias(name))
+
+    # uniform edges (np.linspace): the arithmetic and rounding correction of binning.bin_indices, with the inner
+    # edges computed the way linspace does instead of looked up. One step per with_columns, so the index is not
+    # recomputed by every expression that uses it
+    return (lazy_frame
+            .with_columns(((value - first_edge) / (last_edge - first_edge) * bins).cast(pl.Int64).clip(upper_bound=bins - 1).alias(name))
+            .with_columns((index - (value < index.cast(pl.Float64) * step + first_edge).cast(pl.Int64)).alias(name))
+            .with_columns((index + ((value >= (index + 1).cast(pl.Float64) * step + first_edge) & (index != bins - 1)).cast(pl.Int64)).alias(name)))
+
+def histogram_edges(bins, range) -> np.ndarray:
+    if is_uniform(bins):
+        return bin_edges(int(bins), range)
+    return np.asarray(bins, dtype=np.float64) # bin edges, the range is not used (as in np.histogram)
+
+def expr_identity(expr): # json form of a column name or expression, for the cache key
+    if expr is None or isinstance(expr, str):
+        return expr
+    return expr.meta.serialize(format="json")
+
+def histogram_arrays(histogram) -> dict:
+    if isinstance(histogram, Histogram1D):
+        return {"counts": histogram.counts, "edges": histogram.edges}
+    return {"counts": histogram.counts, "x_edges": histogram.x_edges, "y_edges": histogram.y_edges}
+
+def gate_expr(filter: pl.Expr = None, cuts=None) -> pl.Expr:
+    # filter expression and/or cuts given as (cut, x_column, y_column) or a list of them, the cut a Cut2D or a cut file
+    if isinstance(cuts, tuple):
+        cuts = [cuts]
+
+    conditions = [] if filter is None else [filter]
+    for cut, x_column, y_column in cuts or []:
+        if isinstance(cut, str):
+            cut = load_cut_cached(cut)
+        conditions.append(cut.is_expr_inside(x_column, y_column))
+
+    return pl.all_horizontal(conditions) if conditions else None
+
+class HistogramQuery:
+    def __init__(self, source):
+        # source: DataFrame, LazyFrame or parquet path/glob
+        self.source = source
+        self.lazy_frame = scan_source(source)
+        self.histograms = {} # name -> (lazy counts query, function turning the collected counts into a histogram, cache identity, function restoring it from cached arrays)
+
+    def __len__(self):
+        return len(self.histograms)
+
+    def add(self, name: str, counts_query: pl.LazyFrame, build, identity: dict, restore):
+        if name in self.histograms:
+            raise ValueError(f"A histogram named '{name}' is already in the query.")
+        self.histograms[name] = (counts_query, build, identity, restore)
+        return self
+
+    def histo1d(self, name: str, column, bins, range, filter: pl.Expr = None, cuts=None):
+        edges = histogram_edges(bins, range)
+        value = as_expr(column).cast(pl.Float64)
+
+        condition = in_range_expr(value, (edges[0], edges[-1]))
+        gate = gate_expr(filter, cuts)
+        if gate is not None: condition = condition & gate
+
+        counts_query = with_bin_index(self.lazy_frame.filter(condition).select(value.alias("value")), "value", edges, "bin").group_by("bin").len()
+
+        def build(counts_frame: pl.DataFrame) -> Histogram1D:
+            counts = np.zeros(len(edges) - 1, dtype=np.int64)
+            counts[counts_frame["bin"].to_numpy()] = counts_frame["len"].to_numpy()
+            return Histogram1D(counts, edges, name=column_name(column))
+
+        identity = {"kind": "query_histo1d", "column": expr_identity(column), "filter": expr_identity(filter), "cuts": cut_identity(cuts), **binning_identity(bins, range)}
+        restore = lambda arrays: Histogram1D(arrays["counts"], arrays["edges"], name=column_name(column))
+        return self.add(name, counts_query, build, identity, restore)
+
+    def histo2d(self, name: str, xcolumn, ycolumn, bins, range, filter: pl.Expr = None, cuts=None):
+        x_edges = histogram_edges(bins[0], range[0])
+        y_edges = histogram_edges(bins[1], range[1])
+        x_value = as_expr(xcolumn).cast(pl.Float64)
+        y_value = as_expr(ycolumn).cast(pl.Float64)
+        y_bins = len(y_edges) - 1
+
+        condition = in_range_expr(x_value, (x_edges[0], x_edges[-1])) & in_range_expr(y_value, (y_edges[0], y_edges[-1]))
+        gate = gate_expr(filter, cuts)
+        if gate is not None: condition = condition & gate
+
+        counts_query = self.lazy_frame.filter(condition).select(x_value.alias("x"), y_value.alias("y"))
+        counts_query = with_bin_index(with_bin_index(counts_query, "x", x_edges, "x_bin"), "y", y_edges, "y_bin")
+        counts_query = counts_query.group_by((pl.col("x_bin") * y_bins + pl.col("y_bin")).alias("bin")).len()
+
+        def build(counts_frame: pl.DataFrame) -> Histogram2D:
+            counts = np.zeros((len(x_edges) - 1) * y_bins, dtype=np.int64)
+            counts[counts_frame["bin"].to_numpy()] = counts_frame["len"].to_numpy()
+            return Histogram2D(counts.reshape(len(x_edges) - 1, y_bins), x_edges, y_edges, x_name=column_name(xcolumn), y_name=column_name(ycolumn))
+
+        identity = {"kind": "query_histo2d", "columns": [expr_identity(xcolumn), expr_identity(ycolumn)], "filter": expr_identity(filter),
+                    "cuts": cut_identity(cuts), **binning_identity(bins, range)}
+        restore = lambda arrays: Histogram2D(arrays["counts"], arrays["x_edges"], arrays["y_edges"], x_name=column_name(xcolumn), y_name=column_name(ycolumn))
+        return self.add(name, counts_query, build, identity, restore)
+
+    def explain(self) -> str: # optimized plans of the histograms
+        return "\n\n".join(f"{name}:\n{counts_query.explain()}" for name, (counts_query, *_) in self.histograms.items())
+
+    def cache_keys(self) -> dict: # name -> key in a HistogramCache, only for parquet path/glob sources
+        if not isinstance(self.source, (str, os.PathLike)):
+            raise TypeError("Only the histograms of a parquet path/glob source can be cached, the data of a frame cannot be identified by its files.")
+        source = file_identity(self.source)
+        return {name: cache_key(source=source, **identity) for name, (_, _, identity, _) in self.histograms.items()}
+
+    @profiling.profiled("query.collect")
+    def collect(self, engine: str = "auto", cache=None) -> dict:
+        # runs all the histograms (those not in the cache) in one collect_all (common subplans such as the scan are shared)
+        histograms, keys = {}, {}
+        if cache is not None:
+            keys = self.cache_keys()
+            for name, key in keys.items():
+                arrays = cache.get(key)
+                if arrays is not None:
+                    histograms[name] = self.histograms[name][3](arrays)
+
+        names = [name for name in self.histograms if name not in histograms]
+        counts_frames = pl.collect_all([self.histograms[name][0] for name in names], engine=engine) if names else []
+        for name, counts_frame in zip(names, counts_frames):
+            histograms[name] = self.histograms[name][1](counts_frame)
+            if cache is not None:
+                cache.put(keys[name], histogram_arrays(histograms[name]), sources=source_files(self.source), description=f"query {name}")
+
+        return {name: histograms[name] for name in self.histograms}
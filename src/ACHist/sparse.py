@@ -0,0 +1,171 @@
+import numpy as np
+from matplotlib.image import AxesImage
+from .binning import count_dtype
+from .histogram import Histogram1D, project
+from .pyramid import visible_bins
+
+"""
+Sparse 2D histogram for large, mostly empty matrices (e.g. a 4096x4096 gamma-gamma matrix). Only the
+non-empty bins are stored, row by row (CSR): the bins of x bin i are y_indices[indptr[i]:indptr[i + 1]] with
+counts values[...], the counts in the smallest unsigned dtype that holds them. Projections, window stats and
+the image work on this form directly and cost O(non-empty bins), the dense matrix is never built.
+"""
+class SparseHistogram2D:
+    def __init__(self, indptr: np.ndarray, y_indices: np.ndarray, values: np.ndarray, x_edges: np.ndarray, y_edges: np.ndarray,
+                 x_name: str = "", y_name: str = ""):
+        if len(indptr) != len(x_edges):
+            raise ValueError(f"Expected {len(x_edges)} row pointers for {len(x_edges) - 1} x bins, got {len(indptr)}.")
+        if len(y_indices) != len(values) or indptr[-1] != len(values):
+            raise ValueError(f"Got {len(y_indices)} y indices and {len(values)} counts for {indptr[-1]} non-empty bins.")
+
+        self.indptr = indptr
+        self.y_indices = y_indices
+        self.values = values
+        self.x_edges = x_edges
+        self.y_edges = y_edges
+        self.x_name = x_name
+        self.y_name = y_name
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self.x_edges) - 1, len(self.y_edges) - 1)
+
+    @property
+    def nnz(self) -> int: # number of non-empty bins
+        return len(self.values)
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.y_indices.nbytes + self.values.nbytes
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.values.dtype
+
+    def sum(self) -> int:
+        return int(self.values.sum(dtype=np.uint64))
+
+    def max(self, initial: int = 0) -> int:
+        return int(self.values.max(initial=initial))
+
+    def x_indices(self, start: int = 0, stop: int = None) -> np.ndarray: # x bin of the entries of the rows [start, stop)
+        stop = self.shape[0] if stop is None else stop
+        return np.repeat(np.arange(start, stop), np.diff(self.indptr[start:stop + 1]))
+
+    def to_dense(self, dtype=None) -> np.ndarray:
+        counts = np.zeros(self.shape, dtype=dtype or self.values.dtype)
+        counts[self.x_indices(), self.y_indices] = self.values
+        return counts
+
+    def marginals(self, x_start: int, x_stop: int, y_start: int, y_stop: int):
+        # per x bin and per y bin sums of the window [x_start, x_stop) x [y_start, y_stop), as int64
+        entries = slice(self.indptr[x_start], self.indptr[max(x_stop, x_start)])
+        x_indices = self.x_indices(x_start, max(x_stop, x_start)) - x_start
+        y_indices = self.y_indices[entries].astype(np.int64) - y_start
+        values = self.values[entries]
+
+        inside = (y_indices >= 0) & (y_indices < y_stop - y_start)
+        x_marginal = np.bincount(x_indices[inside], weights=values[inside], minlength=max(x_stop - x_start, 0))
+        y_marginal = np.bincount(y_indices[inside], weights=values[inside], minlength=max(y_stop - y_start, 0))
+        return x_marginal.astype(np.int64), y_marginal.astype(np.int64)
+
+    def y_range_sum(self, start: int, stop: int) -> np.ndarray: # per x bin sum of the y bins [start, stop)
+        return self.marginals(0, self.shape[0], start, stop)[0]
+
+    def x_range_sum(self, start: int, stop: int) -> np.ndarray: # per y bin sum of the x bins [start, stop)
+        return self.marginals(start, stop, 0, self.shape[1])[1]
+
+    def project_x(self, y_low: float, y_high: float, mode: str = "edges", x_data=None, y_data=None):
+        # X-projection of the events between y_low and y_high, returns the projection and the applied gate
+        counts, gate = project(self.y_range_sum, self.x_edges, self.y_edges, y_low, y_high, mode, x_data, y_data)
+        return Histogram1D(counts, self.x_edges, name=self.x_name), gate
+
+    def project_y(self, x_low: float, x_high: float, mode: str = "edges", x_data=None, y_data=None):
+        # Y-projection of the events between x_low and x_high, returns the projection and the applied gate
+        counts, gate = project(self.x_range_sum, self.y_edges, self.x_edges, x_low, x_high, mode, y_data, x_data)
+        return Histogram1D(counts, self.y_edges, name=self.y_name), gate
+
+def sparse_from_bins(flat_indices: np.ndarray, counts: np.ndarray, x_edges: np.ndarray, y_edges: np.ndarray, x_name: str = "", y_name: str = ""):
+    # SparseHistogram2D of sorted flat bin indices (x bin * y bins + y bin) and their counts (fill_histo2d_sparse)
+    x_bins, y_bins = len(x_edges) - 1, len(y_edges) - 1
+    x_indices, y_indices = np.divmod(flat_indices, y_bins)
+
+    indptr = np.zeros(x_bins + 1, dtype=np.int64)
+    np.cumsum(np.bincount(x_indices, minlength=x_bins), out=indptr[1:])
+
+    values = counts.astype(count_dtype(int(counts.max(initial=0))))
+    return SparseHistogram2D(indptr, y_indices.astype(count_dtype(y_bins)), values, x_edges, y_edges, x_name=x_name, y_name=y_name)
+
+def sparse_from_dense(counts: np.ndarray, x_edges: np.ndarray, y_edges: np.ndarray, x_name: str = "", y_name: str = ""):
+    flat_indices = np.flatnonzero(counts)
+    return sparse_from_bins(flat_indices, counts.ravel()[flat_indices], x_edges, y_edges, x_name=x_name, y_name=y_name)
+
+IMAGE_SLAB_BINS = 1 << 20 # bins of a dense matrix widened at once while drawing
+
+def block_sums(counts, x_start: int, x_stop: int, y_start: int, y_stop: int, x_factor: int, y_factor: int) -> np.ndarray:
+    # counts of the bins [x_start, x_stop) x [y_start, y_stop) summed over blocks of x_factor x y_factor bins,
+    # counts a dense matrix or a SparseHistogram2D
+    x_blocks, y_blocks = -(-(x_stop - x_start) // x_factor), -(-(y_stop - y_start) // y_factor)
+
+    if not isinstance(counts, SparseHistogram2D):
+        # summed in slabs of rows, so only a slab at a time is widened to int64
+        window = counts[x_start:x_stop, y_start:y_stop]
+        image = np.empty((x_blocks, y_blocks), dtype=np.int64)
+        slab_rows = x_factor * max(IMAGE_SLAB_BINS // (x_factor * window.shape[1]), 1)
+        for start in np.arange(0, window.shape[0], slab_rows):
+            slab = window[start:start + slab_rows].astype(np.int64)
+            slab = np.add.reduceat(slab, np.arange(0, len(slab), x_factor), axis=0)
+            image[start // x_factor:start // x_factor + len(slab)] = np.add.reduceat(slab, np.arange(0, y_stop - y_start, y_factor), axis=1)
+        return image
+
+    entries = slice(counts.indptr[x_start], counts.indptr[x_stop])
+    x_indices = (counts.x_indices(x_start, x_stop) - x_start) // x_factor
+    y_indices = counts.y_indices[entries].astype(np.int64) - y_start
+    inside = (y_indices >= 0) & (y_indices < y_stop - y_start)
+    blocks = x_indices[inside] * y_blocks + y_indices[inside] // y_factor
+
+    return np.bincount(blocks, weights=counts.values[entries][inside], minlength=x_blocks * y_blocks).reshape(x_blocks, y_blocks)
+
+"""
+Image of compact counts with uniform bins: a SparseHistogram2D or a dense matrix of a small unsigned dtype.
+When the artist is drawn and the view changed, the bins inside the view are summed into an image of at most
+about one bin per screen pixel (blocks of bins are merged when zoomed out, as the levels of a HistogramPyramid),
+so drawing costs O(visible bins), O(visible non-empty bins) for a sparse histogram, and never converts the
+whole matrix to floats like pcolormesh/imshow do.
+"""
+class CountsImage(AxesImage):
+    def __init__(self, ax, counts, x_edges: np.ndarray, y_edges: np.ndarray, **kwargs):
+        super().__init__(ax, origin='lower', interpolation='nearest', **kwargs)
+        self.counts = counts
+        self.x_edges = x_edges
+        self.y_edges = y_edges
+        self.view = None
+
+    def update_view(self):
+        ax = self.axes
+        view = (tuple(ax.get_xlim()), tuple(ax.get_ylim()), ax.bbox.width, ax.bbox.height)
+        if view == self.view:
+            return
+        self.view = view
+
+        x_bins, y_bins = len(self.x_edges) - 1, len(self.y_edges) - 1
+        x_width = (self.x_edges[-1] - self.x_edges[0]) / x_bins
+        y_width = (self.y_edges[-1] - self.y_edges[0]) / y_bins
+
+        x_start, x_stop = visible_bins(self.x_edges[0], x_width, x_bins, view[0])
+        y_start, y_stop = visible_bins(self.y_edges[0], y_width, y_bins, view[1])
+
+        # bins merged per image pixel along each axis
+        x_factor = max(int(np.ceil((x_stop - x_start) / max(view[2], 1))), 1)
+        y_factor = max(int(np.ceil((y_stop - y_start) / max(view[3], 1))), 1)
+
+        image = block_sums(self.counts, x_start, x_stop, y_start, y_stop, x_factor, y_factor)
+
+        self.set_data(image.T)
+        self.set_extent((self.x_edges[0] + x_start * x_width, self.x_edges[0] + (x_start + image.shape[0] * x_factor) * x_width,
+                         self.y_edges[0] + y_start * y_width, self.y_edges[0] + (y_start + image.shape[1] * y_factor) * y_width))
+        self.set_clim(1, max(image.max(initial=0), 1))
+
+    def draw(self, renderer):
+        self.update_view()
+        super().draw(renderer)
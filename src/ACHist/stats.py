@@ -0,0 +1,166 @@
+import numpy as np
+from matplotlib.text import Text
+from . import profiling
+
+"""
+Prefix-sum index for the statistics shown in the 1D stats box. Built once from either the raw data
+("exact" mode, moments of the events) or the filled histogram ("fast" mode, moments of the bin centres),
+after which the integral, mean and standard deviation of any window come from two binary searches.
+"""
+class StatsIndex1D:
+    def __init__(self, data: np.ndarray = None, hist_counts: np.ndarray = None, hist_bins: np.ndarray = None, mode: str = "exact"):
+
+        if mode == "exact":
+            if data is None:
+                raise ValueError("The exact stats mode needs the raw data.")
+
+            # a list of sources is concatenated here since sorting needs a copy anyway
+            data = np.concatenate([np.asarray(item, dtype=np.float64) for item in data]) if isinstance(data, list) else np.asarray(data, dtype=np.float64)
+            self.positions = np.sort(data[~np.isnan(data)])
+            weights = None
+
+        elif mode == "fast":
+            if hist_counts is None or hist_bins is None:
+                raise ValueError("The fast stats mode needs the histogram counts and bins.")
+
+            self.positions = (hist_bins[:-1] + hist_bins[1:]) / 2
+            weights = np.asarray(hist_counts, dtype=np.float64)
+
+        else:
+            raise ValueError(f"Unknown stats mode '{mode}', expected 'exact' or 'fast'.")
+
+        self.mode = mode
+
+        # moments are accumulated about a central value to limit the cancellation in the variance
+        self.shift = self.positions[len(self.positions) // 2] if len(self.positions) > 0 else 0.0
+        shifted = self.positions - self.shift
+
+        if weights is None:
+            self.cumulative_counts = None
+            self.cumulative_sum = np.concatenate(([0.0], np.cumsum(shifted)))
+            self.cumulative_sum_sq = np.concatenate(([0.0], np.cumsum(shifted**2)))
+        else:
+            self.cumulative_counts = np.concatenate(([0.0], np.cumsum(weights)))
+            self.cumulative_sum = np.concatenate(([0.0], np.cumsum(weights * shifted)))
+            self.cumulative_sum_sq = np.concatenate(([0.0], np.cumsum(weights * shifted**2)))
+
+    def window(self, low: float, high: float): # returns the integral, mean and std dev of the entries in [low, high]
+
+        start = np.searchsorted(self.positions, low, side='left')
+        stop = np.searchsorted(self.positions, high, side='right')
+        stop = max(start, stop)
+
+        if self.cumulative_counts is None:
+            integral = float(stop - start)
+        else:
+            integral = self.cumulative_counts[stop] - self.cumulative_counts[start]
+
+        if integral <= 0:
+            return 0.0, np.nan, np.nan
+
+        mean = (self.cumulative_sum[stop] - self.cumulative_sum[start]) / integral
+        variance = (self.cumulative_sum_sq[stop] - self.cumulative_sum_sq[start]) / integral - mean**2
+
+        return integral, mean + self.shift, np.sqrt(max(variance, 0.0))
+
+"""
+Window statistics of a 2D histogram computed from the bins themselves, without a table. This is what compact
+(small unsigned dtype) and sparse matrices use: a summed-area table would be a dense int64 copy of the matrix,
+while summing the bins in the view costs O(visible bins), or O(non-empty bins in the view) for a sparse matrix.
+The window follows the same convention as SummedAreaTable2D, the bins whose centres lie inside the limits.
+"""
+class WindowStats2D:
+    def __init__(self, hist, x_edges: np.ndarray, y_edges: np.ndarray):
+        # hist: counts matrix of any dtype, or an object with marginals(x_start, x_stop, y_start, y_stop) such as a SparseHistogram2D
+        self.hist = hist
+        self.x_centers = (x_edges[:-1] + x_edges[1:]) / 2
+        self.y_centers = (y_edges[:-1] + y_edges[1:]) / 2
+
+    def bin_window(self, x_lims, y_lims): # bins whose centres lie inside the limits, as [start, stop) index pairs
+        x_low, x_high = sorted(x_lims)
+        y_low, y_high = sorted(y_lims)
+
+        x_start = np.searchsorted(self.x_centers, x_low, side='left')
+        x_stop = max(x_start, np.searchsorted(self.x_centers, x_high, side='right'))
+        y_start = np.searchsorted(self.y_centers, y_low, side='left')
+        y_stop = max(y_start, np.searchsorted(self.y_centers, y_high, side='right'))
+
+        return x_start, x_stop, y_start, y_stop
+
+    def marginals(self, x_start: int, x_stop: int, y_start: int, y_stop: int):
+        if hasattr(self.hist, "marginals"):
+            return self.hist.marginals(x_start, x_stop, y_start, y_stop)
+        window = self.hist[x_start:x_stop, y_start:y_stop]
+        dtype = np.int64 if np.issubdtype(window.dtype, np.integer) else np.float64
+        return window.sum(axis=1, dtype=dtype), window.sum(axis=0, dtype=dtype)
+
+    def window(self, x_lims, y_lims): # returns the integral and the (mean, std dev) of the x and y marginals in the window
+        x_start, x_stop, y_start, y_stop = self.bin_window(x_lims, y_lims)
+        x_marginal, y_marginal = self.marginals(x_start, x_stop, y_start, y_stop)
+        return x_marginal.sum(), weighted_moments(self.x_centers[x_start:x_stop], x_marginal), weighted_moments(self.y_centers[y_start:y_stop], y_marginal)
+
+"""
+Summed-area table (integral image) of a filled 2D histogram. Built once, after which the integral of
+any rectangular window is four lookups, and the marginal means/std devs only need the per-bin sums
+along the window edges, which are differences of the same table.
+"""
+class SummedAreaTable2D(WindowStats2D):
+    def __init__(self, hist: np.ndarray, x_edges: np.ndarray, y_edges: np.ndarray):
+        super().__init__(hist, x_edges, y_edges)
+        self.hist = None # only the table is kept
+
+        dtype = np.int64 if np.issubdtype(hist.dtype, np.integer) else np.float64
+        self.table = np.zeros((hist.shape[0] + 1, hist.shape[1] + 1), dtype=dtype)
+        np.cumsum(hist, axis=0, dtype=dtype, out=self.table[1:, 1:])
+        np.cumsum(self.table[1:, 1:], axis=1, out=self.table[1:, 1:])
+
+    def integral(self, x_lims, y_lims):
+        x_start, x_stop, y_start, y_stop = self.bin_window(x_lims, y_lims)
+        table = self.table
+        return table[x_stop, y_stop] - table[x_start, y_stop] - table[x_stop, y_start] + table[x_start, y_start]
+
+    def window(self, x_lims, y_lims): # returns the integral and the (mean, std dev) of the x and y marginals in the window
+        x_start, x_stop, y_start, y_stop = self.bin_window(x_lims, y_lims)
+        table = self.table
+
+        x_marginal = np.diff(table[x_start:x_stop + 1, y_stop] - table[x_start:x_stop + 1, y_start])
+        y_marginal = np.diff(table[x_stop, y_start:y_stop + 1] - table[x_start, y_start:y_stop + 1])
+
+        integral = table[x_stop, y_stop] - table[x_start, y_stop] - table[x_stop, y_start] + table[x_start, y_start]
+
+        return integral, weighted_moments(self.x_centers[x_start:x_stop], x_marginal), weighted_moments(self.y_centers[y_start:y_stop], y_marginal)
+
+def weighted_moments(positions: np.ndarray, weights: np.ndarray): # mean and std dev of positions weighted by counts
+
+    total = np.sum(weights)
+    if total <= 0:
+        return np.nan, np.nan
+
+    mean = np.sum(weights * positions) / total
+    variance = np.sum(weights * (positions - mean)**2) / total
+
+    return mean, np.sqrt(variance)
+
+"""
+Text artist whose string is a function of the axes limits. The text is recomputed when the artist is
+drawn and the limits differ from the ones used last, which coalesces the x and y limit changes of a zoom.
+"""
+class LimitsText(Text):
+    def __init__(self, *args, stats_text, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_text = stats_text
+        self.lims = None
+
+    def set_stats_text(self, stats_text): # replaces the function computing the text, e.g. after the counts changed
+        self.stats_text = stats_text
+        self.lims = None
+        self.stale = True
+
+    def draw(self, renderer):
+        if self.axes is not None:
+            lims = (tuple(self.axes.get_xlim()), tuple(self.axes.get_ylim()))
+            if lims != self.lims:
+                self.lims = lims
+                with profiling.stage("stats.box_update"):
+                    self.set_text(self.stats_text(*lims))
+        super().draw(renderer)
@@ -0,0 +1,94 @@
+import os
+import polars as pl
+import numpy as np
+from .binning import fill_histo1d, fill_histo2d, is_uniform
+from .histogram_cache import source_key, source_files
+
+# Out-of-core filling of histograms. The source is scanned lazily and only the requested columns are
+# pulled into memory, one batch at a time, so the peak memory is set by batch_size and not by the file size.
+
+DEFAULT_BATCH_SIZE = 1_000_000
+
+def scan_source(source) -> pl.LazyFrame: # returns a LazyFrame for a LazyFrame, DataFrame or parquet path/glob
+    if isinstance(source, pl.LazyFrame):
+        return source
+    if isinstance(source, pl.DataFrame):
+        return source.lazy()
+    if isinstance(source, (str, os.PathLike)):
+        return pl.scan_parquet(source)
+    raise TypeError(f"Cannot stream from an object of type '{type(source).__name__}', expected a LazyFrame or a parquet path.")
+
+def iter_batches(source, columns: list, batch_size: int = DEFAULT_BATCH_SIZE):
+
+    lazy_frame = scan_source(source).select(columns)
+
+    if hasattr(lazy_frame, "collect_batches"): # streaming engine is available
+        for batch in lazy_frame.collect_batches(chunk_size=batch_size):
+            if batch.height > 0:
+                yield batch
+        return
+
+    if isinstance(source, (str, os.PathLike)):
+        # older polars, parquet files: page through the scan, the slices are pushed down into the parquet reader
+        offset = 0
+        while True:
+            batch = lazy_frame.slice(offset, batch_size).collect()
+            if batch.height == 0:
+                return
+            yield batch
+            offset += batch.height
+
+    # older polars, other LazyFrames: a slice would re-run the whole query, so the selected columns are collected
+    # once (eager, the memory is not bounded by batch_size) and sliced
+    yield from (batch for batch in lazy_frame.collect().iter_slices(batch_size) if batch.height > 0)
+
+def check_range(bins, range, name: str):
+    # every batch is binned on its own, so a number of bins needs the range given, it cannot follow the data
+    if range is None and is_uniform(bins):
+        raise ValueError(f"{name} needs an explicit range, or bin edges, the batches cannot be binned over the range of the data.")
+
+def stream_histo1d(source, column: str, bins: int, range: list, batch_size: int = DEFAULT_BATCH_SIZE, workers: int = None, cache=None):
+
+    # identical to np.histogram(data, bins=bins, range=range) of the full column. With a HistogramCache the
+    # source is not read at all when the histogram is in the cache
+    check_range(bins, range, "stream_histo1d")
+    if cache is not None:
+        key = source_key("histo1d", source, [column], bins, range, sources_kept=False)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached["counts"], cached["edges"]
+
+    hist_counts, hist_bins = fill_histo1d(np.empty(0), bins=bins, range=range)
+
+    for batch in iter_batches(source, [column], batch_size=batch_size):
+        batch_counts, _ = fill_histo1d(batch[column].to_numpy(), bins=bins, range=range, workers=workers)
+        hist_counts += batch_counts
+
+    if cache is not None:
+        cache.put(key, {"counts": hist_counts, "edges": hist_bins}, sources=source_files(source) if isinstance(source, (str, os.PathLike)) else [],
+                  description=f"histo1d {column}")
+
+    return hist_counts, hist_bins
+
+def stream_histo2d(source, xcolumn: str, ycolumn: str, bins: list, range: list, batch_size: int = DEFAULT_BATCH_SIZE, workers: int = None, cache=None):
+
+    # identical to np.histogram2d(x_data, y_data, bins=bins, range=range) of the full columns
+    for axis in (0, 1):
+        check_range(bins[axis], None if range is None else range[axis], "stream_histo2d")
+    if cache is not None:
+        key = source_key("histo2d", source, [xcolumn, ycolumn], bins, range)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached["counts"], cached["x_edges"], cached["y_edges"]
+
+    hist, x_edges, y_edges = fill_histo2d(np.empty(0), np.empty(0), bins=bins, range=range)
+
+    for batch in iter_batches(source, list(dict.fromkeys([xcolumn, ycolumn])), batch_size=batch_size):
+        batch_hist, _, _ = fill_histo2d(batch[xcolumn].to_numpy(), batch[ycolumn].to_numpy(), bins=bins, range=range, workers=workers)
+        hist += batch_hist
+
+    if cache is not None:
+        cache.put(key, {"counts": hist, "x_edges": x_edges, "y_edges": y_edges}, sources=source_files(source) if isinstance(source, (str, os.PathLike)) else [],
+                  description=f"histo2d {xcolumn} {ycolumn}")
+
+    return hist, x_edges, y_edges
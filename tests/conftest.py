@@ -0,0 +1,3 @@
+import matplotlib
+
+matplotlib.use("Agg") # histo1d/histo2d open figures, the tests run headless
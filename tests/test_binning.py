@@ -0,0 +1,132 @@
+import numpy as np
+import polars as pl
+import pytest
+import matplotlib.pyplot as plt
+from ACHist.binning import fill_histo1d, fill_histo1d_sources, fill_histo2d, fill_histo2d_compact, fill_histo2d_sparse
+from ACHist.histo1d_tools import histo1d
+from ACHist.stream import stream_histo1d, stream_histo2d
+
+@pytest.fixture
+def values():
+    # random values plus the edges themselves, NaNs and values outside the range: the cases np.histogram defines
+    rng = np.random.default_rng(1)
+    data = np.concatenate([rng.normal(50, 20, 200_000), np.linspace(0, 100, 101), [np.nan, -1.0, 100.0, 101.0]])
+    rng.shuffle(data)
+    return data
+
+@pytest.mark.parametrize("workers", [None, 3])
+def test_fill_histo1d_matches_numpy(values, workers):
+    counts, edges = fill_histo1d(values, bins=100, range=(0, 100), workers=workers)
+    expected_counts, expected_edges = np.histogram(values, bins=100, range=(0, 100))
+    assert np.array_equal(counts, expected_counts)
+    assert np.array_equal(edges, expected_edges)
+
+@pytest.mark.parametrize("workers", [None, 3])
+def test_fill_histo1d_mask_matches_filtered_numpy(values, workers):
+    mask = np.arange(len(values)) % 3 == 0
+    counts, _ = fill_histo1d(values, bins=64, range=(10, 90), workers=workers, mask=mask)
+    assert np.array_equal(counts, np.histogram(values[mask], bins=64, range=(10, 90))[0])
+
+def test_fill_histo1d_edges_matches_numpy(values):
+    edges = np.array([0, 1, 5, 20, 50, 51, 100], dtype=np.float64)
+    counts, _ = fill_histo1d(values, bins=edges, range=None)
+    assert np.array_equal(counts, np.histogram(values, bins=edges)[0])
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_fill_histo1d_without_range_autoscales_like_numpy(workers):
+    data = np.random.default_rng(2).exponential(10, 10_000)
+    counts, edges = fill_histo1d(data, bins=50, range=None, workers=workers)
+    expected_counts, expected_edges = np.histogram(data, bins=50)
+    assert np.array_equal(counts, expected_counts)
+    assert np.array_equal(edges, expected_edges)
+
+def test_fill_histo1d_sources_without_range_share_one_range():
+    data = np.random.default_rng(3).normal(0, 1, 10_000)
+    counts, edges, _ = fill_histo1d_sources([data[:3000], data[3000:]], bins=40, range=None)
+    assert np.array_equal(counts, np.histogram(data, bins=40)[0])
+    assert np.array_equal(edges, np.histogram(data, bins=40)[1])
+
+def test_histo1d_without_range():
+    # regression: histo1d(data, bins=50, range=None) raised a TypeError in bin_edges
+    energy = pl.Series("Energy", np.random.default_rng(4).normal(500, 50, 5_000))
+    counts, edges = histo1d(energy, bins=50, range=None)
+    plt.close("all")
+    assert np.array_equal(counts, np.histogram(energy.to_numpy(), bins=50)[0])
+    assert np.array_equal(edges, np.histogram(energy.to_numpy(), bins=50)[1])
+
+@pytest.fixture
+def xy():
+    rng = np.random.default_rng(5)
+    x = np.concatenate([rng.uniform(-10, 110, 100_000), np.linspace(0, 100, 33), [np.nan, 100.0]])
+    y = np.concatenate([rng.normal(25, 15, 100_000), np.linspace(0, 50, 33), [1.0, np.nan]])
+    return x, y
+
+@pytest.mark.parametrize("workers", [None, 3])
+def test_fill_histo2d_matches_numpy(xy, workers):
+    x, y = xy
+    mask = np.arange(len(x)) % 2 == 0
+    bins, range = (40, 25), [[0, 100], [0, 50]]
+
+    counts, x_edges, y_edges = fill_histo2d(x, y, bins=bins, range=range, workers=workers)
+    expected, expected_x_edges, expected_y_edges = np.histogram2d(x, y, bins=bins, range=range)
+    assert np.array_equal(counts, expected.astype(np.int64))
+    assert np.array_equal(x_edges, expected_x_edges) and np.array_equal(y_edges, expected_y_edges)
+
+    counts, _, _ = fill_histo2d(x, y, bins=bins, range=range, workers=workers, mask=mask)
+    assert np.array_equal(counts, np.histogram2d(x[mask], y[mask], bins=bins, range=range)[0].astype(np.int64))
+
+def test_compact_and_sparse_fills_match_numpy(xy):
+    x, y = xy
+    bins, range = (40, 25), [[0, 100], [0, 50]]
+    expected = np.histogram2d(x, y, bins=bins, range=range)[0].astype(np.int64)
+
+    compact, _, _ = fill_histo2d_compact([x], [y], bins=bins, range=range)
+    assert compact.dtype.kind == "u"
+    assert np.array_equal(compact.astype(np.int64), expected) # promoted past uint8 where a bin overflowed
+
+    flat_indices, counts, _, _ = fill_histo2d_sparse([x], [y], bins=bins, range=range)
+    dense = np.zeros(expected.size, dtype=np.int64)
+    dense[flat_indices] = counts
+    assert np.array_equal(dense.reshape(expected.shape), expected)
+
+def test_stream_fills_match_numpy(tmp_path, xy):
+    x, y = xy
+    path = str(tmp_path / "events.parquet")
+    pl.DataFrame({"x": x, "y": y}).write_parquet(path)
+
+    counts, _ = stream_histo1d(path, "x", bins=100, range=(0, 100), batch_size=7_000)
+    assert np.array_equal(counts, np.histogram(x, bins=100, range=(0, 100))[0])
+
+    counts, _, _ = stream_histo2d(path, "x", "y", bins=(40, 25), range=[[0, 100], [0, 50]], batch_size=7_000)
+    assert np.array_equal(counts, np.histogram2d(x, y, bins=(40, 25), range=[[0, 100], [0, 50]])[0].astype(np.int64))
+
+def test_stream_without_range(tmp_path, xy):
+    # every batch is binned on its own, so a number of bins needs an explicit range
+    x, y = xy
+    path = str(tmp_path / "events.parquet")
+    pl.DataFrame({"x": x, "y": y}).write_parquet(path)
+
+    with pytest.raises(ValueError, match="explicit range"):
+        stream_histo1d(path, "x", bins=100, range=None, batch_size=7_000)
+    with pytest.raises(ValueError, match="explicit range"):
+        stream_histo2d(path, "x", "y", bins=(40, 25), range=None, batch_size=7_000)
+
+    # bin edges define the histogram without a range
+    edges = np.array([0, 5, 20, 60, 100], dtype=np.float64)
+    counts, _ = stream_histo1d(path, "x", bins=edges, range=None, batch_size=7_000)
+    assert np.array_equal(counts, np.histogram(x, bins=edges)[0])
+
+def test_histo2d_validates_its_data():
+    from ACHist.histo2d_tools import histo2d
+
+    x, y = pl.Series("x", np.linspace(0, 1, 100)), pl.Series("y", np.linspace(1, 0, 100))
+    with pytest.raises(ValueError, match="needs ydata"):
+        histo2d(x, bins=(10, 10), range=[[0, 1], [0, 1]])
+    with pytest.raises(ValueError, match="two columns"):
+        histo2d(pl.DataFrame([x, y, x.alias("z")]), bins=(10, 10), range=[[0, 1], [0, 1]])
+    with pytest.raises(TypeError):
+        histo2d(x, y.to_numpy(), bins=(10, 10), range=[[0, 1], [0, 1]])
+
+    counts, _, _ = histo2d(pl.DataFrame([x, y]), bins=(10, 10), range=[[0, 1], [0, 1]])
+    plt.close("all")
+    assert np.array_equal(counts, np.histogram2d(x.to_numpy(), y.to_numpy(), bins=(10, 10), range=[[0, 1], [0, 1]])[0].astype(np.int64))
@@ -0,0 +1,49 @@
+import numpy as np
+import polars as pl
+import pytest
+from matplotlib.path import Path
+from ACHist.cut import Cut2D, CutSet, gate_mask, reduce_df_with_cut, write_cut_json
+
+# a concave polygon (an L shape with a notch) and a triangle, with events on a grid through their vertices and edges
+L_SHAPE = [(0, 0), (60, 0), (60, 20), (25, 20), (25, 35), (40, 50), (0, 50)]
+TRIANGLE = [(30, 10), (90, 30), (50, 80)]
+
+@pytest.fixture
+def events():
+    rng = np.random.default_rng(6)
+    grid_x, grid_y = np.meshgrid(np.arange(-5, 100, 2.5), np.arange(-5, 90, 2.5))
+    x = np.concatenate([rng.uniform(-10, 100, 50_000), grid_x.ravel()])
+    y = np.concatenate([rng.uniform(-10, 90, 50_000), grid_y.ravel()])
+    return pl.DataFrame({"x": x, "y": y, "z": y[::-1].copy()})
+
+def contains(vertices, x, y) -> np.ndarray:
+    return Path(vertices, closed=True).contains_points(np.column_stack([x, y]))
+
+@pytest.mark.parametrize("vertices", [L_SHAPE, TRIANGLE])
+def test_is_xy_inside_matches_contains_points(events, vertices):
+    cut = Cut2D("cut", vertices)
+    inside = cut.is_xy_inside(events["x"], events["y"])
+    assert np.array_equal(inside, contains(vertices, events["x"].to_numpy(), events["y"].to_numpy()))
+
+def test_cut_set_bitmask_matches_contains_points(events):
+    cuts = CutSet()
+    cuts.add(Cut2D("l_shape", L_SHAPE), "x", "y")
+    cuts.add(Cut2D("triangle", TRIANGLE), "x", "y")
+    cuts.add(Cut2D("triangle_xz", TRIANGLE), "x", "z")
+    bitmask = cuts.bitmask(events)
+
+    x, y, z = (events[column].to_numpy() for column in ("x", "y", "z"))
+    assert np.array_equal((bitmask & cuts.mask("l_shape")) != 0, contains(L_SHAPE, x, y))
+    assert np.array_equal((bitmask & cuts.mask("triangle")) != 0, contains(TRIANGLE, x, y))
+    assert np.array_equal((bitmask & cuts.mask("triangle_xz")) != 0, contains(TRIANGLE, x, z))
+
+def test_gate_mask_is_inside_all_cuts(events):
+    mask = gate_mask([(Cut2D("l_shape", L_SHAPE), events["x"], events["y"]), (Cut2D("triangle", TRIANGLE), events["x"], events["z"])])
+    x, y, z = (events[column].to_numpy() for column in ("x", "y", "z"))
+    assert np.array_equal(mask, contains(L_SHAPE, x, y) & contains(TRIANGLE, x, z))
+
+def test_reduce_df_with_cut_keeps_the_events_inside(events, tmp_path):
+    cut_file = str(tmp_path / "cut.json")
+    write_cut_json(Cut2D("triangle", TRIANGLE), cut_file)
+    reduced = reduce_df_with_cut(events, cut_file, "x", "y")
+    assert reduced.equals(events.filter(pl.Series(contains(TRIANGLE, events["x"].to_numpy(), events["y"].to_numpy()))))
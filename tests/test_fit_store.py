@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from ACHist.fit_store import FitStore
+from ACHist.histo1d_tools import fit_linear_background, fit_region
+
+@pytest.fixture
+def doublet():
+    # two overlapping Gaussians on a linear background
+    rng = np.random.default_rng(8)
+    edges = np.linspace(0, 200, 401)
+    centers = (edges[:-1] + edges[1:]) / 2
+    expected = 40 - 0.05 * centers + 3000 * np.exp(-(centers - 95)**2 / 18) + 1500 * np.exp(-(centers - 106)**2 / 18)
+    return rng.poisson(expected).astype(np.float64), centers
+
+def fit(doublet, backend, objective):
+    counts, centers = doublet
+    region = (75, 125)
+    background_result, _ = fit_linear_background((70, 72, 128, 130), counts, centers)
+    result, _ = fit_region(hist_counts=counts, hist_bin_centers=centers, region=region, peak_positions=[95, 106],
+                           background_result=background_result, backend=backend, objective=objective)
+    return result, (result.background if backend == "fast" else background_result), region
+
+@pytest.mark.parametrize("backend, objective", [("lmfit", "chi2"), ("fast", "chi2"), ("fast", "poisson")])
+def test_round_trip(doublet, tmp_path, backend, objective):
+    result, background_result, region = fit(doublet, backend, objective)
+    store = FitStore(str(tmp_path / "fits.zip"))
+    fit_id = store.append(result, background_result, region, backend=backend, objective=objective, name="doublet")
+
+    stored = FitStore(str(tmp_path / "fits.zip")).load(fit_id)
+    assert stored.region == region
+    assert stored.record["backend"] == backend and stored.record["name"] == "doublet"
+
+    centers = doublet[1]
+    assert np.allclose(stored.result.eval(centers), result.eval(x=centers))
+    for name in ("g0_center", "g0_amplitude", "g0_sigma", "g1_center", "g1_amplitude", "g1_sigma"):
+        assert stored.result.params[name].value == pytest.approx(result.params[name].value)
+        assert stored.result.params[name].stderr == pytest.approx(result.params[name].stderr)
+    for name in ("slope", "intercept"):
+        assert stored.result.background.params[name].value == pytest.approx(background_result.params[name].value)
+
+    # the covariance comes back complete, so uncertainties derived from it (including cross terms) are finite
+    assert np.isfinite(stored.result.covariance).all()
+    assert np.isfinite(stored.result.params["g0_height"].stderr)
+
+def test_table_lists_every_peak(doublet, tmp_path):
+    store = FitStore(str(tmp_path / "fits.zip"))
+    for backend in ("lmfit", "fast"):
+        result, background_result, region = fit(doublet, backend, "chi2")
+        store.append(result, background_result, region, backend=backend)
+
+    table = store.table()
+    assert len(store) == 2 and table.height == 4
+    assert np.allclose(np.sort(table["center"].to_numpy()), [95, 95, 106, 106], atol=0.5)
+
+def test_failed_append_keeps_the_store(doublet, tmp_path, monkeypatch):
+    store = FitStore(str(tmp_path / "fits.zip"))
+    result, background_result, region = fit(doublet, "fast", "chi2")
+    fit_id = store.append(result, background_result, region, backend="fast")
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(np, "save", fail)
+    with pytest.raises(OSError):
+        store.append(result, background_result, region, backend="fast")
+
+    assert store.ids() == [fit_id] and store.load(fit_id).region == region
+    assert list(tmp_path.iterdir()) == [tmp_path / "fits.zip"]
@@ -0,0 +1,104 @@
+import numpy as np
+import polars as pl
+import pytest
+import matplotlib.pyplot as plt
+from ACHist.histo1d_tools import histo1d
+from ACHist.histogram_cache import HistogramCache, histogram_key
+
+@pytest.fixture
+def run_file(tmp_path):
+    rng = np.random.default_rng(0)
+    path = tmp_path / "run.parquet"
+    pl.DataFrame({"Energy": rng.uniform(0, 100, 100_000), "Detector": rng.integers(0, 4, 100_000)}).write_parquet(path)
+    return str(path)
+
+def test_filtered_series_does_not_hit_the_full_column(run_file, tmp_path):
+    cache = HistogramCache(str(tmp_path / "cache"))
+    df = pl.read_parquet(run_file)
+    filtered = df.filter(pl.col("Detector") == 1)["Energy"]
+
+    full_counts, _ = histo1d(df["Energy"], bins=100, range=(0, 100), cache=cache, source=run_file)
+    filtered_counts, _ = histo1d(filtered, bins=100, range=(0, 100), cache=cache, source=run_file)
+    plt.close("all")
+
+    assert full_counts.sum() == len(df)
+    assert filtered_counts.sum() == len(filtered)
+    assert np.array_equal(filtered_counts, np.histogram(filtered.to_numpy(), bins=100, range=(0, 100))[0])
+    assert cache.hits == 0
+
+def test_same_series_hits_the_cache(run_file, tmp_path):
+    cache = HistogramCache(str(tmp_path / "cache"))
+    energy = pl.read_parquet(run_file)["Energy"]
+
+    first, _ = histo1d(energy, bins=100, range=(0, 100), cache=cache, source=run_file)
+    second, _ = histo1d(energy, bins=100, range=(0, 100), cache=cache, source=run_file)
+    plt.close("all")
+
+    assert cache.hits == 1
+    assert np.array_equal(first, second)
+
+def test_modified_file_gives_a_new_key(run_file, tmp_path):
+    from ACHist.stream import stream_histo1d
+    import os
+
+    cache = HistogramCache(str(tmp_path / "cache"))
+    first, _ = stream_histo1d(run_file, "Energy", bins=100, range=(0, 100), cache=cache)
+
+    replaced = pl.DataFrame({"Energy": np.random.default_rng(1).uniform(0, 50, 1_000), "Detector": np.zeros(1_000, dtype=np.int64)})
+    replaced.write_parquet(run_file)
+    stat = os.stat(run_file)
+    os.utime(run_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000)) # a new modification time even on coarse clocks
+
+    second, _ = stream_histo1d(run_file, "Energy", bins=100, range=(0, 100), cache=cache)
+    assert cache.hits == 0
+    assert first.sum() == 100_000
+    assert np.array_equal(second, np.histogram(replaced["Energy"].to_numpy(), bins=100, range=(0, 100))[0])
+
+    third, _ = stream_histo1d(run_file, "Energy", bins=100, range=(0, 100), cache=cache)
+    assert cache.hits == 1 and np.array_equal(second, third)
+
+def test_invalidate_drops_the_entries_of_a_file(run_file, tmp_path):
+    from ACHist.stream import stream_histo1d
+
+    cache = HistogramCache(str(tmp_path / "cache"))
+    stream_histo1d(run_file, "Energy", bins=100, range=(0, 100), cache=cache)
+    stream_histo1d(run_file, "Energy", bins=50, range=(0, 100), cache=cache)
+    assert len(cache) == 2
+    assert cache.invalidate(run_file) == 2
+    assert len(cache) == 0
+
+def test_filters_and_cuts_are_part_of_the_key(run_file):
+    from ACHist.batch import HistogramBatch
+    from ACHist.cut import Cut2D
+    from ACHist.query import HistogramQuery
+
+    cut = Cut2D("band", [(0, 0), (50, 0), (50, 2), (0, 2)])
+    for collection in (HistogramQuery(run_file), HistogramBatch()):
+        collection.histo1d("all", "Energy", bins=100, range=(0, 100))
+        collection.histo1d("detector_1", "Energy", bins=100, range=(0, 100), filter=pl.col("Detector") == 1)
+        collection.histo1d("detector_2", "Energy", bins=100, range=(0, 100), filter=pl.col("Detector") == 2)
+        collection.histo1d("band", "Energy", bins=100, range=(0, 100), cuts=(cut, "Energy", "Detector"))
+        keys = collection.cache_keys() if isinstance(collection, HistogramQuery) else collection.cache_keys(run_file)
+        assert len(set(keys.values())) == 4
+
+def test_series_keys_follow_the_values():
+    energy = pl.Series("Energy", np.arange(1_000, dtype=np.float64))
+    key = histogram_key("histo1d", [energy], 100, (0, 1000))
+    assert histogram_key("histo1d", [energy.clone()], 100, (0, 1000)) == key
+    assert histogram_key("histo1d", [energy[:500]], 100, (0, 1000)) != key
+    assert histogram_key("histo1d", [energy.reverse()], 100, (0, 1000)) != key
+    assert histogram_key("histo1d", [energy], 50, (0, 1000)) != key
+
+def test_concurrent_puts_keep_every_entry(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = HistogramCache(str(tmp_path / "cache"))
+
+    def put(number):
+        cache.put(f"key{number}", {"counts": np.full(4, number)})
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(put, range(32)))
+
+    assert {entry["key"] for entry in cache.entries()} == {f"key{number}" for number in range(32)}
+    assert not (tmp_path / "cache" / "index.lock").exists()
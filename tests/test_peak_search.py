@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from ACHist.batch_fit import fit_peaks_batch
+from ACHist.peak_search import fit_spectrum, search_peaks, search_region_peaks
+
+LINES = [(200.0, 4000), (520.0, 9000), (530.0, 6000), (1300.0, 3000), (1790.0, 5000)] # (center, area)
+FWHM = 4.0
+
+@pytest.fixture
+def spectrum():
+    # gamma lines of the same FWHM on an exponential continuum, 1 bin per unit
+    rng = np.random.default_rng(9)
+    edges = np.arange(0, 2001, 1.0)
+    centers = (edges[:-1] + edges[1:]) / 2
+    sigma = FWHM / (2 * np.sqrt(2 * np.log(2)))
+    expected = 400 * np.exp(-centers / 600) + 20
+    for center, area in LINES:
+        expected += area * np.exp(-(centers - center)**2 / (2 * sigma**2)) / (sigma * np.sqrt(2 * np.pi))
+    return rng.poisson(expected).astype(np.float64), edges
+
+def test_search_finds_every_line(spectrum):
+    found = search_peaks(*spectrum, fwhm=FWHM, threshold=6) # well above the largest fluctuation of the continuum
+    positions = found["position"].to_numpy()
+    assert len(positions) == len(LINES)
+    assert np.allclose(positions, [center for center, _ in LINES], atol=1.0)
+
+def test_region_search_matches_the_full_search(spectrum):
+    full = search_peaks(*spectrum, fwhm=FWHM)["position"].to_numpy()
+    region = search_region_peaks(*spectrum, region=(500, 560), fwhm=FWHM)
+    assert np.array_equal(region["position"].to_numpy(), full[(full >= 500) & (full <= 560)])
+    assert np.array_equal(spectrum[1][region["bin"].to_numpy()], region["position"].to_numpy() - 0.5) # bins of the full spectrum
+
+def test_fit_spectrum_fits_every_line(spectrum):
+    peaks = fit_spectrum(*spectrum, fwhm=FWHM, threshold=6, verbose=False)
+    assert peaks.height == len(LINES) and peaks["success"].all()
+    assert np.allclose(peaks["center"].to_numpy(), [center for center, _ in LINES], atol=0.3)
+    assert np.allclose(peaks.filter(peaks["multiplet"] == 2)["search_position"].to_numpy(), [520, 530], atol=1.0) # one region for the doublet
+
+def test_peak_on_the_region_edge_is_kept(spectrum):
+    # a peak exactly on a region edge is fitted like the peaks inside, not dropped
+    results = fit_peaks_batch([(spectrum, (1290.5, 1310), [1290.5, 1299.5], [1280, 1282, 1318, 1320])], verbose=False, backend="fast", objective="poisson")
+    assert results["peak"].to_list() == [0, 1]
+    assert results["center"][1] == pytest.approx(1300.0, abs=0.5)
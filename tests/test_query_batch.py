@@ -0,0 +1,65 @@
+import numpy as np
+import polars as pl
+import pytest
+from matplotlib.path import Path
+from ACHist.batch import HistogramBatch
+from ACHist.cut import Cut2D
+from ACHist.query import HistogramQuery
+
+TRIANGLE = [(100, 50), (900, 200), (500, 900)]
+
+@pytest.fixture
+def events():
+    rng = np.random.default_rng(7)
+    n = 200_000
+    return pl.DataFrame({
+        "E": np.concatenate([rng.uniform(-50, 1050, n), np.linspace(0, 1000, 101)]),
+        "dE": np.concatenate([rng.uniform(0, 1000, n), np.linspace(0, 1000, 101)]),
+        "Detector": np.concatenate([rng.integers(0, 4, n), np.zeros(101, dtype=np.int64)]),
+    })
+
+def expected_histograms(events):
+    E, dE = events["E"].to_numpy(), events["dE"].to_numpy()
+    detector_1 = events["Detector"].to_numpy() == 1
+    inside = Path(TRIANGLE, closed=True).contains_points(np.column_stack([E, dE]))
+    edges = np.array([0, 10, 100, 250, 600, 1000], dtype=np.float64)
+    return {
+        "energy": np.histogram(E, bins=200, range=(0, 1000))[0],
+        "energy_detector_1": np.histogram(E[detector_1], bins=200, range=(0, 1000))[0],
+        "energy_cut": np.histogram(E[inside], bins=200, range=(0, 1000))[0],
+        "energy_edges": np.histogram(E, bins=edges)[0],
+        "pid": np.histogram2d(E, dE, bins=(50, 40), range=[[0, 1000], [0, 1000]])[0].astype(np.int64),
+        "pid_detector_1_cut": np.histogram2d(E[detector_1 & inside], dE[detector_1 & inside], bins=(50, 40), range=[[0, 1000], [0, 1000]])[0].astype(np.int64),
+    }, edges
+
+def declare(collection, edges):
+    cut = Cut2D("triangle", TRIANGLE)
+    detector_1 = pl.col("Detector") == 1
+    collection.histo1d("energy", "E", bins=200, range=(0, 1000))
+    collection.histo1d("energy_detector_1", "E", bins=200, range=(0, 1000), filter=detector_1)
+    collection.histo1d("energy_cut", "E", bins=200, range=(0, 1000), cuts=(cut, "E", "dE"))
+    collection.histo1d("energy_edges", "E", bins=edges, range=None)
+    collection.histo2d("pid", "E", "dE", bins=(50, 40), range=[[0, 1000], [0, 1000]])
+    collection.histo2d("pid_detector_1_cut", "E", "dE", bins=(50, 40), range=[[0, 1000], [0, 1000]], filter=detector_1, cuts=(cut, "E", "dE"))
+    return collection
+
+def test_query_matches_numpy(events):
+    expected, edges = expected_histograms(events)
+    histograms = declare(HistogramQuery(events), edges).collect()
+    for name, counts in expected.items():
+        assert np.array_equal(histograms[name].counts, counts), name
+
+@pytest.mark.parametrize("workers", [None, 3])
+def test_batch_matches_numpy(events, workers):
+    expected, edges = expected_histograms(events)
+    histograms = declare(HistogramBatch(), edges).fill(events, workers=workers)
+    for name, counts in expected.items():
+        assert np.array_equal(histograms[name].counts, counts), name
+
+def test_batch_from_parquet_in_batches_matches_numpy(events, tmp_path):
+    path = str(tmp_path / "events.parquet")
+    events.write_parquet(path)
+    expected, edges = expected_histograms(events)
+    histograms = declare(HistogramBatch(), edges).fill(path, batch_size=30_000)
+    for name, counts in expected.items():
+        assert np.array_equal(histograms[name].counts, counts), name